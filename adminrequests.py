@@ -1,7 +1,7 @@
 from sqlalchemy import select, update, delete
 from models import (async_session, User, UserWallet, WalletTransaction, VPNSubscription, TypesVPN,
     CountriesVPN, ServersVPN, Tariff, ExchangeRate, Order, Payment, ReferralConfig, ReferralEarning,
-    PromoCode, PromoCodeUsage, BundlePlan, BundleServer, BundleTariff, WalletOperation,
+    PromoCode, PromoCodeUsage, BundlePlan, BundleServer, BundleTariff, BundleSubscription, WalletOperation,
     UserFreeDaysBalance, UserCheckin, UserTask, UserReward, UserRewardOp)
 from typing import List
 from datetime import datetime, timedelta, timezone
@@ -9,8 +9,10 @@ from decimal import Decimal
 from sqlalchemy import func
 from urllib.parse import quote
 
-from xui_api import XUIApi
+from xui_api import invalidate_xui
 import tasksrequests as taskrq
+import subscriptionrequests as subrq
+import pricingrequests as pricerq
 
 # --- ADMIN ------------------------------------------------------------
 
@@ -604,6 +606,9 @@ async def admin_update_server(server_id: int, data):
             )
         )
         await session.commit()
+        invalidate_xui(server_id)
+        subrq.invalidate_server_bundles(server_id)
+        subrq.invalidate_server_tokens(server_id)
         return {"status": "ok"}
 
 async def admin_delete_server(server_id: int):
@@ -614,6 +619,9 @@ async def admin_delete_server(server_id: int):
 
         await session.delete(server)
         await session.commit()
+        invalidate_xui(server_id)
+        subrq.invalidate_server_bundles(server_id)
+        subrq.invalidate_server_tokens(server_id)
         return {"status": "ok"}
 
 
@@ -642,6 +650,7 @@ async def admin_add_tariff(server_id: int, days: int, price_tarif: Decimal, is_a
         )
         session.add(t)
         await session.commit()
+        pricerq.invalidate()
         await session.refresh(t)
         return {"idTarif": t.idTarif}
 
@@ -655,6 +664,7 @@ async def admin_update_tariff(tariff_id: int, days: int, price_tarif: Decimal, i
         t.price_tarif = price_tarif
         t.is_active = is_active
         await session.commit()
+        pricerq.invalidate()
         return {"status": "ok"}
 
 async def admin_delete_tariff(tariff_id: int):
@@ -665,6 +675,7 @@ async def admin_delete_tariff(tariff_id: int):
 
         await session.delete(t)
         await session.commit()
+        pricerq.invalidate()
         return {"status": "ok"}
 
 
@@ -695,6 +706,7 @@ async def admin_add_bundle_tariff(data: dict):
         )
         session.add(t)
         await session.commit()
+        pricerq.invalidate()
         await session.refresh(t)
         return {"id": t.id}
 
@@ -710,6 +722,7 @@ async def admin_update_bundle_tariff(tariff_id: int, data: dict):
                 setattr(t, field, data[field])
 
         await session.commit()
+        pricerq.invalidate()
         return {"status": "ok"}
 
 
@@ -720,6 +733,7 @@ async def admin_delete_bundle_tariff(tariff_id: int):
             raise ValueError("BundleTariff not found")
         await session.delete(t)
         await session.commit()
+        pricerq.invalidate()
         return {"status": "ok"}
 
 
@@ -779,7 +793,12 @@ async def admin_update_bundle_plan(plan_id: int, data: dict):
             for server_id in data["server_ids"]:
                 session.add(BundleServer(bundle_plan_id=plan_id, server_id=server_id))
 
+        bundle_ids = (await session.scalars(
+            select(BundleSubscription.id).where(BundleSubscription.bundle_plan_id == plan_id)
+        )).all() if "server_ids" in data else []
         await session.commit()
+        for bundle_id in bundle_ids:
+            subrq.forget_bundle(bundle_id)
         return {"status": "ok"}
 
 
@@ -788,8 +807,14 @@ async def admin_delete_bundle_plan(plan_id: int):
         plan = await session.get(BundlePlan, plan_id)
         if not plan:
             raise ValueError("BundlePlan not found")
+        # подписки плана удалятся каскадом — запоминаем их до удаления
+        bundle_ids = (await session.scalars(
+            select(BundleSubscription.id).where(BundleSubscription.bundle_plan_id == plan_id)
+        )).all()
         await session.delete(plan)
         await session.commit()
+        for bundle_id in bundle_ids:
+            subrq.forget_bundle(bundle_id)
         return {"status": "ok"}
     
 
@@ -821,6 +846,7 @@ async def admin_set_exchange_rate(pair: str, rate_value: Decimal):
             session.add(rate)
 
         await session.commit()
+        pricerq.invalidate()
 
         return {
             "pair": rate.pair,
@@ -1020,6 +1046,7 @@ async def admin_update_vpn_subscription(sub_id: int, data: dict):
                 setattr(sub, key, value)
 
         await session.commit()
+        subrq.invalidate_token(sub.access_token)
         return {"status": "ok"}
 
 
@@ -1031,6 +1058,7 @@ async def admin_delete_vpn_subscription(sub_id: int):
 
         await session.delete(sub)
         await session.commit()
+        subrq.invalidate_token(sub.access_token)
         return {"status": "ok"}
 
 
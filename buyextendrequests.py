@@ -4,12 +4,29 @@ from models import (async_session, User, UserWallet, WalletTransaction, VPNSubsc
 from typing import List
 from datetime import datetime, timezone, timedelta
 from decimal import Decimal
-from xui_api import XUIApi
+from xui_api import get_xui
+import os
+import asyncio
 import uuid as uuid_lib
 from sqlalchemy import select
 import requestsfile as rq
+import subscriptionrequests as subrq
 import main as main
 
+BUNDLE_PROVISION_CONCURRENCY = int(os.getenv("BUNDLE_PROVISION_CONCURRENCY", "4"))
+
+
+def _to_ms(dt: datetime) -> int:
+    return int(dt.timestamp() * 1000)
+
+
+def renewal_target(current: datetime | None, days: int) -> datetime:
+    """целевой срок продления: от текущего, если не истёк, иначе от сейчас.
+    Считаем один раз и передаём как until — повтор после частичной ошибки не продлит сервер дважды"""
+    now = datetime.now(timezone.utc)
+    base = current if current and current > now else now
+    return base + timedelta(days=days)
+
 
 # СОЗДАНИЕ ЗАКАЗА    
 async def create_order(user_id: int,server_id: int,tariff_id: int,amount_usdt: Decimal,purpose_order: str = "buy",currency: str = "XTR"):
@@ -23,7 +40,8 @@ async def create_order(user_id: int,server_id: int,tariff_id: int,amount_usdt: D
 
 
 # СОЗДАНИЕ КЛЮЧА покупка
-async def create_vpn_xui(user_id: int, server_id: int, tariff_days: int):
+async def create_vpn_xui(user_id: int, server_id: int, tariff_days: int, order_id: int | None = None):
+    """order_id — заказ из очереди выдачи: подписка пишется в него в той же транзакции (повтор её не дублирует)"""
     async with async_session() as session:
         user = await session.get(User, user_id)
         server = await session.get(ServersVPN, server_id)
@@ -31,8 +49,8 @@ async def create_vpn_xui(user_id: int, server_id: int, tariff_days: int):
         if not user or not server:
             raise Exception("User or server not found")
 
-        xui = XUIApi(server.api_url, server.xui_username, server.xui_password)
-        client_email = await rq.generate_unique_client_email(session, user_id, server, xui)
+        xui = get_xui(server)
+        client_email = await rq.generate_unique_client_email(session, user_id, server)
         main.logger.info("Client email: server=%s email=%s", server.nameVPN, client_email)
         inbound = await xui.get_inbound_by_port(server.inbound_port)
         if not inbound:
@@ -58,6 +76,10 @@ async def create_vpn_xui(user_id: int, server_id: int, tariff_days: int):
             created_at=now,expires_at=expires_at,is_active=True,status="active")
 
         session.add(subscription)
+        if order_id is not None:
+            await session.flush()
+            order = await session.get(Order, order_id)
+            order.subscription_id = subscription.id
         await rq.recalc_server_load(session, server_id)
         await session.commit()
 
@@ -66,7 +88,8 @@ async def create_vpn_xui(user_id: int, server_id: int, tariff_days: int):
         
         
 # продление
-async def pay_and_extend_vpn(subscription_id: int, tariff_id: int):
+async def pay_and_extend_vpn(subscription_id: int, tariff_id: int, until: datetime | None = None):
+    """until — целевой срок, посчитанный один раз (очередь выдачи): повтор не добавит дни второй раз"""
     async with async_session() as session:
         tariff = await session.get(Tariff, tariff_id)
         if not tariff:
@@ -77,7 +100,7 @@ async def pay_and_extend_vpn(subscription_id: int, tariff_id: int):
             raise ValueError("Subscription not found")
 
         server = await session.get(ServersVPN, sub.idServerVPN)
-        xui = XUIApi(server.api_url, server.xui_username, server.xui_password)
+        xui = get_xui(server)
         inbound = await xui.get_inbound_by_port(server.inbound_port)
         if not inbound:
             raise Exception("Inbound not found")
@@ -86,7 +109,8 @@ async def pay_and_extend_vpn(subscription_id: int, tariff_id: int):
             inbound_id=inbound.id,
             client_email=sub.provider_client_email,
             days=tariff.days,
-            sub_id=sub.subscription_id
+            sub_id=sub.subscription_id,
+            expiry_ms=_to_ms(until) if until else None
         )
         if not sub.subscription_id and extend_result.get("sub_id"):
             sub.subscription_id = extend_result["sub_id"]
@@ -94,7 +118,9 @@ async def pay_and_extend_vpn(subscription_id: int, tariff_id: int):
 
         now = datetime.now(timezone.utc)
 
-        if sub.expires_at and sub.expires_at > now:
+        if until:
+            sub.expires_at = max(sub.expires_at, until) if sub.expires_at else until
+        elif sub.expires_at and sub.expires_at > now:
             sub.expires_at += timedelta(days=tariff.days)
         else:
             sub.expires_at = now + timedelta(days=tariff.days)
@@ -103,6 +129,7 @@ async def pay_and_extend_vpn(subscription_id: int, tariff_id: int):
         sub.status = "active"
         await rq.recalc_server_load(session, sub.idServerVPN)
         await session.commit()
+        subrq.invalidate_token(sub.access_token)
 
         return {"subscription_id": sub.id,"days_added": tariff.days,
             "subscription_url": sub.subscription_url,
@@ -135,9 +162,11 @@ async def rotate_vpn_access_token(session, subscription_id: int, user_id: int):
     if not new_subscription_url:
         raise ValueError("SUBSCRIPTION_URL_UNAVAILABLE")
 
+    old_token = sub.access_token
     sub.access_token = new_token
     sub.subscription_url = new_subscription_url
     await session.commit()
+    subrq.invalidate_token(old_token)
 
     return {
         "subscription_id": sub.id,
@@ -157,9 +186,11 @@ async def rotate_bundle_access_token(session, bundle_subscription_id: int, user_
     if not new_subscription_url:
         raise ValueError("SUBSCRIPTION_URL_UNAVAILABLE")
 
+    old_token = bundle_sub.access_token
     bundle_sub.access_token = new_token
     bundle_sub.subscription_url = new_subscription_url
     await session.commit()
+    subrq.invalidate_token(old_token)
 
     return {
         "bundle_subscription_id": bundle_sub.id,
@@ -174,7 +205,7 @@ async def remove_vpn_xui(subscription: VPNSubscription):
         if not server:
             raise Exception("Сервер не найден")
 
-        xui = XUIApi(server.api_url, server.xui_username, server.xui_password)
+        xui = get_xui(server)
         inbound = await xui.get_inbound_by_port(server.inbound_port)
         if not inbound:
             raise Exception("Inbound не найден")
@@ -436,19 +467,15 @@ async def renew_bundle_from_balance(tg_id: int, bundle_subscription_id: int, bun
         await session.flush()
         session.add(Payment(order_id=order.id,provider="balance",provider_payment_id=f"balance_{order.id}",status="paid"))
 
-        await extend_bundle_subscription(session, bundle_sub, plan, servers, tariff.days)
-
-        now = datetime.utcnow()
-        if bundle_sub.expires_at and bundle_sub.expires_at > now:
-            bundle_sub.expires_at = bundle_sub.expires_at + timedelta(days=tariff.days)
-        else:
-            bundle_sub.expires_at = now + timedelta(days=tariff.days)
-
-        bundle_sub.is_active = True
-        bundle_sub.status = "active"
+        # при ошибке на части серверов транзакция откатывается и срок в БД прежний:
+        # повтор посчитает тот же until, и уже продлённые серверы не получат дни второй раз
+        until = renewal_target(bundle_sub.expires_at, tariff.days)
+        await extend_bundle_subscription(session, bundle_sub, plan, servers, tariff.days, until=until)
 
         order.status = "completed"
         await session.commit()
+        subrq.invalidate_bundle(bundle_sub.id)
+        subrq.invalidate_token(bundle_sub.access_token)
 
         return {
             "subscription_url": bundle_sub.subscription_url,
@@ -458,6 +485,18 @@ async def renew_bundle_from_balance(tg_id: int, bundle_subscription_id: int, bun
         }
 
 
+async def _fan_out(servers: list[ServersVPN], work) -> list:
+    """work(server) по всем серверам параллельно, не больше BUNDLE_PROVISION_CONCURRENCY сразу.
+    Возвращает результаты по порядку серверов; исключения — в виде значений"""
+    sem = asyncio.Semaphore(BUNDLE_PROVISION_CONCURRENCY)
+
+    async def run(server):
+        async with sem:
+            return await work(server)
+
+    return await asyncio.gather(*(run(s) for s in servers), return_exceptions=True)
+
+
 async def create_bundle_subscription(session, user_id: int, plan: BundlePlan, servers: list[ServersVPN], tariff_days: int) -> BundleSubscription:
     sub_id = uuid_lib.uuid4().hex[:16]
     access_token = uuid_lib.uuid4().hex
@@ -479,22 +518,43 @@ async def create_bundle_subscription(session, user_id: int, plan: BundlePlan, se
 
     subscription_url = rq.build_bundle_subscription_url(access_token)
 
+    # email-ы — последовательно: сессия БД одна на все серверы
+    emails = {}
     for server in servers:
-        xui = XUIApi(server.api_url, server.xui_username, server.xui_password)
+        emails[server.idServerVPN] = await rq.generate_unique_bundle_client_email(session, user_id, server)
+        main.logger.info("Bundle client email: server=%s email=%s", server.nameVPN, emails[server.idServerVPN])
+
+    async def provision(server):
+        xui = get_xui(server)
         inbound = await xui.get_inbound_by_port(server.inbound_port)
         if not inbound:
             raise Exception("Inbound not found")
-        client_email = await rq.generate_unique_bundle_client_email(session, user_id, server, xui)
-        main.logger.info("Bundle client email: server=%s email=%s", server.nameVPN, client_email)
-        client = await xui.add_client(inbound_id=inbound.id, email=client_email, days=tariff_days, sub_id=sub_id)
-        item_sub_id = client.get("sub_id") or sub_id
-
+        client = await xui.add_client(inbound_id=inbound.id, email=emails[server.idServerVPN], days=tariff_days, sub_id=sub_id)
+        return inbound.id, client
+
+    results = await _fan_out(servers, provision)
+    failed = [(s, r) for s, r in zip(servers, results) if isinstance(r, BaseException)]
+    if failed:
+        # откатываем то, что успели создать на панелях
+        async def compensate(server):
+            inbound_id, client = results[servers.index(server)]
+            await get_xui(server).remove_client(inbound_id=inbound_id, client_uuid=client["uuid"])
+
+        created = [s for s, r in zip(servers, results) if not isinstance(r, BaseException)]
+        for server, err in zip(created, await _fan_out(created, compensate)):
+            if isinstance(err, BaseException):
+                main.logger.error("Bundle rollback failed: server=%s email=%s err=%s", server.nameVPN, emails[server.idServerVPN], err)
+        for server, err in failed:
+            main.logger.error("Bundle provision failed: server=%s err=%s", server.nameVPN, err)
+        raise failed[0][1]
+
+    for server, (_, client) in zip(servers, results):
         session.add(BundleSubscriptionItem(
             bundle_subscription_id=bundle_sub.id,
             server_id=server.idServerVPN,
-            client_email=client_email,
+            client_email=emails[server.idServerVPN],
             client_uuid=client["uuid"],
-            subscription_id=item_sub_id
+            subscription_id=client.get("sub_id") or sub_id
         ))
 
     bundle_sub.subscription_id = sub_id
@@ -502,31 +562,44 @@ async def create_bundle_subscription(session, user_id: int, plan: BundlePlan, se
     return bundle_sub
 
 
-async def extend_bundle_subscription(session, bundle_sub: BundleSubscription, plan: BundlePlan, servers: list[ServersVPN], tariff_days: int):
+async def extend_bundle_subscription(session, bundle_sub: BundleSubscription, plan: BundlePlan, servers: list[ServersVPN], tariff_days: int,
+    until: datetime | None = None):
+    """until — целевой срок (renewal_target): серверы, продлённые прошлой попыткой, повторно не продлеваются"""
     items = (await session.scalars(
         select(BundleSubscriptionItem).where(BundleSubscriptionItem.bundle_subscription_id == bundle_sub.id)
     )).all()
     items_map = {i.server_id: i for i in items}
+    if any(s.idServerVPN not in items_map for s in servers):
+        raise Exception("BUNDLE_ITEM_NOT_FOUND")
 
-    for server in servers:
-        item = items_map.get(server.idServerVPN)
-        if not item:
-            raise Exception("BUNDLE_ITEM_NOT_FOUND")
-        xui = XUIApi(server.api_url, server.xui_username, server.xui_password)
+    async def renew(server):
+        item = items_map[server.idServerVPN]
+        xui = get_xui(server)
         inbound = await xui.get_inbound_by_port(server.inbound_port)
         if not inbound:
             raise Exception("Inbound not found")
-        await xui.extend_client(
+        return await xui.extend_client(
             inbound_id=inbound.id,
             client_email=item.client_email,
             days=tariff_days,
-            sub_id=item.subscription_id or bundle_sub.subscription_id
+            sub_id=item.subscription_id or bundle_sub.subscription_id,
+            expiry_ms=_to_ms(until) if until else None
         )
 
+    results = await _fan_out(servers, renew)
+    failed = [(s, r) for s, r in zip(servers, results) if isinstance(r, BaseException)]
+    for server, err in failed:
+        main.logger.error("Bundle extend failed: server=%s sub=%s err=%s", server.nameVPN, bundle_sub.id, err)
+    if failed:
+        raise failed[0][1]
+
     now = datetime.utcnow()
-    if bundle_sub.expires_at and bundle_sub.expires_at > now:
+    if until:
+        bundle_sub.expires_at = max(bundle_sub.expires_at, until) if bundle_sub.expires_at else until
+    elif bundle_sub.expires_at and bundle_sub.expires_at > now:
         bundle_sub.expires_at = bundle_sub.expires_at + timedelta(days=tariff_days)
     else:
         bundle_sub.expires_at = now + timedelta(days=tariff_days)
     bundle_sub.is_active = True
-    bundle_sub.status = "active"
\ No newline at end of file
+    bundle_sub.status = "active"
+    # кеши подписки сбрасывает вызывающий после commit — иначе фоновая пересборка прочитает старый срок
@@ -0,0 +1,91 @@
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from sqlalchemy import select, func, literal, false
+from sqlalchemy.orm import aliased
+
+from models import (User, Order, Tariff, ServersVPN, VPNSubscription, BundleTariff, BundlePlan, BundleServer,
+    BundleSubscription)
+import pricingrequests as pricerq
+
+
+ACTIVE_ORDER_STATUSES = ("pending", "paid", "processing")
+
+
+class InvoiceContext:
+    """всё, что нужно инвойс-эндпоинту до вызова провайдера; отсутствующее — None"""
+
+    def __init__(self, user, active, tariff, sub, server, bundle_tariff, plan, bundle_sub, rate, first_server_id):
+        self.user = user
+        self.active = active
+        self.tariff = tariff
+        self.sub = sub
+        self.server = server
+        self.bundle_tariff = bundle_tariff
+        self.plan = plan
+        self.bundle_sub = bundle_sub
+        self.rate = rate  # Decimal из кеша курсов
+        self.first_server_id = first_server_id  # первый сервер bundle-плана (для Order.server_id)
+
+    @property
+    def days(self) -> int:
+        return (self.tariff or self.bundle_tariff).days
+
+    @property
+    def price_usdt(self) -> Decimal:
+        if self.tariff:
+            return Decimal(self.tariff.price_tarif)
+        return Decimal(self.bundle_tariff.price_usdt)
+
+    def stars_price(self) -> int:
+        return pricerq.stars_from_usdt(self.price_usdt, self.rate)
+
+    def rub_price(self) -> Decimal:
+        return self.price_usdt * self.rate
+
+
+def _by_id(column, value):
+    return column == value if value is not None else false()
+
+
+async def load_invoice_context(session, tg_id: int, tariff_id: int | None = None, subscription_id: int | None = None,
+    bundle_tariff_id: int | None = None, bundle_subscription_id: int | None = None,
+    rate_pair: str | None = None) -> InvoiceContext:
+    """пользователь + активный заказ + тариф + сервер/план одним запросом (LEFT JOIN от одной строки), курс — из кеша"""
+    anchor = select(literal(1).label("one")).subquery()
+    active_order = aliased(Order)
+    active_id = (select(Order.id)
+        .where(Order.idUser == User.idUser, Order.status.in_(ACTIVE_ORDER_STATUSES))
+        .order_by(Order.created_at.desc())
+        .limit(1)
+        .correlate(User)
+        .scalar_subquery())
+    first_server_id = (select(BundleServer.server_id)
+        .where(BundleServer.bundle_plan_id == BundlePlan.id)
+        .order_by(BundleServer.id)
+        .limit(1)
+        .correlate(BundlePlan)
+        .scalar_subquery())
+
+    q = (select(User, active_order, Tariff, VPNSubscription, ServersVPN, BundleTariff, BundlePlan, BundleSubscription,
+            first_server_id)
+        .select_from(anchor)
+        .outerjoin(User, User.tg_id == tg_id)
+        .outerjoin(active_order, active_order.id == active_id)
+        .outerjoin(Tariff, _by_id(Tariff.idTarif, tariff_id))
+        .outerjoin(VPNSubscription, _by_id(VPNSubscription.id, subscription_id))
+        .outerjoin(ServersVPN, ServersVPN.idServerVPN == func.coalesce(VPNSubscription.idServerVPN, Tariff.server_id))
+        .outerjoin(BundleTariff, _by_id(BundleTariff.id, bundle_tariff_id))
+        .outerjoin(BundlePlan, BundlePlan.id == BundleTariff.bundle_plan_id)
+        .outerjoin(BundleSubscription, _by_id(BundleSubscription.id, bundle_subscription_id)))
+    row = (await session.execute(q)).one()
+    rate = await pricerq.get_rate(rate_pair) if rate_pair else None
+    ctx = InvoiceContext(*row[:8], rate, row[8])
+
+    # просроченный pending-заказ не блокирует новый (как было в get_active_order_for_user)
+    active = ctx.active
+    if active and active.status == "pending" and active.expires_at and active.expires_at < datetime.now(timezone.utc):
+        active.status = "expired"
+        await session.commit()
+        ctx.active = None
+    return ctx
@@ -2,14 +2,13 @@ from contextlib import asynccontextmanager
 import asyncio
 from datetime import datetime, timedelta, timezone
 from decimal import Decimal
-from fastapi import FastAPI, HTTPException, Path, Request, Response
+from fastapi import FastAPI, HTTPException, Path, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from sqlalchemy import select, update, delete, and_, or_
 from sqlalchemy.exc import SQLAlchemyError
 import logging
 import base64
-import requests
 import os
 
 from aiogram import Bot, Dispatcher, F
@@ -27,8 +26,18 @@ import yookassarequests as ykrq
 import walletrequests as wrq
 import tasksrequests as taskrq
 import adminrequests as rqadm
+import reconcilerequests as recrq
+import subscriptionrequests as subrq
 from cryptopay_client import crypto
 from scheduler import start_scheduler
+from xui_api import close_all_xui
+import subscription_app
+import provisioningrequests as provrq
+import webhookrequests as whrq
+import invoicerequests as invrq
+import pricingrequests as pricerq
+import panel_health
+import panel_metrics
 
 logger = logging.getLogger(__name__)
 
@@ -38,11 +47,6 @@ WEBHOOK_PATH = "/webhook"
 bot = Bot(BOT_TOKEN)
 dp = Dispatcher()
 
-SUB_PROFILE_TITLE = "Artcry VPN"
-SUB_UPDATE_INTERVAL_HOURS = "1"
-SUB_SUPPORT_URL = "https://t.me/testvpnartcrybot"
-SUB_WEB_PAGE_URL = "https://t.me/testvpnartcrybot"
-
 
 # ======================
 # APP
@@ -51,12 +55,18 @@ SUB_WEB_PAGE_URL = "https://t.me/testvpnartcrybot"
 async def lifespan(app_: FastAPI):
     await init_db()
     start_scheduler()
+    provrq.start_workers()
     print("✅ VPN backend ready!")
     yield
+    await provrq.stop_workers()
+    await close_all_xui()
+    await subrq.close_subscription_http()
+    await ykrq.close_yookassa_http()
 
 
 app = FastAPI(title="ArtCry VPN", lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"],)
+app.include_router(subscription_app.router)  # подписки можно вынести в отдельный процесс: uvicorn subscription_app:app
 
 
 # TELEGRAM WEBHOOK
@@ -171,7 +181,7 @@ ORDER_TTL_MINUTES = 10
 async def get_active_order_for_user(session, user_id: int):
     now = datetime.now(timezone.utc)
 
-    q = (select(Order).where(Order.idUser == user_id,Order.status.in_(("pending", "processing"))).order_by(Order.created_at.desc()))
+    q = (select(Order).where(Order.idUser == user_id,Order.status.in_(("pending", "paid", "processing"))).order_by(Order.created_at.desc()))
 
     order = await session.scalar(q)
 
@@ -310,151 +320,6 @@ async def rotate_bundle_token(data: RotateBundleTokenRequest):
             raise HTTPException(400, msg)
 
 
-@app.get("/api/vpn/sub/{token}")
-async def single_subscription(token: str):
-    async with async_session() as session:
-        sub = await session.scalar(select(VPNSubscription).where(VPNSubscription.access_token == token))
-        if not sub:
-            raise HTTPException(404, "Subscription not found")
-        server = await session.get(ServersVPN, sub.idServerVPN)
-        if not server:
-            raise HTTPException(404, "Server not found")
-
-    url = rq.build_subscription_url(server, sub.subscription_id)
-    if not url:
-        raise HTTPException(400, "SUBSCRIPTION_URL_UNAVAILABLE")
-
-    try:
-        resp = requests.get(url, timeout=10, verify=False, headers={"User-Agent": "ArtCryVPN/1.0"})
-        if resp.status_code != 200:
-            raise Exception(f"status={resp.status_code}")
-        content = resp.text
-    except Exception as e:
-        logger.exception("Single sub fetch error: %s", e)
-        raise HTTPException(502, "SUBSCRIPTION_FETCH_FAILED")
-
-    headers = {
-        "profile-title": SUB_PROFILE_TITLE,
-        "profile-update-interval": SUB_UPDATE_INTERVAL_HOURS,
-        "support-url": SUB_SUPPORT_URL,
-        "profile-web-page-url": SUB_WEB_PAGE_URL,
-        "subscription-userinfo": f"expire={int(sub.expires_at.timestamp())}",
-        "update-always": "true",
-        "Cache-Control": "no-store, max-age=0",
-        "Pragma": "no-cache",
-        "Expires": "0",
-    }
-    return Response(content=content, media_type="text/plain; charset=utf-8", headers=headers)
-
-
-@app.get("/api/vpn/bundle/sub/{access_token}")
-async def bundle_subscription(access_token: str):
-    async with async_session() as session:
-        bundle_sub = await session.scalar(
-            select(BundleSubscription).where(BundleSubscription.access_token == access_token)
-        )
-        if not bundle_sub:
-            raise HTTPException(404, "Bundle subscription not found")
-
-        rows = await session.execute(
-            select(BundleSubscriptionItem, ServersVPN)
-            .join(ServersVPN, BundleSubscriptionItem.server_id == ServersVPN.idServerVPN)
-            .where(BundleSubscriptionItem.bundle_subscription_id == bundle_sub.id)
-        )
-        items = rows.all()
-
-    if not items:
-        raise HTTPException(404, "Bundle subscription items not found")
-
-    sub_urls = []
-    for item, server in items:
-        sub_id = item.subscription_id or bundle_sub.subscription_id
-        url = rq.build_subscription_url(server, sub_id)
-        if url:
-            sub_urls.append(url)
-
-    if not sub_urls:
-        raise HTTPException(400, "SUBSCRIPTION_URL_UNAVAILABLE")
-
-    def fetch_subscription(url: str) -> str:
-        try:
-            resp = requests.get(url, timeout=10, verify=False, headers={"User-Agent": "ArtCryVPN/1.0"})
-            if resp.status_code == 200:
-                return resp.text
-            if url.startswith("https://"):
-                http_url = "http://" + url[len("https://"):]
-                resp = requests.get(http_url, timeout=10, verify=False, headers={"User-Agent": "ArtCryVPN/1.0"})
-                if resp.status_code == 200:
-                    logger.info("Bundle sub fetch fallback to http: %s", http_url)
-                    return resp.text
-            logger.warning("Bundle sub fetch failed: %s status=%s", url, resp.status_code)
-        except Exception:
-            logger.exception("Bundle sub fetch error: %s", url)
-            return ""
-        return ""
-
-    async def fetch_with_retries(url: str, retries: int = 2, delay_sec: float = 0.6) -> str:
-        last = ""
-        for attempt in range(retries + 1):
-            last = await asyncio.to_thread(fetch_subscription, url)
-            if last.strip():
-                return last
-            if attempt < retries:
-                await asyncio.sleep(delay_sec)
-        logger.warning("Bundle sub empty after retries: %s", url)
-        return last
-
-    texts = await asyncio.gather(*[
-        fetch_with_retries(url) for url in sub_urls
-    ])
-
-    raw_lines = []
-    for text in texts:
-        for line in text.splitlines():
-            line = line.strip()
-            if line:
-                raw_lines.append(line)
-
-    def decode_if_base64(line: str) -> list[str]:
-        # Try to decode base64 subscriptions into URI lines.
-        try:
-            decoded = base64.b64decode(line + "==", validate=False).decode("utf-8", errors="ignore")
-            decoded_lines = [l.strip() for l in decoded.splitlines() if l.strip()]
-            if decoded_lines:
-                return decoded_lines
-        except Exception:
-            pass
-        return [line]
-
-    merged = []
-    seen = set()
-    for line in raw_lines:
-        for item in decode_if_base64(line):
-            if item in seen:
-                continue
-            seen.add(item)
-            merged.append(item)
-
-    for url, text in zip(sub_urls, texts):
-        if not text.strip():
-            logger.warning("Bundle sub empty content: %s", url)
-    logger.info("Bundle sub aggregated raw=%s merged=%s urls=%s", len(raw_lines), len(merged), len(sub_urls))
-
-    encoded = base64.b64encode("\n".join(merged).encode("utf-8")).decode("utf-8")
-    headers = {
-        "profile-title": SUB_PROFILE_TITLE,
-        "profile-update-interval": SUB_UPDATE_INTERVAL_HOURS,
-        "support-url": SUB_SUPPORT_URL,
-        "profile-web-page-url": SUB_WEB_PAGE_URL,
-        "subscription-userinfo": f"expire={int(bundle_sub.expires_at.timestamp())}",
-        "update-always": "true",
-        "Cache-Control": "no-store, max-age=0",
-        "Pragma": "no-cache",
-        "Expires": "0",
-    }
-    return Response(content=encoded, media_type="text/plain; charset=utf-8", headers=headers)
-
-
 # === КАСАЕМО ПОКУПКИ, ПРОДЛЕНИЯ И ОПЛАТ =====
 @app.get("/api/payment/status/{payment_id}")
 async def get_payment_status(payment_id: int):
@@ -473,34 +338,27 @@ class CreateInvoiceRequest(BaseModel):
 @app.post("/api/vpn/create_invoice")
 async def create_invoice(data: CreateInvoiceRequest):
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == data.tg_id))
+        ctx = await invrq.load_invoice_context(session, data.tg_id, tariff_id=data.tariff_id, rate_pair="XTR_USDT")
+        user, tariff, server = ctx.user, ctx.tariff, ctx.server
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        active = await get_active_order_for_user(session, user.idUser)
+        active = ctx.active
         if active:
             raise HTTPException(status_code=409,
-                detail={"error": "ACTIVE_ORDER_EXISTS","order_id": active.id,
-                    "status": active.status,"expires_at": active.expires_at.isoformat() if active.expires_at else None}
+                detail={"error": "ACTIVE_ORDER_EXISTS","order_id": active.id,"status": active.status,
+                    "expires_at": active.expires_at.isoformat() if active.expires_at else None}
             )
 
-        tariff = await session.scalar(select(Tariff).where(Tariff.idTarif == data.tariff_id))
         if not tariff or not tariff.is_active:
             raise HTTPException(status_code=404, detail="Tariff not found")
-
-        server = await session.scalar(select(ServersVPN).where(ServersVPN.idServerVPN == tariff.server_id))
         if not server:
             raise HTTPException(status_code=404, detail="Server not found")
-
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "XTR_USDT"))
-        if not rate:
+        if not ctx.rate:
             raise HTTPException(status_code=400, detail="Exchange rate not set")
 
-        price_usdt = Decimal(tariff.price_tarif)
-        rate_usdt = Decimal(rate.rate)
-        stars_price = int(price_usdt / rate_usdt)
-        if stars_price < 1:
-            stars_price = 1
+        price_usdt = ctx.price_usdt
+        stars_price = ctx.stars_price()
 
         order = Order(idUser=user.idUser,server_id=server.idServerVPN,idTarif=tariff.idTarif,
             purpose_order="buy",amount=price_usdt,currency="USDT",provider="stars",status="pending",
@@ -529,35 +387,27 @@ class RenewInvoiceRequest(BaseModel):
 @app.post("/api/vpn/renew-invoice")
 async def renew_invoice(data: RenewInvoiceRequest):
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == data.tg_id))
+        ctx = await invrq.load_invoice_context(session, data.tg_id, tariff_id=data.tariff_id,
+            subscription_id=data.subscription_id, rate_pair="XTR_USDT")
+        user, sub, tariff, server = ctx.user, ctx.sub, ctx.tariff, ctx.server
         if not user:
             raise HTTPException(404, "User not found")
-
-        sub = await session.get(VPNSubscription, data.subscription_id)
         if not sub:
             raise HTTPException(404, "VPN key not found")
-
-        tariff = await session.get(Tariff, data.tariff_id)
         if not tariff or not tariff.is_active:
             raise HTTPException(404, "Subscription not found")
-
-        server = await session.get(ServersVPN, sub.idServerVPN)
-
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "XTR_USDT"))
-        if not rate:
+        if not ctx.rate:
             raise HTTPException(500, "Exchange rate not set")
 
-        active = await get_active_order_for_user(session, user.idUser)
+        active = ctx.active
         if active:
             raise HTTPException(status_code=409,
                 detail={"error": "ACTIVE_ORDER_EXISTS","order_id": active.id,"status": active.status,
                     "expires_at": active.expires_at.isoformat() if active.expires_at else None}
             )
 
-        price_usdt = Decimal(tariff.price_tarif)
-        stars_price = int(Decimal(tariff.price_tarif) / rate.rate)
-        if stars_price < 1:
-            stars_price = 1
+        price_usdt = ctx.price_usdt
+        stars_price = ctx.stars_price()
 
         order = Order(idUser=user.idUser,server_id=server.idServerVPN,idTarif=tariff.idTarif,subscription_id=sub.id,
             purpose_order="extension",amount=price_usdt,currency="USDT",provider="stars",status="pending",
@@ -593,46 +443,32 @@ class BundleRenewInvoiceRequest(BaseModel):
 @app.post("/api/vpn/bundle/create-invoice")
 async def bundle_create_invoice(data: BundleInvoiceRequest):
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == data.tg_id))
+        ctx = await invrq.load_invoice_context(session, data.tg_id, bundle_tariff_id=data.bundle_tariff_id, rate_pair="XTR_USDT")
+        user, tariff, plan = ctx.user, ctx.bundle_tariff, ctx.plan
         if not user:
             raise HTTPException(404, "User not found")
-
-        tariff = await session.get(BundleTariff, data.bundle_tariff_id)
         if not tariff or not tariff.is_active:
             raise HTTPException(404, "Bundle tariff not found")
-
-        plan = await session.get(BundlePlan, tariff.bundle_plan_id)
         if not plan or not plan.is_active:
             raise HTTPException(404, "Bundle plan not found")
-
-        server_ids = (await session.scalars(
-            select(BundleServer.server_id).where(BundleServer.bundle_plan_id == plan.id)
-        )).all()
-        if not server_ids:
+        if not ctx.first_server_id:
             raise HTTPException(400, "PLAN_HAS_NO_SERVERS")
-
-        server_id = server_ids[0]
-        server = await session.get(ServersVPN, server_id)
-
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "XTR_USDT"))
-        if not rate:
+        if not ctx.rate:
             raise HTTPException(500, "Exchange rate not set")
 
-        active = await get_active_order_for_user(session, user.idUser)
+        active = ctx.active
         if active:
             raise HTTPException(status_code=409,
                 detail={"error": "ACTIVE_ORDER_EXISTS","order_id": active.id,"status": active.status,
                     "expires_at": active.expires_at.isoformat() if active.expires_at else None}
             )
 
-        price_usdt = Decimal(tariff.price_usdt)
-        stars_price = int(Decimal(tariff.price_usdt) / rate.rate)
-        if stars_price < 1:
-            stars_price = 1
+        price_usdt = ctx.price_usdt
+        stars_price = ctx.stars_price()
 
         order = Order(
             idUser=user.idUser,
-            server_id=server.idServerVPN,
+            server_id=ctx.first_server_id,
             idTarif=None,
             subscription_id=None,
             bundle_plan_id=plan.id,
@@ -665,50 +501,37 @@ async def bundle_create_invoice(data: BundleInvoiceRequest):
 @app.post("/api/vpn/bundle/renew-invoice")
 async def bundle_renew_invoice(data: BundleRenewInvoiceRequest):
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == data.tg_id))
+        ctx = await invrq.load_invoice_context(session, data.tg_id, bundle_tariff_id=data.bundle_tariff_id,
+            bundle_subscription_id=data.bundle_subscription_id, rate_pair="XTR_USDT")
+        user, bundle_sub, tariff, plan = ctx.user, ctx.bundle_sub, ctx.bundle_tariff, ctx.plan
         if not user:
             raise HTTPException(404, "User not found")
-
-        bundle_sub = await session.get(BundleSubscription, data.bundle_subscription_id)
         if not bundle_sub:
             raise HTTPException(404, "Bundle subscription not found")
-
-        tariff = await session.get(BundleTariff, data.bundle_tariff_id)
         if not tariff or not tariff.is_active:
             raise HTTPException(404, "Bundle tariff not found")
-
-        plan = await session.get(BundlePlan, tariff.bundle_plan_id)
         if not plan or not plan.is_active:
             raise HTTPException(404, "Bundle plan not found")
         if plan.id != bundle_sub.bundle_plan_id:
             raise HTTPException(400, "TARIFF_NOT_ALLOWED_FOR_THIS_BUNDLE")
-
-        server_ids = (await session.scalars(
-            select(BundleServer.server_id).where(BundleServer.bundle_plan_id == plan.id)
-        )).all()
-        if not server_ids:
+        if not ctx.first_server_id:
             raise HTTPException(400, "PLAN_HAS_NO_SERVERS")
-        server = await session.get(ServersVPN, server_ids[0])
-
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "XTR_USDT"))
-        if not rate:
+        if not ctx.rate:
             raise HTTPException(500, "Exchange rate not set")
 
-        active = await get_active_order_for_user(session, user.idUser)
+        active = ctx.active
         if active:
             raise HTTPException(status_code=409,
                 detail={"error": "ACTIVE_ORDER_EXISTS","order_id": active.id,"status": active.status,
                     "expires_at": active.expires_at.isoformat() if active.expires_at else None}
             )
 
-        price_usdt = Decimal(tariff.price_usdt)
-        stars_price = int(Decimal(tariff.price_usdt) / rate.rate)
-        if stars_price < 1:
-            stars_price = 1
+        price_usdt = ctx.price_usdt
+        stars_price = ctx.stars_price()
 
         order = Order(
             idUser=user.idUser,
-            server_id=server.idServerVPN,
+            server_id=ctx.first_server_id,
             idTarif=None,
             subscription_id=None,
             bundle_subscription_id=bundle_sub.id,
@@ -757,13 +580,12 @@ async def wallet_deposit_stars(data: WalletDepositRequest):
 
 @app.post("/api/wallet/deposit/yookassa")
 async def wallet_deposit_yookassa(data: WalletDepositRequest):
-    async with async_session() as session:
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "RUB_USDT"))
-        if not rate:
-            raise HTTPException(500, "RUB rate not set")
+    rate = await pricerq.get_rate("RUB_USDT")
+    if not rate:
+        raise HTTPException(500, "RUB rate not set")
 
     result = await wrq.create_yookassa_deposit(data.tg_id,Decimal(data.amount_usdt))
-    amount_rub = Decimal(data.amount_usdt) * Decimal(rate.rate)
+    amount_rub = Decimal(data.amount_usdt) * rate
 
     payment_id, confirmation_url = await ykrq.create_yookassa_payment(
         result["wallet_operation_id"],
@@ -798,11 +620,11 @@ async def create_order_endpoint(data: OrderRequest):
         if not tariff or not tariff.is_active:
             raise HTTPException(status_code=404, detail="Tariff not found")
 
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "XTR_USDT"))
-        if not rate:
+        prices = await pricerq.price_matrix()
+        if not prices.rates.get("XTR_USDT"):
             raise HTTPException(status_code=500, detail="Exchange rate not found")
 
-        amount_stars = int(tariff.price_tarif / rate.rate)
+        amount_stars = prices.tariff_stars(tariff)
         return await berq.create_order(user.idUser, data.server_id, data.tariff_id, Decimal(amount_stars), currency="XTR")
 
 
@@ -827,6 +649,10 @@ async def successful_payment(message: Message):
     # ПОПОЛНЕНИЕ БАЛАНСА
     if prefix == "wallet":
         async with async_session() as session:
+            event_id = await whrq.begin_event(session, "telegram_stars", provider_payment_id)
+            if event_id is None:
+                logger.info("Stars payment replay: %s", provider_payment_id)
+                return
             op = await session.get(WalletOperation, entity_id)
             if not op:
                 logger.warning("Stars wallet op not found: %s", entity_id)
@@ -840,6 +666,7 @@ async def successful_payment(message: Message):
             session.add(payment)
 
             await wrq.complete_wallet_deposit(session, op.id)
+            await whrq.finish_event(session, event_id, {"ok": True, "wallet_operation_id": op.id})
             await session.commit()
 
         logger.info("Stars wallet completed: op_id=%s payment_id=%s", entity_id, provider_payment_id)
@@ -851,6 +678,10 @@ async def successful_payment(message: Message):
         return
 
     async with async_session() as session:
+        event_id = await whrq.begin_event(session, "telegram_stars", provider_payment_id)
+        if event_id is None:
+            logger.info("Stars payment replay: %s", provider_payment_id)
+            return
         order = await session.get(Order, entity_id)
         if not order:
             logger.warning("Stars order not found: %s", entity_id)
@@ -859,100 +690,14 @@ async def successful_payment(message: Message):
             logger.info("Stars order already handled: %s status=%s", order.id, order.status)
             return
 
-        order.status = "paid"
         payment = Payment(order_id=order.id,provider="telegram_stars",provider_payment_id=provider_payment_id,status="paid")
         session.add(payment)
-        await session.flush()
-        order.status = "processing"
-
-        tariff = await session.get(Tariff, order.idTarif) if order.idTarif else None
-        server = await session.get(ServersVPN, order.server_id) if order.server_id else None
-        bundle_tariff = await session.get(BundleTariff, order.bundle_tariff_id) if order.bundle_tariff_id else None
-
-        try:
-            if order.purpose_order == "buy":
-                vpn_data = await berq.create_vpn_xui(order.idUser,order.server_id,tariff.days)
-
-            elif order.purpose_order == "extension":
-                vpn_data = await berq.pay_and_extend_vpn(subscription_id=order.subscription_id,tariff_id=order.idTarif)
-
-            elif order.purpose_order == "bundle_buy":
-                plan = await session.get(BundlePlan, order.bundle_plan_id)
-                if not plan:
-                    raise Exception("Bundle plan not found")
-                if not bundle_tariff:
-                    raise Exception("Bundle tariff not found")
-                tariff_days = bundle_tariff.days
-                server_ids = (await session.scalars(
-                    select(BundleServer.server_id).where(BundleServer.bundle_plan_id == plan.id)
-                )).all()
-                servers = (await session.scalars(
-                    select(ServersVPN).where(ServersVPN.idServerVPN.in_(server_ids))
-                )).all()
-                bundle_sub = await berq.create_bundle_subscription(session, order.idUser, plan, servers, tariff_days)
-                order.bundle_subscription_id = bundle_sub.id
-                vpn_data = {"subscription_url": bundle_sub.subscription_url, "expires_at_human": rq.format_datetime_ru(bundle_sub.expires_at)}
-
-            elif order.purpose_order == "bundle_extension":
-                bundle_sub = await session.get(BundleSubscription, order.bundle_subscription_id)
-                if not bundle_sub:
-                    raise Exception("Bundle subscription not found")
-                plan = await session.get(BundlePlan, bundle_sub.bundle_plan_id)
-                if not bundle_tariff:
-                    raise Exception("Bundle tariff not found")
-                tariff_days = bundle_tariff.days
-                server_ids = (await session.scalars(
-                    select(BundleServer.server_id).where(BundleServer.bundle_plan_id == plan.id)
-                )).all()
-                servers = (await session.scalars(
-                    select(ServersVPN).where(ServersVPN.idServerVPN.in_(server_ids))
-                )).all()
-                await berq.extend_bundle_subscription(session, bundle_sub, plan, servers, tariff_days)
-                vpn_data = {"expires_at_human": rq.format_datetime_ru(bundle_sub.expires_at)}
-
-            else:
-                raise Exception("Unknown order purpose")
-
-        except Exception as e:
-            order.status = "failed"
-            await session.commit()
-            logger.exception("Stars order failed: %s error=%s", order.id, e)
-            await message.answer(f"❌ Ошибка создания VPN: {e}")
-            return
-
-        order.status = "completed"
-        await rq.process_referral_reward(session, order)
+        await provrq.enqueue_order(session, order)
+        await whrq.finish_event(session, event_id, {"ok": True, "order_id": order.id})
         await session.commit()
-        logger.info("Stars order completed: %s payment_id=%s", order.id, provider_payment_id)
 
-        if order.purpose_order == "buy":
-            await message.answer(
-                f"✅ <b>VPN готов!</b>\n"
-                f"Сервер: {server.nameVPN}\n"
-                f"Действует до: {vpn_data['expires_at_human']}\n\n"
-                f"<b>Ваша подписка:</b>\n"
-                f"<code>{vpn_data['subscription_url']}</code>",parse_mode="HTML"
-            )
-
-        elif order.purpose_order == "extension":
-            await message.answer(
-                f"♻️ <b>VPN успешно продлён!</b>\n"
-                f"➕ Добавлено дней: {vpn_data['days_added']}\n"
-                f"🕒 Новый срок: {vpn_data['expires_at_human']}",parse_mode="HTML"
-            )
-        elif order.purpose_order == "bundle_buy":
-            await message.answer(
-                f"✅ <b>VPN готов!</b>\n"
-                f"План: Все сервера\n"
-                f"Действует до: {vpn_data['expires_at_human']}\n\n"
-                f"<b>Ваша подписка:</b>\n"
-                f"<code>{vpn_data['subscription_url']}</code>",parse_mode="HTML"
-            )
-        elif order.purpose_order == "bundle_extension":
-            await message.answer(
-                f"♻️ <b>VPN успешно продлён!</b>\n"
-                f"🕒 Новый срок: {vpn_data['expires_at_human']}",parse_mode="HTML"
-            )
+    provrq.wake()
+    logger.info("Stars order paid, provisioning queued: %s payment_id=%s", order.id, provider_payment_id)
 
 
 # ===== КРИПТА x Cryptobot
@@ -963,9 +708,9 @@ class CryptoInvoiceRequest(BaseModel):
 @app.post("/api/vpn/crypto-invoice")
 async def create_crypto_invoice(data: CryptoInvoiceRequest):
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == data.tg_id))
-        tariff = await session.get(Tariff, data.tariff_id)
-        active = await get_active_order_for_user(session, user.idUser)
+        ctx = await invrq.load_invoice_context(session, data.tg_id, tariff_id=data.tariff_id)
+        user, tariff = ctx.user, ctx.tariff
+        active = ctx.active
         if active:
             raise HTTPException(status_code=409,
                 detail={"error": "ACTIVE_ORDER_EXISTS","order_id": active.id,"status": active.status,
@@ -1001,19 +746,16 @@ class RenewCryptoInvoiceRequest(BaseModel):
 @app.post("/api/vpn/renew-crypto-invoice")
 async def renew_crypto_invoice(data: RenewCryptoInvoiceRequest):
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == data.tg_id))
+        ctx = await invrq.load_invoice_context(session, data.tg_id, tariff_id=data.tariff_id, subscription_id=data.subscription_id)
+        user, sub, tariff = ctx.user, ctx.sub, ctx.tariff
         if not user:
             raise HTTPException(404, "User not found")
-
-        sub = await session.get(VPNSubscription, data.subscription_id)
         if not sub:
             raise HTTPException(404, "Subscription not found")
-
-        tariff = await session.get(Tariff, data.tariff_id)
         if not tariff or not tariff.is_active:
             raise HTTPException(404, "Tariff not found")
-        
-        active = await get_active_order_for_user(session, user.idUser)
+
+        active = ctx.active
         if active:
             raise HTTPException(status_code=409,
                 detail={"error": "ACTIVE_ORDER_EXISTS","order_id": active.id,"status": active.status,
@@ -1051,28 +793,24 @@ class BundleRenewCryptoInvoiceRequest(BaseModel):
 @app.post("/api/vpn/bundle/crypto-invoice")
 async def bundle_crypto_invoice(data: BundleCryptoInvoiceRequest):
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == data.tg_id))
-        tariff = await session.get(BundleTariff, data.bundle_tariff_id)
-        plan = await session.get(BundlePlan, tariff.bundle_plan_id) if tariff else None
+        ctx = await invrq.load_invoice_context(session, data.tg_id, bundle_tariff_id=data.bundle_tariff_id)
+        user, tariff, plan = ctx.user, ctx.bundle_tariff, ctx.plan
         if not user or not tariff or not tariff.is_active or not plan or not plan.is_active:
             raise HTTPException(404, "Invalid user or bundle tariff")
 
-        active = await get_active_order_for_user(session, user.idUser)
+        active = ctx.active
         if active:
             raise HTTPException(status_code=409,
                 detail={"error": "ACTIVE_ORDER_EXISTS","order_id": active.id,"status": active.status,
                     "expires_at": active.expires_at.isoformat() if active.expires_at else None}
             )
 
-        server_ids = (await session.scalars(
-            select(BundleServer.server_id).where(BundleServer.bundle_plan_id == plan.id)
-        )).all()
-        if not server_ids:
+        if not ctx.first_server_id:
             raise HTTPException(400, "PLAN_HAS_NO_SERVERS")
 
         order = Order(
             idUser=user.idUser,
-            server_id=server_ids[0],
+            server_id=ctx.first_server_id,
             idTarif=None,
             subscription_id=None,
             bundle_plan_id=plan.id,
@@ -1098,35 +836,31 @@ async def bundle_crypto_invoice(data: BundleCryptoInvoiceRequest):
 @app.post("/api/vpn/bundle/renew-crypto-invoice")
 async def bundle_renew_crypto_invoice(data: BundleRenewCryptoInvoiceRequest):
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == data.tg_id))
+        ctx = await invrq.load_invoice_context(session, data.tg_id, bundle_tariff_id=data.bundle_tariff_id,
+            bundle_subscription_id=data.bundle_subscription_id)
+        user, bundle_sub, tariff, plan = ctx.user, ctx.bundle_sub, ctx.bundle_tariff, ctx.plan
         if not user:
             raise HTTPException(404, "User not found")
-        bundle_sub = await session.get(BundleSubscription, data.bundle_subscription_id)
         if not bundle_sub:
             raise HTTPException(404, "Bundle subscription not found")
-        tariff = await session.get(BundleTariff, data.bundle_tariff_id)
-        plan = await session.get(BundlePlan, tariff.bundle_plan_id) if tariff else None
         if not tariff or not tariff.is_active or not plan or not plan.is_active:
             raise HTTPException(404, "Bundle tariff not found")
         if plan.id != bundle_sub.bundle_plan_id:
             raise HTTPException(400, "TARIFF_NOT_ALLOWED_FOR_THIS_BUNDLE")
 
-        active = await get_active_order_for_user(session, user.idUser)
+        active = ctx.active
         if active:
             raise HTTPException(status_code=409,
                 detail={"error": "ACTIVE_ORDER_EXISTS","order_id": active.id,"status": active.status,
                     "expires_at": active.expires_at.isoformat() if active.expires_at else None}
             )
 
-        server_ids = (await session.scalars(
-            select(BundleServer.server_id).where(BundleServer.bundle_plan_id == plan.id)
-        )).all()
-        if not server_ids:
+        if not ctx.first_server_id:
             raise HTTPException(400, "PLAN_HAS_NO_SERVERS")
 
         order = Order(
             idUser=user.idUser,
-            server_id=server_ids[0],
+            server_id=ctx.first_server_id,
             idTarif=None,
             subscription_id=None,
             bundle_subscription_id=bundle_sub.id,
@@ -1185,7 +919,13 @@ async def crypto_webhook(data: dict):
     except:
         return {"ok": True}
 
+    event_key = f"invoice_paid:{invoice_id}"
     async with async_session() as session:
+        event_id = await whrq.begin_event(session, "cryptobot", event_key)
+        if event_id is None:
+            logger.info("Cryptobot webhook replay: %s", invoice_id)
+            return await whrq.replay(session, "cryptobot", event_key)
+
         payment = await session.scalar(select(Payment).where(Payment.provider == "cryptobot",Payment.provider_payment_id == invoice_id))
         if not payment:
             logger.warning("Cryptobot payment not found: %s", invoice_id)
@@ -1208,14 +948,15 @@ async def crypto_webhook(data: dict):
             
             user = await session.get(User, op.idUser)
             await wrq.complete_wallet_deposit(session, op.id)
+            outcome = await whrq.finish_event(session, event_id, {"ok": True, "wallet_operation_id": op.id})
             await session.commit()
             logger.info("Cryptobot wallet completed: op_id=%s payment_id=%s", op.id, invoice_id)
             await bot.send_message(chat_id=user.tg_id,text=("✅ Баланс успешно пополнен!"))
             
-            return {"ok": True}
+            return outcome
         
-        # ПРОДЛЕНИЕ VPN
-        if prefix == "renew":
+        # ПОКУПКА/ПРОДЛЕНИЕ VPN и BUNDLE — выдача в воркере provisioningrequests
+        if prefix in ("buy", "renew", "bundle_buy", "bundle_renew"):
             order = await session.get(Order, entity_id)
             if not order:
                 logger.warning("Cryptobot order not found: %s", entity_id)
@@ -1224,168 +965,12 @@ async def crypto_webhook(data: dict):
                 logger.info("Cryptobot order already handled: %s status=%s", order.id, order.status)
                 return {"ok": True}
 
-            order.status = "processing"
-            tariff = await session.get(Tariff, order.idTarif)
-            server = await session.get(ServersVPN, order.server_id)
-            user = await session.get(User, order.idUser)
-
-            try:
-                vpn_data = await berq.pay_and_extend_vpn(subscription_id=order.subscription_id,tariff_id=order.idTarif)
-            except Exception:
-                order.status = "failed"
-                await session.commit()
-                logger.exception("Cryptobot renew failed: %s", order.id)
-                return {"ok": True}
-
-            order.status = "completed"
-            await rq.process_referral_reward(session, order)
+            await provrq.enqueue_order(session, order)
+            outcome = await whrq.finish_event(session, event_id, {"ok": True, "order_id": order.id})
             await session.commit()
-            logger.info("Cryptobot renew completed: %s payment_id=%s", order.id, invoice_id)
-
-            await bot.send_message(chat_id=user.tg_id,
-                text=(
-                    f"♻️ <b>VPN успешно продлён!</b>\n"
-                    f"➕ Добавлено дней: {vpn_data['days_added']}\n"
-                    f"🕒 Новый срок: {vpn_data['expires_at_human']}"
-                ),parse_mode="HTML"
-            )
-
-            return {"ok": True}
-
-        # ПРОДЛЕНИЕ BUNDLE
-        if prefix == "bundle_renew":
-            order = await session.get(Order, entity_id)
-            if not order:
-                logger.warning("Cryptobot bundle order not found: %s", entity_id)
-                return {"ok": True}
-            if order.status != "pending":
-                logger.info("Cryptobot bundle order already handled: %s status=%s", order.id, order.status)
-                return {"ok": True}
-
-            order.status = "processing"
-            user = await session.get(User, order.idUser)
-            bundle_sub = await session.get(BundleSubscription, order.bundle_subscription_id)
-            bundle_tariff = await session.get(BundleTariff, order.bundle_tariff_id) if order.bundle_tariff_id else None
-            plan = await session.get(BundlePlan, order.bundle_plan_id) if order.bundle_plan_id else None
-            if not plan and bundle_sub:
-                plan = await session.get(BundlePlan, bundle_sub.bundle_plan_id)
-            if not plan:
-                raise Exception("Bundle plan not found")
-            if not bundle_tariff:
-                raise Exception("Bundle tariff not found")
-            tariff_days = bundle_tariff.days
-            server_ids = (await session.scalars(
-                select(BundleServer.server_id).where(BundleServer.bundle_plan_id == plan.id)
-            )).all()
-            servers = (await session.scalars(
-                select(ServersVPN).where(ServersVPN.idServerVPN.in_(server_ids))
-            )).all()
-            try:
-                await berq.extend_bundle_subscription(session, bundle_sub, plan, servers, tariff_days)
-            except Exception:
-                order.status = "failed"
-                await session.commit()
-                logger.exception("Cryptobot bundle renew failed: %s", order.id)
-                return {"ok": True}
-
-            order.status = "completed"
-            await session.commit()
-            logger.info("Cryptobot bundle renew completed: %s payment_id=%s", order.id, invoice_id)
-            await bot.send_message(chat_id=user.tg_id,
-                text=(
-                    f"♻️ <b>VPN успешно продлён!</b>\n"
-                    f"🕒 Новый срок: {rq.format_datetime_ru(bundle_sub.expires_at)}"
-                ),parse_mode="HTML"
-            )
-            return {"ok": True}
-
-        # ПОКУПКА VPN
-        if prefix == "buy":
-            order = await session.get(Order, entity_id)
-            if not order:
-                logger.warning("Cryptobot order not found: %s", entity_id)
-                return {"ok": True}
-            if order.status != "pending":
-                logger.info("Cryptobot order already handled: %s status=%s", order.id, order.status)
-                return {"ok": True}
-
-            order.status = "processing"
-
-            tariff = await session.get(Tariff, order.idTarif)
-            server = await session.get(ServersVPN, order.server_id)
-            user = await session.get(User, order.idUser)
-
-            try:
-                vpn_data = await berq.create_vpn_xui(order.idUser, order.server_id, tariff.days)
-            except Exception:
-                order.status = "failed"
-                await session.commit()
-                logger.exception("Cryptobot buy failed: %s", order.id)
-                return {"ok": True}
-
-            order.status = "completed"
-            await rq.process_referral_reward(session, order)
-            await session.commit()
-            logger.info("Cryptobot buy completed: %s payment_id=%s", order.id, invoice_id)
-
-            await bot.send_message(chat_id=user.tg_id,
-                text=(
-                    f"✅ <b>VPN готов!</b>\n"
-                    f"Сервер: {server.nameVPN}\n"
-                    f"Действует до: {vpn_data['expires_at_human']}\n\n"
-                    f"<b>Ваша подписка:</b>\n"
-                    f"<code>{vpn_data['subscription_url']}</code>"
-                ),parse_mode="HTML"
-            )
-
-        # ПОКУПКА BUNDLE
-        if prefix == "bundle_buy":
-            order = await session.get(Order, entity_id)
-            if not order:
-                logger.warning("Cryptobot bundle order not found: %s", entity_id)
-                return {"ok": True}
-            if order.status != "pending":
-                logger.info("Cryptobot bundle order already handled: %s status=%s", order.id, order.status)
-                return {"ok": True}
-
-            order.status = "processing"
-            user = await session.get(User, order.idUser)
-            bundle_tariff = await session.get(BundleTariff, order.bundle_tariff_id) if order.bundle_tariff_id else None
-            plan = await session.get(BundlePlan, order.bundle_plan_id) if order.bundle_plan_id else None
-            if not plan and bundle_tariff:
-                plan = await session.get(BundlePlan, bundle_tariff.bundle_plan_id)
-            if not plan:
-                raise Exception("Bundle plan not found")
-            if not bundle_tariff:
-                raise Exception("Bundle tariff not found")
-            tariff_days = bundle_tariff.days
-            server_ids = (await session.scalars(
-                select(BundleServer.server_id).where(BundleServer.bundle_plan_id == plan.id)
-            )).all()
-            servers = (await session.scalars(
-                select(ServersVPN).where(ServersVPN.idServerVPN.in_(server_ids))
-            )).all()
-            try:
-                bundle_sub = await berq.create_bundle_subscription(session, user.idUser, plan, servers, tariff_days)
-                order.bundle_subscription_id = bundle_sub.id
-            except Exception:
-                order.status = "failed"
-                await session.commit()
-                logger.exception("Cryptobot bundle buy failed: %s", order.id)
-                return {"ok": True}
-
-            order.status = "completed"
-            await session.commit()
-            logger.info("Cryptobot bundle buy completed: %s payment_id=%s", order.id, invoice_id)
-            await bot.send_message(chat_id=user.tg_id,
-                text=(
-                    f"✅ <b>VPN готов!</b>\n"
-                    f"План: Все сервера\n"
-                    f"Действует до: {rq.format_datetime_ru(bundle_sub.expires_at)}\n\n"
-                    f"<b>Ваша подписка:</b>\n"
-                    f"<code>{bundle_sub.subscription_url}</code>"
-                ),parse_mode="HTML"
-            )
+            provrq.wake()
+            logger.info("Cryptobot order paid, provisioning queued: %s payment_id=%s", order.id, invoice_id)
+            return outcome
 
     return {"ok": True}
 
@@ -1399,24 +984,21 @@ class YooKassaInvoiceRequest(BaseModel):
 @app.post("/api/vpn/yookassa-invoice")
 async def create_yookassa_invoice(data: YooKassaInvoiceRequest):
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == data.tg_id))
-        tariff = await session.get(Tariff, data.tariff_id)
-
+        ctx = await invrq.load_invoice_context(session, data.tg_id, tariff_id=data.tariff_id, rate_pair="RUB_USDT")
+        user, tariff = ctx.user, ctx.tariff
         if not user or not tariff or not tariff.is_active:
             raise HTTPException(404, "Invalid user or tariff")
-
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "RUB_USDT"))
-        if not rate:
+        if not ctx.rate:
             raise HTTPException(500, "RUB rate not set")
-        
-        active = await get_active_order_for_user(session, user.idUser)
+
+        active = ctx.active
         if active:
             raise HTTPException(status_code=409,
                 detail={"error": "ACTIVE_ORDER_EXISTS","order_id": active.id,"status": active.status,
                     "expires_at": active.expires_at.isoformat() if active.expires_at else None}
             )
 
-        price_rub = Decimal(tariff.price_tarif) * Decimal(rate.rate)
+        price_rub = ctx.rub_price()
 
         order = Order(idUser=user.idUser,server_id=tariff.server_id,idTarif=tariff.idTarif,purpose_order="buy",
             amount=Decimal(tariff.price_tarif),currency="USDT",provider="yookassa",status="pending",
@@ -1444,30 +1026,23 @@ class RenewYooKassaInvoiceRequest(BaseModel):
 @app.post("/api/vpn/renew-yookassa-invoice")
 async def renew_yookassa_invoice(data: RenewYooKassaInvoiceRequest):
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == data.tg_id))
-        sub = await session.get(VPNSubscription, data.subscription_id)
-        tariff = await session.get(Tariff, data.tariff_id)
-
+        ctx = await invrq.load_invoice_context(session, data.tg_id, tariff_id=data.tariff_id,
+            subscription_id=data.subscription_id, rate_pair="RUB_USDT")
+        user, sub, tariff = ctx.user, ctx.sub, ctx.tariff
         if not user or not sub or not tariff or not tariff.is_active:
             raise HTTPException(404, "Invalid data")
 
-        active = await get_active_order_for_user(session, user.idUser)
+        active = ctx.active
         if active:
-            raise HTTPException(
-                status_code=409,
-                detail={
-                    "error": "ACTIVE_ORDER_EXISTS",
-                    "order_id": active.id,
-                    "status": active.status,
-                    "expires_at": active.expires_at.isoformat() if active.expires_at else None
-                }
+            raise HTTPException(status_code=409,
+                detail={"error": "ACTIVE_ORDER_EXISTS","order_id": active.id,"status": active.status,
+                    "expires_at": active.expires_at.isoformat() if active.expires_at else None}
             )
 
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "RUB_USDT"))
-        if not rate:
+        if not ctx.rate:
             raise HTTPException(500, "RUB rate not set")
 
-        price_rub = Decimal(tariff.price_tarif) * Decimal(rate.rate)
+        price_rub = ctx.rub_price()
 
         order = Order(idUser=user.idUser,server_id=sub.idServerVPN,idTarif=tariff.idTarif,
             subscription_id=sub.id,
@@ -1506,33 +1081,28 @@ class BundleRenewYooKassaInvoiceRequest(BaseModel):
 @app.post("/api/vpn/bundle/yookassa-invoice")
 async def bundle_yookassa_invoice(data: BundleYooKassaInvoiceRequest):
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == data.tg_id))
-        tariff = await session.get(BundleTariff, data.bundle_tariff_id)
-        plan = await session.get(BundlePlan, tariff.bundle_plan_id) if tariff else None
+        ctx = await invrq.load_invoice_context(session, data.tg_id, bundle_tariff_id=data.bundle_tariff_id, rate_pair="RUB_USDT")
+        user, tariff, plan = ctx.user, ctx.bundle_tariff, ctx.plan
         if not user or not tariff or not tariff.is_active or not plan or not plan.is_active:
             raise HTTPException(404, "Invalid user or tariff")
 
-        active = await get_active_order_for_user(session, user.idUser)
+        active = ctx.active
         if active:
             raise HTTPException(status_code=409,
                 detail={"error": "ACTIVE_ORDER_EXISTS","order_id": active.id,"status": active.status,
                     "expires_at": active.expires_at.isoformat() if active.expires_at else None}
             )
 
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "RUB_USDT"))
-        if not rate:
+        if not ctx.rate:
             raise HTTPException(500, "RUB rate not set")
-
-        server_ids = (await session.scalars(
-            select(BundleServer.server_id).where(BundleServer.bundle_plan_id == plan.id)
-        )).all()
-        if not server_ids:
+        if not ctx.first_server_id:
             raise HTTPException(400, "PLAN_HAS_NO_SERVERS")
 
-        price_rub = Decimal(tariff.price_usdt) * Decimal(rate.rate)
+        price_rub = ctx.rub_price()
+
         order = Order(
             idUser=user.idUser,
-            server_id=server_ids[0],
+            server_id=ctx.first_server_id,
             idTarif=None,
             subscription_id=None,
             bundle_plan_id=plan.id,
@@ -1562,44 +1132,33 @@ async def bundle_yookassa_invoice(data: BundleYooKassaInvoiceRequest):
 @app.post("/api/vpn/bundle/renew-yookassa-invoice")
 async def bundle_renew_yookassa_invoice(data: BundleRenewYooKassaInvoiceRequest):
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == data.tg_id))
-        bundle_sub = await session.get(BundleSubscription, data.bundle_subscription_id)
+        ctx = await invrq.load_invoice_context(session, data.tg_id, bundle_tariff_id=data.bundle_tariff_id,
+            bundle_subscription_id=data.bundle_subscription_id, rate_pair="RUB_USDT")
+        user, bundle_sub, tariff, plan = ctx.user, ctx.bundle_sub, ctx.bundle_tariff, ctx.plan
         if not user or not bundle_sub:
             raise HTTPException(404, "Invalid data")
-
-        tariff = await session.get(BundleTariff, data.bundle_tariff_id)
-        plan = await session.get(BundlePlan, tariff.bundle_plan_id) if tariff else None
         if not tariff or not tariff.is_active or not plan or not plan.is_active:
             raise HTTPException(404, "Bundle tariff not found")
         if plan.id != bundle_sub.bundle_plan_id:
             raise HTTPException(400, "TARIFF_NOT_ALLOWED_FOR_THIS_BUNDLE")
 
-        active = await get_active_order_for_user(session, user.idUser)
+        active = ctx.active
         if active:
-            raise HTTPException(
-                status_code=409,
-                detail={
-                    "error": "ACTIVE_ORDER_EXISTS",
-                    "order_id": active.id,
-                    "status": active.status,
-                    "expires_at": active.expires_at.isoformat() if active.expires_at else None
-                }
+            raise HTTPException(status_code=409,
+                detail={"error": "ACTIVE_ORDER_EXISTS","order_id": active.id,"status": active.status,
+                    "expires_at": active.expires_at.isoformat() if active.expires_at else None}
             )
 
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "RUB_USDT"))
-        if not rate:
+        if not ctx.rate:
             raise HTTPException(500, "RUB rate not set")
-
-        server_ids = (await session.scalars(
-            select(BundleServer.server_id).where(BundleServer.bundle_plan_id == plan.id)
-        )).all()
-        if not server_ids:
+        if not ctx.first_server_id:
             raise HTTPException(400, "PLAN_HAS_NO_SERVERS")
 
-        price_rub = Decimal(tariff.price_usdt) * Decimal(rate.rate)
+        price_rub = ctx.rub_price()
+
         order = Order(
             idUser=user.idUser,
-            server_id=server_ids[0],
+            server_id=ctx.first_server_id,
             idTarif=None,
             subscription_id=None,
             bundle_subscription_id=bundle_sub.id,
@@ -1646,7 +1205,13 @@ async def yookassa_webhook(request: Request):
     except (TypeError, ValueError):
         return {"ok": True}
 
+    event_key = f"{notification.event}:{payment_obj.id}"
     async with async_session() as session:
+        event_id = await whrq.begin_event(session, "yookassa", event_key)
+        if event_id is None:
+            logger.info("YooKassa webhook replay: %s", payment_obj.id)
+            return await whrq.replay(session, "yookassa", event_key)
+
         if purpose == "wallet":
             op = await session.get(WalletOperation, order_id)
             if not op:
@@ -1662,11 +1227,12 @@ async def yookassa_webhook(request: Request):
 
             user = await session.get(User, op.idUser)
             await wrq.complete_wallet_deposit(session, op.id)
+            outcome = await whrq.finish_event(session, event_id, {"ok": True, "wallet_operation_id": op.id})
             await session.commit()
 
             logger.info("YooKassa wallet completed: op_id=%s payment_id=%s", op.id, payment_obj.id)
             await bot.send_message(chat_id=user.tg_id,text=("✅ Баланс успешно пополнен!"))
-            return {"ok": True}
+            return outcome
 
         order = await session.get(Order, order_id)
         if not order:
@@ -1676,107 +1242,17 @@ async def yookassa_webhook(request: Request):
             logger.info("YooKassa order already handled: %s status=%s", order.id, order.status)
             return {"ok": True}
 
-        order.status = "processing"
-
         payment = await session.scalar(select(Payment).where(Payment.provider == "yookassa").where(Payment.provider_payment_id == payment_obj.id))
         if payment:
             payment.status = "paid"
 
-        user = await session.get(User, order.idUser)
-        tariff = await session.get(Tariff, order.idTarif) if order.idTarif else None
-        server = await session.get(ServersVPN, order.server_id) if order.server_id else None
-        bundle_tariff = await session.get(BundleTariff, order.bundle_tariff_id) if order.bundle_tariff_id else None
-
-        try:
-            if order.purpose_order == "buy":
-                vpn_data = await berq.create_vpn_xui(user_id=user.idUser,server_id=order.server_id,tariff_days=tariff.days)
-
-                order.subscription_id = vpn_data["subscription_id"]
-
-                await bot.send_message(chat_id=user.tg_id,
-                    text=(
-                        f"✅ <b>VPN готов!</b>\n"
-                        f"Сервер: {server.nameVPN}\n"
-                        f"Действует до: {vpn_data['expires_at_human']}\n\n"
-                        f"<b>Ваша подписка:</b>\n"
-                        f"<code>{vpn_data['subscription_url']}</code>"
-                    ),parse_mode="HTML"
-                )
-
-            elif order.purpose_order == "extension":
-                vpn_data = await berq.pay_and_extend_vpn(subscription_id=order.subscription_id,tariff_id=order.idTarif)
-
-                await bot.send_message(chat_id=user.tg_id,
-                    text=(
-                        f"♻️ <b>VPN успешно продлён!</b>\n"
-                        f"➕ Добавлено дней: {vpn_data['days_added']}\n"
-                        f"🕒 Новый срок: {vpn_data['expires_at_human']}"
-                    ),parse_mode="HTML"
-                )
-
-            elif order.purpose_order == "bundle_buy":
-                plan = await session.get(BundlePlan, order.bundle_plan_id) if order.bundle_plan_id else None
-                if not plan and bundle_tariff:
-                    plan = await session.get(BundlePlan, bundle_tariff.bundle_plan_id)
-                if not plan:
-                    raise Exception("Bundle plan not found")
-                if not bundle_tariff:
-                    raise Exception("Bundle tariff not found")
-                tariff_days = bundle_tariff.days
-                server_ids = (await session.scalars(
-                    select(BundleServer.server_id).where(BundleServer.bundle_plan_id == plan.id)
-                )).all()
-                servers = (await session.scalars(
-                    select(ServersVPN).where(ServersVPN.idServerVPN.in_(server_ids))
-                )).all()
-                bundle_sub = await berq.create_bundle_subscription(session, user.idUser, plan, servers, tariff_days)
-                order.bundle_subscription_id = bundle_sub.id
-                await bot.send_message(chat_id=user.tg_id,
-                    text=(
-                        f"✅ <b>VPN готов!</b>\n"
-                        f"План: Все сервера\n"
-                        f"Действует до: {rq.format_datetime_ru(bundle_sub.expires_at)}\n\n"
-                        f"<b>Ваша подписка:</b>\n"
-                        f"<code>{bundle_sub.subscription_url}</code>"
-                    ),parse_mode="HTML"
-                )
-
-            elif order.purpose_order == "bundle_extension":
-                bundle_sub = await session.get(BundleSubscription, order.bundle_subscription_id)
-                plan = await session.get(BundlePlan, bundle_sub.bundle_plan_id) if bundle_sub else None
-                if not plan and bundle_tariff:
-                    plan = await session.get(BundlePlan, bundle_tariff.bundle_plan_id)
-                if not plan:
-                    raise Exception("Bundle plan not found")
-                if not bundle_tariff:
-                    raise Exception("Bundle tariff not found")
-                tariff_days = bundle_tariff.days
-                server_ids = (await session.scalars(
-                    select(BundleServer.server_id).where(BundleServer.bundle_plan_id == plan.id)
-                )).all()
-                servers = (await session.scalars(
-                    select(ServersVPN).where(ServersVPN.idServerVPN.in_(server_ids))
-                )).all()
-                await berq.extend_bundle_subscription(session, bundle_sub, plan, servers, tariff_days)
-                await bot.send_message(chat_id=user.tg_id,
-                    text=(
-                        f"♻️ <b>VPN успешно продлён!</b>\n"
-                        f"🕒 Новый срок: {rq.format_datetime_ru(bundle_sub.expires_at)}"
-                    ),parse_mode="HTML"
-                )
-
-            order.status = "completed"
-            await rq.process_referral_reward(session, order)
-            await session.commit()
-            logger.info("YooKassa order completed: %s payment_id=%s", order.id, payment_obj.id)
-            return {"ok": True}
-
-        except Exception as e:
-            order.status = "failed"
-            await session.commit()
-            logger.exception("YooKassa webhook error: %s order=%s", e, order.id)
-            return {"ok": True}
+        await provrq.enqueue_order(session, order)
+        outcome = await whrq.finish_event(session, event_id, {"ok": True, "order_id": order.id})
+        await session.commit()
 
+    provrq.wake()
+    logger.info("YooKassa order paid, provisioning queued: %s payment_id=%s", order.id, payment_obj.id)
+    return outcome
 
 
 
@@ -1911,18 +1387,18 @@ async def get_wallet_operation_status(operation_id: int):
 
 @app.get("/api/rate/xtr")
 async def get_xtr_rate():
-    async with async_session() as session:
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "XTR_USDT"))
-        if not rate:
-            raise HTTPException(404, "Rate not set")
-        return {"rate": str(rate.rate)}
+    rate = await pricerq.get_rate("XTR_USDT")
+    if not rate:
+        raise HTTPException(404, "Rate not set")
+    return {"rate": str(rate)}
 
 
 @app.get("/api/rate/rub")
 async def get_rub_rate():
-    async with async_session() as session:
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "RUB_USDT"))
-        return {"rate": str(rate.rate)}
+    rate = await pricerq.get_rate("RUB_USDT")
+    if not rate:
+        raise HTTPException(404, "Rate not set")
+    return {"rate": str(rate)}
 
 
 # ======================
@@ -2364,6 +1840,36 @@ async def admin_update_server(server_id: int, data: ServerCreate):
 async def admin_delete_server(server_id: int):
     return await rqadm.admin_delete_server(server_id)
 
+@app.get("/api/admin/panel-health")
+async def admin_panel_health():
+    return panel_health.health_snapshot()
+
+@app.get("/api/admin/panel-metrics")
+async def admin_panel_metrics():
+    return panel_metrics.metrics_snapshot()
+
+@app.get("/api/admin/reconcile")
+async def admin_reconcile_report():
+    return recrq.last_report or {}
+
+@app.post("/api/admin/reconcile")
+async def admin_reconcile_run(repair: bool = False):
+    return await recrq.reconcile_all(repair=repair)
+
+@app.get("/api/admin/provisioning-jobs")
+async def admin_provisioning_jobs(status: str | None = None, limit: int = 100):
+    return await provrq.list_jobs(status, limit)
+
+@app.post("/api/admin/provisioning-jobs/{job_id}/retry")
+async def admin_provisioning_retry(job_id: int):
+    try:
+        return await provrq.retry_job(job_id)
+    except ValueError as e:
+        msg = str(e)
+        if msg == "JOB_NOT_FOUND":
+            raise HTTPException(404, "Job not found")
+        raise HTTPException(400, msg)
+
 @app.get("/api/vpn/servers-full")
 async def get_servers_full():
     return await rq.get_servers_full()
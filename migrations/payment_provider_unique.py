@@ -0,0 +1,48 @@
+"""
+Migration: unique (provider, provider_payment_id) on payments.
+Run once: python -m migrations.payment_provider_unique
+Aborts if duplicates exist — resolve them by hand first (the query prints them).
+"""
+import asyncio
+import os
+import sys
+
+# Add parent dir for imports
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+load_dotenv()
+
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = os.getenv("DB_PORT")
+DB_NAME = os.getenv("DB_NAME")
+DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+
+async def run():
+    engine = create_async_engine(DATABASE_URL)
+    async with engine.begin() as conn:
+        dupes = (await conn.execute(text(
+            "SELECT provider, provider_payment_id, array_agg(id ORDER BY id) FROM payments "
+            "GROUP BY provider, provider_payment_id HAVING count(*) > 1"))).all()
+        if dupes:
+            for provider, provider_payment_id, ids in dupes:
+                print(f"Duplicate payment {provider}:{provider_payment_id} ids={ids}")
+            print("Migration aborted: remove duplicate payments first")
+            await engine.dispose()
+            return
+
+        await conn.execute(text("DROP INDEX IF EXISTS idx_payment_provider_id"))
+        await conn.execute(text(
+            "ALTER TABLE payments ADD CONSTRAINT uq_payment_provider_id UNIQUE (provider, provider_payment_id)"))
+    print("Migration complete: payments (provider, provider_payment_id) is unique")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,36 @@
+"""
+Migration: lease owner and step progress on provisioning_jobs.
+Run once: python -m migrations.provisioning_job_lease
+"""
+import asyncio
+import os
+import sys
+
+# Add parent dir for imports
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+load_dotenv()
+
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = os.getenv("DB_PORT")
+DB_NAME = os.getenv("DB_NAME")
+DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+
+async def run():
+    engine = create_async_engine(DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.execute(text("ALTER TABLE provisioning_jobs ADD COLUMN IF NOT EXISTS locked_by VARCHAR(64)"))
+        await conn.execute(text("ALTER TABLE provisioning_jobs ADD COLUMN IF NOT EXISTS progress JSON"))
+    print("Migration complete: provisioning_jobs.locked_by, provisioning_jobs.progress")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
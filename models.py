@@ -3,7 +3,7 @@ from sqlalchemy.orm import (Mapped, DeclarativeBase, mapped_column)
 from sqlalchemy.ext.asyncio import (AsyncAttrs, async_sessionmaker, create_async_engine)
 from datetime import datetime
 from decimal import Decimal
-from sqlalchemy import Column, Integer, ForeignKey, Numeric, Boolean, UniqueConstraint, Index, text
+from sqlalchemy import Column, Integer, ForeignKey, Numeric, Boolean, UniqueConstraint, Index, text, JSON
 from sqlalchemy.orm import relationship
 from dotenv import load_dotenv
 import os
@@ -209,7 +209,7 @@ class Order(Base):
     currency: Mapped[str] = mapped_column(String(100))  # XTR / USDT
     provider: Mapped[str] = mapped_column(String(50), default="unknown")  # stars / cryptobot / yookassa / balance
     payment_url: Mapped[str | None] = mapped_column(String(500), nullable=True)
-    status: Mapped[str] = mapped_column(String(50), default="pending")  # pending / paid / failed
+    status: Mapped[str] = mapped_column(String(50), default="pending")  # pending / paid / processing / completed / failed
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
     expires_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
     
@@ -230,7 +230,7 @@ class Payment(Base):
     status: Mapped[str] = mapped_column(String(50))
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
     __table_args__ = (
-        Index("idx_payment_provider_id", "provider", "provider_payment_id"),
+        UniqueConstraint("provider", "provider_payment_id", name="uq_payment_provider_id"),
     )
     
     wallet_operation = relationship("WalletOperation", back_populates="payments")
@@ -322,6 +322,51 @@ class BundleSubscriptionItem(Base):
     )
 
 
+class ClientEmailSequence(Base):
+    # последний номер в email клиента "{страна} - {idUser},N" на сервере
+    __tablename__ = "client_email_sequences"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    idUser: Mapped[int] = mapped_column(ForeignKey("users.idUser", ondelete="CASCADE"))
+    server_id: Mapped[int] = mapped_column(ForeignKey("servers_vpn.idServerVPN", ondelete="CASCADE"))
+    kind: Mapped[str] = mapped_column(String(20))  # single / bundle
+    last_num: Mapped[int] = mapped_column(Integer, default=0)
+    __table_args__ = (
+        UniqueConstraint("idUser", "server_id", "kind", name="uq_client_email_seq"),
+    )
+
+
+class ProvisioningJob(Base):
+    # outbox: выдача/продление VPN по оплаченному заказу, выполняет воркер provisioningrequests
+    __tablename__ = "provisioning_jobs"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    order_id: Mapped[int] = mapped_column(ForeignKey("orders.id", ondelete="CASCADE"), unique=True)
+    status: Mapped[str] = mapped_column(String(20), default="pending")  # pending / running / done / dead
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    last_error: Mapped[str | None] = mapped_column(String(1000), nullable=True)
+    next_run_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
+    locked_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)  # последний heartbeat
+    locked_by: Mapped[str | None] = mapped_column(String(64), nullable=True)  # аренда воркера, выдаётся при захвате
+    progress: Mapped[dict | None] = mapped_column(JSON, nullable=True)  # сделанные шаги — повтор их не дублирует
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    __table_args__ = (
+        Index("idx_provisioning_jobs_status_next", "status", "next_run_at"),
+    )
+
+
+class WebhookEvent(Base):
+    # журнал идемпотентности вебхуков: одно событие провайдера — одна строка
+    __tablename__ = "webhook_events"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    provider: Mapped[str] = mapped_column(String(50))  # telegram_stars / cryptobot / yookassa
+    event_key: Mapped[str] = mapped_column(String(200))
+    outcome: Mapped[dict | None] = mapped_column(JSON, nullable=True)  # ответ, который отдаём на повторные доставки
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
+    __table_args__ = (
+        UniqueConstraint("provider", "event_key", name="uq_webhook_event"),
+    )
+
+
 # --- REFERALS ---
 class ReferralConfig(Base):
     __tablename__ = "referral_config"
@@ -0,0 +1,124 @@
+import os
+import time
+from collections import deque
+
+
+# окно последних вызовов, по которому считаем долю ошибок
+PANEL_CB_WINDOW = int(os.getenv("PANEL_CB_WINDOW", "20"))
+PANEL_CB_MIN_CALLS = int(os.getenv("PANEL_CB_MIN_CALLS", "5"))
+PANEL_CB_ERROR_RATE = float(os.getenv("PANEL_CB_ERROR_RATE", "0.5"))
+# успешный, но слишком долгий ответ считаем ошибкой
+PANEL_CB_SLOW_SEC = float(os.getenv("PANEL_CB_SLOW_SEC", "8"))
+# сколько держим цепь открытой до пробного запроса
+PANEL_CB_OPEN_SEC = float(os.getenv("PANEL_CB_OPEN_SEC", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class PanelUnavailable(Exception):
+    """цепь панели открыта — не ждём таймаутов, сразу отказываем"""
+
+
+class PanelHealth:
+    """circuit breaker одной панели (одного ServersVPN)"""
+
+    def __init__(self, server_id: int):
+        self.server_id = server_id
+        self.state = CLOSED
+        self.samples: deque[tuple[bool, float]] = deque(maxlen=PANEL_CB_WINDOW)
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.last_error: str | None = None
+        self.last_ok_at: float | None = None
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < PANEL_CB_OPEN_SEC:
+                return False
+            self.state = HALF_OPEN
+            self.trial_in_flight = False
+        # half-open: пропускаем ровно один пробный запрос
+        if self.trial_in_flight:
+            return False
+        self.trial_in_flight = True
+        return True
+
+    def record(self, ok: bool, latency: float, error: str | None = None):
+        good = ok and latency <= PANEL_CB_SLOW_SEC
+        if ok:
+            self.last_ok_at = time.time()
+        if not good:
+            self.last_error = error or f"slow: {latency:.2f}s"
+
+        if self.state == HALF_OPEN:
+            self.trial_in_flight = False
+            if good:
+                self.state = CLOSED
+                self.samples.clear()
+            else:
+                self._open()
+            return
+
+        self.samples.append((good, latency))
+        if self.state == CLOSED and len(self.samples) >= PANEL_CB_MIN_CALLS and self.error_rate() >= PANEL_CB_ERROR_RATE:
+            self._open()
+
+    def release(self):
+        """вызов отменён (таймаут/отключение клиента) — ни успех, ни ошибка; освобождаем пробный слот"""
+        if self.state == HALF_OPEN:
+            self.trial_in_flight = False
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for good, _ in self.samples if not good) / len(self.samples)
+
+    def is_healthy(self) -> bool:
+        return self.state == CLOSED
+
+    def probe_due(self) -> bool:
+        return self.state == OPEN and time.monotonic() - self.opened_at >= PANEL_CB_OPEN_SEC
+
+    def snapshot(self) -> dict:
+        latencies = sorted(l for _, l in self.samples)
+        return {
+            "server_id": self.server_id,
+            "state": self.state,
+            "error_rate": round(self.error_rate(), 3),
+            "calls": len(self.samples),
+            "latency_p50": round(latencies[len(latencies) // 2], 3) if latencies else None,
+            "latency_max": round(latencies[-1], 3) if latencies else None,
+            "last_error": self.last_error,
+            "last_ok_at": self.last_ok_at,
+        }
+
+
+_registry: dict[int, PanelHealth] = {}
+
+
+def get_health(server_id: int) -> PanelHealth:
+    health = _registry.get(server_id)
+    if not health:
+        health = _registry[server_id] = PanelHealth(server_id)
+    return health
+
+
+def is_healthy(server_id: int) -> bool:
+    health = _registry.get(server_id)
+    return health.is_healthy() if health else True
+
+
+def due_for_probe() -> list[int]:
+    return [sid for sid, h in _registry.items() if h.probe_due()]
+
+
+def health_snapshot() -> list[dict]:
+    return [h.snapshot() for h in _registry.values()]
@@ -0,0 +1,105 @@
+import logging
+import time
+from bisect import bisect_left
+
+
+logger = logging.getLogger("panel_metrics")
+
+# верхние границы корзин гистограммы задержек, секунды (последняя — всё остальное)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# выше этого пишем вызов в лог с уровнем WARNING
+SLOW_CALL_SEC = 2.0
+
+
+class OpStats:
+    """счётчики одной операции одной панели"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.relogins = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.max_response_bytes = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def quantile(self, q: float) -> float | None:
+        """оценка квантиля по корзинам (верхняя граница корзины)"""
+        if not self.calls:
+            return None
+        rank = q * self.calls
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+        return float("inf")
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "relogins": self.relogins,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "max_response_bytes": self.max_response_bytes,
+            "latency_avg": round(self.latency_sum / self.calls, 4) if self.calls else None,
+            "latency_p50": self.quantile(0.5),
+            "latency_p95": self.quantile(0.95),
+            "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["inf"], self.buckets)),
+        }
+
+
+_stats: dict[tuple[str, str], OpStats] = {}
+_started_at = time.time()
+
+
+def _get(server: str, op: str) -> OpStats:
+    key = (server, op)
+    stats = _stats.get(key)
+    if not stats:
+        stats = _stats[key] = OpStats()
+    return stats
+
+
+def record_call(server: str, op: str, latency: float, ok: bool, error: str | None = None):
+    stats = _get(server, op)
+    stats.calls += 1
+    stats.latency_sum += latency
+    stats.buckets[bisect_left(LATENCY_BUCKETS, latency)] += 1
+    if not ok:
+        stats.errors += 1
+
+    level = logging.WARNING if not ok or latency >= SLOW_CALL_SEC else logging.DEBUG
+    logger.log(level, "xui_call server=%s op=%s ok=%s latency_ms=%d error=%s",
+        server, op, ok, latency * 1000, error or "")
+
+
+def record_bytes(server: str, op: str, sent: int, received: int):
+    stats = _get(server, op)
+    stats.bytes_sent += sent
+    stats.bytes_received += received
+    stats.max_response_bytes = max(stats.max_response_bytes, received)
+
+
+def record_retry(server: str, op: str, kind: str = "connect"):
+    stats = _get(server, op)
+    if kind == "relogin":
+        stats.relogins += 1
+    else:
+        stats.retries += 1
+    logger.info("xui_retry server=%s op=%s kind=%s", server, op, kind)
+
+
+def metrics_snapshot() -> dict:
+    servers: dict[str, dict] = {}
+    for (server, op), stats in _stats.items():
+        servers.setdefault(server, {})[op] = stats.as_dict()
+    return {"since": _started_at, "servers": servers}
+
+
+def reset_metrics():
+    _stats.clear()
@@ -0,0 +1,89 @@
+import os
+import time
+import asyncio
+from decimal import Decimal
+
+from sqlalchemy import select
+
+from models import async_session, ExchangeRate, Tariff, BundleTariff
+
+
+# страховка на случай изменений из другого процесса; в своём процессе сбрасываем явно через invalidate()
+PRICING_CACHE_TTL = float(os.getenv("PRICING_CACHE_TTL", "300"))
+
+
+def stars_from_usdt(amount_usdt: Decimal, rate: Decimal) -> int:
+    """цена в Stars: как везде в инвойсах — вниз до целого, минимум 1"""
+    return max(int(Decimal(amount_usdt) / Decimal(rate)), 1)
+
+
+class TariffPrice:
+    def __init__(self, usdt: Decimal, xtr_rate: Decimal | None, rub_rate: Decimal | None):
+        self.usdt = Decimal(usdt)
+        # без курса витрина исторически считала по 1:1
+        self.stars = stars_from_usdt(self.usdt, xtr_rate or Decimal("1"))
+        self.rub = self.usdt * rub_rate if rub_rate else None
+
+
+class PriceMatrix:
+    """курсы + цены всех тарифов и bundle-тарифов в USDT / Stars / RUB"""
+
+    def __init__(self, rates: dict[str, Decimal], tariffs: list, bundle_tariffs: list):
+        self.rates = rates
+        xtr, rub = rates.get("XTR_USDT"), rates.get("RUB_USDT")
+        self.tariffs = {t.idTarif: TariffPrice(t.price_tarif, xtr, rub) for t in tariffs}
+        self.bundle_tariffs = {t.id: TariffPrice(t.price_usdt, xtr, rub) for t in bundle_tariffs}
+        self.built_at = time.monotonic()
+
+    def tariff(self, tariff_id: int) -> TariffPrice | None:
+        return self.tariffs.get(tariff_id)
+
+    def bundle_tariff(self, tariff_id: int) -> TariffPrice | None:
+        return self.bundle_tariffs.get(tariff_id)
+
+    def _stars(self, price: TariffPrice | None, usdt) -> int:
+        # строка из БД новее матрицы (правка из другого процесса) — считаем на лету
+        if price and price.usdt == Decimal(usdt):
+            return price.stars
+        return stars_from_usdt(usdt, self.rates.get("XTR_USDT") or Decimal("1"))
+
+    def tariff_stars(self, tariff) -> int:
+        return self._stars(self.tariffs.get(tariff.idTarif), tariff.price_tarif)
+
+    def bundle_tariff_stars(self, tariff) -> int:
+        return self._stars(self.bundle_tariffs.get(tariff.id), tariff.price_usdt)
+
+
+_matrix: PriceMatrix | None = None
+_generation = 0  # растёт на каждом invalidate(): сборку, начатую до сброса, не кэшируем
+_lock = asyncio.Lock()
+
+
+async def price_matrix() -> PriceMatrix:
+    global _matrix
+    matrix = _matrix
+    if matrix and time.monotonic() - matrix.built_at < PRICING_CACHE_TTL:
+        return matrix
+    async with _lock:
+        if _matrix is not matrix and _matrix is not None:  # пока ждали — мог пересобрать другой запрос
+            return _matrix
+        generation = _generation
+        async with async_session() as session:
+            rates = {r.pair: Decimal(r.rate) for r in await session.scalars(select(ExchangeRate))}
+            tariffs = (await session.scalars(select(Tariff))).all()
+            bundle_tariffs = (await session.scalars(select(BundleTariff))).all()
+        built = PriceMatrix(rates, tariffs, bundle_tariffs)
+        if generation == _generation:
+            _matrix = built
+        return built
+
+
+async def get_rate(pair: str) -> Decimal | None:
+    return (await price_matrix()).rates.get(pair)
+
+
+def invalidate():
+    """курс или тарифы поменялись — пересоберём при следующем чтении"""
+    global _matrix, _generation
+    _generation += 1
+    _matrix = None
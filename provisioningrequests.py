@@ -0,0 +1,344 @@
+import os
+import asyncio
+import logging
+import uuid as uuid_lib
+from datetime import datetime, timezone, timedelta
+
+from sqlalchemy import select, update, or_, and_
+
+from models import (async_session, Order, User, Tariff, ServersVPN, VPNSubscription, BundlePlan, BundleTariff,
+    BundleServer, BundleSubscription, ProvisioningJob)
+from bot_instance import bot
+import requestsfile as rq
+import buyextendrequests as berq
+import subscriptionrequests as subrq
+
+
+logger = logging.getLogger("provisioning")
+
+PROVISIONING_WORKERS = int(os.getenv("PROVISIONING_WORKERS", "4"))
+PROVISIONING_MAX_ATTEMPTS = int(os.getenv("PROVISIONING_MAX_ATTEMPTS", "6"))
+# пауза перед повтором: base * 2^(попытка-1), но не больше max
+PROVISIONING_BACKOFF_SEC = float(os.getenv("PROVISIONING_BACKOFF_SEC", "10"))
+PROVISIONING_BACKOFF_MAX_SEC = float(os.getenv("PROVISIONING_BACKOFF_MAX_SEC", "900"))
+PROVISIONING_POLL_SEC = float(os.getenv("PROVISIONING_POLL_SEC", "5"))
+# воркер продлевает аренду задачи каждые HEARTBEAT сек; без продления дольше LOCK_TIMEOUT
+# считаем воркер упавшим и забираем задачу заново
+PROVISIONING_HEARTBEAT_SEC = float(os.getenv("PROVISIONING_HEARTBEAT_SEC", "15"))
+PROVISIONING_LOCK_TIMEOUT_SEC = float(os.getenv("PROVISIONING_LOCK_TIMEOUT_SEC", "90"))
+
+_wakeup = asyncio.Event()
+_workers: list[asyncio.Task] = []
+
+
+async def enqueue_order(session, order: Order) -> ProvisioningJob:
+    """заказ оплачен: ставим задачу в той же транзакции, выдача — в воркере. Коммит — на вызывающем"""
+    order.status = "paid"
+    job = ProvisioningJob(order_id=order.id, status="pending", next_run_at=datetime.now(timezone.utc))
+    session.add(job)
+    await session.flush()
+    return job
+
+
+def wake():
+    """после коммита enqueue — чтобы воркер не ждал следующего опроса"""
+    _wakeup.set()
+
+
+def backoff_sec(attempts: int) -> float:
+    return min(PROVISIONING_BACKOFF_MAX_SEC, PROVISIONING_BACKOFF_SEC * 2 ** max(attempts - 1, 0))
+
+
+async def _plan_servers(session, plan: BundlePlan) -> list[ServersVPN]:
+    server_ids = (await session.scalars(select(BundleServer.server_id).where(BundleServer.bundle_plan_id == plan.id))).all()
+    return (await session.scalars(select(ServersVPN).where(ServersVPN.idServerVPN.in_(server_ids)))).all()
+
+
+class LeaseLost(Exception):
+    """задачу забрал другой воркер — наш heartbeat не успел"""
+
+
+async def _checkpoint(session, job: ProvisioningJob, lease: str, **progress):
+    """запомнить шаг и закоммитить сразу — повтор после ошибки его уже не выполнит"""
+    await _check_lease(session, job, lease)
+    job.progress = {**(job.progress or {}), **progress}
+    await session.commit()
+
+
+async def _check_lease(session, job: ProvisioningJob, lease: str):
+    # FOR UPDATE до конца транзакции: пока мы коммитим, задачу не перехватят
+    await session.refresh(job, with_for_update=True)
+    if job.locked_by != lease or job.status != "running":
+        raise LeaseLost(f"job {job.id} lease lost")
+
+
+async def _until(session, job: ProvisioningJob, lease: str, current: datetime | None, days: int) -> datetime:
+    """целевой срок продления считаем один раз на задачу — повторы доводят до него, а не добавляют дни"""
+    until = (job.progress or {}).get("until")
+    if until:
+        return datetime.fromisoformat(until)
+    target = berq.renewal_target(current, days)
+    await _checkpoint(session, job, lease, until=target.isoformat())
+    return target
+
+
+async def provision_order(session, job: ProvisioningJob, order: Order, lease: str) -> str:
+    """выдать/продлить VPN по заказу; возвращает текст сообщения пользователю.
+    Каждый шаг либо проверяет состояние (подписка уже в заказе), либо доводит до сохранённого в job целевого срока"""
+    bundle_tariff = await session.get(BundleTariff, order.bundle_tariff_id) if order.bundle_tariff_id else None
+
+    if order.purpose_order == "buy":
+        tariff = await session.get(Tariff, order.idTarif)
+        server = await session.get(ServersVPN, order.server_id)
+        if not order.subscription_id:
+            # подписка и order.subscription_id пишутся одной транзакцией
+            await berq.create_vpn_xui(order.idUser, order.server_id, tariff.days, order_id=order.id)
+            await session.refresh(order, ["subscription_id"])
+        sub = await session.get(VPNSubscription, order.subscription_id)
+        return (
+            f"✅ <b>VPN готов!</b>\n"
+            f"Сервер: {server.nameVPN}\n"
+            f"Действует до: {rq.format_datetime_ru(sub.expires_at)}\n\n"
+            f"<b>Ваша подписка:</b>\n"
+            f"<code>{sub.subscription_url}</code>"
+        )
+
+    if order.purpose_order == "extension":
+        tariff = await session.get(Tariff, order.idTarif)
+        sub = await session.get(VPNSubscription, order.subscription_id)
+        if not tariff or not sub:
+            raise Exception("Tariff or subscription not found")
+        until = await _until(session, job, lease, sub.expires_at, tariff.days)
+        vpn_data = await berq.pay_and_extend_vpn(subscription_id=order.subscription_id, tariff_id=order.idTarif, until=until)
+        return (
+            f"♻️ <b>VPN успешно продлён!</b>\n"
+            f"➕ Добавлено дней: {vpn_data['days_added']}\n"
+            f"🕒 Новый срок: {vpn_data['expires_at_human']}"
+        )
+
+    if order.purpose_order == "bundle_buy":
+        if not order.bundle_subscription_id:
+            plan = await session.get(BundlePlan, order.bundle_plan_id) if order.bundle_plan_id else None
+            if not plan and bundle_tariff:
+                plan = await session.get(BundlePlan, bundle_tariff.bundle_plan_id)
+            if not plan:
+                raise Exception("Bundle plan not found")
+            if not bundle_tariff:
+                raise Exception("Bundle tariff not found")
+            servers = await _plan_servers(session, plan)
+            bundle_sub = await berq.create_bundle_subscription(session, order.idUser, plan, servers, bundle_tariff.days)
+            order.bundle_subscription_id = bundle_sub.id
+            # клиенты на панелях уже созданы — фиксируем bundle до следующих шагов
+            await _checkpoint(session, job, lease, bundle_subscription_id=bundle_sub.id)
+        bundle_sub = await session.get(BundleSubscription, order.bundle_subscription_id)
+        return (
+            f"✅ <b>VPN готов!</b>\n"
+            f"План: Все сервера\n"
+            f"Действует до: {rq.format_datetime_ru(bundle_sub.expires_at)}\n\n"
+            f"<b>Ваша подписка:</b>\n"
+            f"<code>{bundle_sub.subscription_url}</code>"
+        )
+
+    if order.purpose_order == "bundle_extension":
+        bundle_sub = await session.get(BundleSubscription, order.bundle_subscription_id)
+        if not bundle_sub:
+            raise Exception("Bundle subscription not found")
+        plan = await session.get(BundlePlan, order.bundle_plan_id or bundle_sub.bundle_plan_id)
+        if not plan:
+            raise Exception("Bundle plan not found")
+        if not bundle_tariff:
+            raise Exception("Bundle tariff not found")
+        servers = await _plan_servers(session, plan)
+        until = await _until(session, job, lease, bundle_sub.expires_at, bundle_tariff.days)
+        # серверы, продлённые прошлой попыткой, уже на until — extend_client их не трогает
+        await berq.extend_bundle_subscription(session, bundle_sub, plan, servers, bundle_tariff.days, until=until)
+        return (
+            f"♻️ <b>VPN успешно продлён!</b>\n"
+            f"🕒 Новый срок: {rq.format_datetime_ru(bundle_sub.expires_at)}"
+        )
+
+    raise Exception("Unknown order purpose")
+
+
+async def _claim_job() -> tuple[int, str] | None:
+    """забрать одну готовую задачу; SKIP LOCKED — воркеры (и процессы) не толкаются на одной строке.
+    running-задачу забираем, только если её воркер перестал продлевать аренду (упал/завис)"""
+    now = datetime.now(timezone.utc)
+    stale = now - timedelta(seconds=PROVISIONING_LOCK_TIMEOUT_SEC)
+    async with async_session() as session:
+        job = await session.scalar(select(ProvisioningJob)
+            .where(or_(
+                and_(ProvisioningJob.status == "pending", ProvisioningJob.next_run_at <= now),
+                and_(ProvisioningJob.status == "running", ProvisioningJob.locked_at < stale),
+            ))
+            .order_by(ProvisioningJob.next_run_at)
+            .limit(1)
+            .with_for_update(skip_locked=True))
+        if not job:
+            return None
+        lease = uuid_lib.uuid4().hex
+        job.status = "running"
+        job.attempts += 1
+        job.locked_at = now
+        job.locked_by = lease
+        order = await session.get(Order, job.order_id)
+        if order:
+            order.status = "processing"
+        await session.commit()
+        return job.id, lease
+
+
+async def _heartbeat(job_id: int, lease: str):
+    """продлеваем аренду, пока задача выполняется; отдельная сессия — сессия задачи занята шагами"""
+    while True:
+        await asyncio.sleep(PROVISIONING_HEARTBEAT_SEC)
+        try:
+            async with async_session() as session:
+                result = await session.execute(update(ProvisioningJob)
+                    .where(ProvisioningJob.id == job_id, ProvisioningJob.locked_by == lease,
+                        ProvisioningJob.status == "running")
+                    .values(locked_at=datetime.now(timezone.utc)))
+                await session.commit()
+            if result.rowcount == 0:
+                logger.warning("Provisioning lease lost: job=%s", job_id)
+                return
+        except Exception as e:
+            logger.warning("Provisioning heartbeat failed: job=%s err=%s", job_id, e)
+
+
+async def run_job(job_id: int, lease: str):
+    heartbeat = asyncio.create_task(_heartbeat(job_id, lease))
+    try:
+        await _run_job(job_id, lease)
+    finally:
+        heartbeat.cancel()
+
+
+async def _run_job(job_id: int, lease: str):
+    async with async_session() as session:
+        job = await session.get(ProvisioningJob, job_id)
+        order = await session.get(Order, job.order_id)
+        user = await session.get(User, order.idUser) if order else None
+        if not order or not user:
+            job.status, job.last_error = "dead", "Order or user not found"
+            job.finished_at = datetime.now(timezone.utc)
+            await session.commit()
+            return
+        tg_id = user.tg_id  # после rollback объекты сессии протухают
+
+        try:
+            text = await provision_order(session, job, order, lease)
+            await _check_lease(session, job, lease)
+            order.status = "completed"
+            job.status = "done"
+            job.last_error = None
+            job.finished_at = datetime.now(timezone.utc)
+            await rq.process_referral_reward(session, order)
+            await session.commit()
+        except LeaseLost:
+            await session.rollback()
+            logger.warning("Provisioning abandoned: job=%s lease taken over", job_id)
+            return
+        except Exception as e:
+            await session.rollback()
+            job = await session.get(ProvisioningJob, job_id)
+            order = await session.get(Order, job.order_id)
+            try:
+                await _check_lease(session, job, lease)
+            except LeaseLost:
+                await session.rollback()
+                return
+            job.last_error = str(e)[:1000]
+            if job.attempts >= PROVISIONING_MAX_ATTEMPTS:
+                job.status = "dead"
+                job.finished_at = datetime.now(timezone.utc)
+                order.status = "failed"
+                logger.exception("Provisioning dead: job=%s order=%s attempts=%s", job.id, order.id, job.attempts)
+                notify = "❌ Не удалось выдать VPN. Оплата получена — мы уже разбираемся, напишите в поддержку."
+            else:
+                job.status = "pending"
+                job.next_run_at = datetime.now(timezone.utc) + timedelta(seconds=backoff_sec(job.attempts))
+                order.status = "paid"
+                logger.warning("Provisioning retry: job=%s order=%s attempt=%s err=%s", job.id, order.id, job.attempts, e)
+            await session.commit()
+            if job.status == "dead":
+                await _notify(tg_id, notify, order.id)
+            return
+
+        if order.purpose_order == "bundle_extension":
+            bundle_sub = await session.get(BundleSubscription, order.bundle_subscription_id)
+            subrq.invalidate_bundle(bundle_sub.id)
+            subrq.invalidate_token(bundle_sub.access_token)
+        logger.info("Provisioning done: job=%s order=%s provider=%s", job.id, order.id, order.provider)
+
+    await _notify(tg_id, text, order.id)
+
+
+async def _notify(tg_id: int, text: str, order_id: int):
+    try:
+        await bot.send_message(chat_id=tg_id, text=text, parse_mode="HTML")
+    except Exception as e:
+        logger.warning("Provisioning notify failed: order=%s err=%s", order_id, e)
+
+
+async def _worker(n: int):
+    while True:
+        try:
+            claimed = await _claim_job()
+            if claimed is None:
+                _wakeup.clear()
+                try:
+                    await asyncio.wait_for(_wakeup.wait(), timeout=PROVISIONING_POLL_SEC)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await run_job(*claimed)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Provisioning worker %s error: %s", n, e)
+            await asyncio.sleep(PROVISIONING_POLL_SEC)
+
+
+def start_workers(count: int = PROVISIONING_WORKERS):
+    for n in range(count - len(_workers)):
+        _workers.append(asyncio.create_task(_worker(n)))
+
+
+async def stop_workers():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+
+async def list_jobs(status: str | None = None, limit: int = 100) -> list[dict]:
+    async with async_session() as session:
+        q = select(ProvisioningJob).order_by(ProvisioningJob.id.desc()).limit(limit)
+        if status:
+            q = q.where(ProvisioningJob.status == status)
+        jobs = (await session.scalars(q)).all()
+    return [{"id": j.id, "order_id": j.order_id, "status": j.status, "attempts": j.attempts, "last_error": j.last_error,
+        "next_run_at": j.next_run_at.isoformat() if j.next_run_at else None,
+        "created_at": j.created_at.isoformat() if j.created_at else None,
+        "finished_at": j.finished_at.isoformat() if j.finished_at else None} for j in jobs]
+
+
+async def retry_job(job_id: int) -> dict:
+    """вернуть dead-задачу в очередь с нуля попыток"""
+    async with async_session() as session:
+        job = await session.get(ProvisioningJob, job_id)
+        if not job:
+            raise ValueError("JOB_NOT_FOUND")
+        if job.status != "dead":
+            raise ValueError("JOB_NOT_DEAD")
+        order = await session.get(Order, job.order_id)
+        job.status = "pending"
+        job.attempts = 0
+        job.next_run_at = datetime.now(timezone.utc)
+        job.finished_at = None
+        if order:
+            order.status = "paid"
+        await session.commit()
+    wake()
+    return {"id": job_id, "status": "pending"}
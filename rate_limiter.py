@@ -0,0 +1,94 @@
+import os
+import time
+from collections import OrderedDict
+
+
+# бюджет опросов подписки на один access_token
+SUB_TOKEN_BURST = float(os.getenv("SUB_TOKEN_BURST", "10"))
+SUB_TOKEN_PER_MIN = float(os.getenv("SUB_TOKEN_PER_MIN", "6"))
+# и на один IP (за NAT бывает много клиентов — бюджет больше)
+SUB_IP_BURST = float(os.getenv("SUB_IP_BURST", "60"))
+SUB_IP_PER_MIN = float(os.getenv("SUB_IP_PER_MIN", "120"))
+RATE_LIMITER_MAX_KEYS = int(os.getenv("RATE_LIMITER_MAX_KEYS", "100000"))
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, per_sec: float):
+        self.capacity = capacity
+        self.per_sec = per_sec
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.per_sec)
+        self.updated = now
+
+    def peek(self) -> bool:
+        self._refill()
+        return self.tokens >= 1
+
+    def take(self) -> bool:
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self) -> int:
+        self._refill()
+        if self.tokens >= 1 or self.per_sec <= 0:
+            return 0
+        return int((1 - self.tokens) / self.per_sec) + 1
+
+
+class RateLimiter:
+    """token bucket на ключ; самые давние ключи вытесняются при переполнении"""
+
+    def __init__(self, burst: float, per_min: float, max_keys: int = RATE_LIMITER_MAX_KEYS):
+        self.burst = burst
+        self.per_sec = per_min / 60
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def bucket(self, key: str) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst, self.per_sec)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def allow(self, key: str) -> bool:
+        return self.bucket(key).take()
+
+    def retry_after(self, key: str) -> int:
+        return self.bucket(key).retry_after()
+
+    def clear(self):
+        self._buckets.clear()
+
+
+subscription_token_limiter = RateLimiter(SUB_TOKEN_BURST, SUB_TOKEN_PER_MIN)
+subscription_ip_limiter = RateLimiter(SUB_IP_BURST, SUB_IP_PER_MIN)
+
+
+def allow_subscription_poll(token: str, ip: str | None) -> bool:
+    """списываем из обоих бюджетов только если хватает в обоих"""
+    token_bucket = subscription_token_limiter.bucket(token)
+    ip_bucket = subscription_ip_limiter.bucket(ip) if ip else None
+    if not token_bucket.peek() or (ip_bucket and not ip_bucket.peek()):
+        return False
+    token_bucket.take()
+    if ip_bucket:
+        ip_bucket.take()
+    return True
+
+
+def subscription_retry_after(token: str, ip: str | None) -> int:
+    wait = subscription_token_limiter.retry_after(token)
+    if ip:
+        wait = max(wait, subscription_ip_limiter.retry_after(ip))
+    return wait
@@ -0,0 +1,142 @@
+import os
+import re
+import time
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import select
+
+from models import async_session, ServersVPN, VPNSubscription, BundleSubscription, BundleSubscriptionItem
+from xui_api import get_xui
+
+
+logger = logging.getLogger("reconcile")
+
+# 1 — чинить расхождения, иначе только отчёт
+RECONCILE_REPAIR = os.getenv("RECONCILE_REPAIR", "0") == "1"
+# удалять с панели клиентов, которых нет в БД (только с нашим форматом email)
+RECONCILE_REMOVE_ORPHANS = os.getenv("RECONCILE_REMOVE_ORPHANS", "0") == "1"
+# расхождение срока меньше этого не считаем дрейфом
+RECONCILE_DRIFT_SEC = int(os.getenv("RECONCILE_DRIFT_SEC", "300"))
+# сирота должна продержаться столько между прогонами, прежде чем её удалим:
+# покупка создаёт клиента на панели раньше, чем коммитит строку в БД
+RECONCILE_ORPHAN_GRACE_SEC = int(os.getenv("RECONCILE_ORPHAN_GRACE_SEC", "900"))
+
+# "{страна} - {idUser},N" / "...,N-plan" — так email генерирует requestsfile
+_OUR_EMAIL_RE = re.compile(r"^.+ - \d+,\d+(-plan)?$")
+
+last_report: dict | None = None
+# (server_id, email) -> когда впервые увидели клиента сиротой
+_orphan_seen: dict[tuple[int, str], float] = {}
+
+
+def _to_ms(dt: datetime) -> int:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+
+async def _load_expected(session, server_id: int) -> tuple[dict[str, dict], set[str]]:
+    """активные клиенты сервера по БД: email -> {uuid, sub_id, expiry_ms}; плюс все известные БД email"""
+    now = datetime.now(timezone.utc)
+    expected, known = {}, set()
+
+    subs = await session.scalars(select(VPNSubscription).where(VPNSubscription.idServerVPN == server_id))
+    for sub in subs:
+        known.add(sub.provider_client_email)
+        if sub.is_active and sub.expires_at and sub.expires_at > now:
+            expected[sub.provider_client_email] = {"uuid": sub.provider_client_uuid, "sub_id": sub.subscription_id,
+                "expiry_ms": _to_ms(sub.expires_at)}
+
+    rows = await session.execute(select(BundleSubscriptionItem, BundleSubscription)
+        .join(BundleSubscription, BundleSubscription.id == BundleSubscriptionItem.bundle_subscription_id)
+        .where(BundleSubscriptionItem.server_id == server_id))
+    for item, bundle_sub in rows:
+        known.add(item.client_email)
+        if bundle_sub.is_active and bundle_sub.expires_at and bundle_sub.expires_at > now:
+            expected[item.client_email] = {"uuid": item.client_uuid,
+                "sub_id": item.subscription_id or bundle_sub.subscription_id, "expiry_ms": _to_ms(bundle_sub.expires_at)}
+
+    return expected, known
+
+
+def _aged_orphans(server_id: int, orphans: list[str]) -> set[str]:
+    """сироты, которые висят дольше RECONCILE_ORPHAN_GRACE_SEC"""
+    now = time.monotonic()
+    current = {(server_id, email) for email in orphans}
+    for key in [k for k in _orphan_seen if k[0] == server_id and k not in current]:
+        del _orphan_seen[key]  # появилась строка в БД или клиента уже нет
+    for key in current:
+        _orphan_seen.setdefault(key, now)
+    return {email for email in orphans if now - _orphan_seen[(server_id, email)] >= RECONCILE_ORPHAN_GRACE_SEC}
+
+
+async def reconcile_server(server: ServersVPN, repair: bool = RECONCILE_REPAIR) -> dict:
+    async with async_session() as session:
+        expected, known = await _load_expected(session, server.idServerVPN)
+    return await reconcile_inbound(get_xui(server), server, expected, known, repair=repair)
+
+
+async def reconcile_inbound(xui, server: ServersVPN, expected: dict[str, dict], known: set[str],
+        repair: bool = RECONCILE_REPAIR) -> dict:
+    """выборка списка инбаундов, сравнение множеств, починка пачкой: перезапись инбаунда (свежее чтение
+    под локом + update) и один addClient. БД прочитана раньше панели, поэтому сроки чиним только вперёд"""
+    await xui.get_inbounds()  # свежий список целиком, get_inbound_by_port возьмёт его из кэша
+    inbound = await xui.get_inbound_by_port(server.inbound_port)
+    if not inbound:
+        raise Exception("Inbound not found")
+    panel = {c.email: c for c in inbound.settings.clients or []}
+
+    drift, behind = [], {}
+    for email, exp in expected.items():
+        client = panel.get(email)
+        if client and client.expiry_time > 0 and abs(client.expiry_time - exp["expiry_ms"]) > RECONCILE_DRIFT_SEC * 1000:
+            drift.append(email)
+            if client.expiry_time < exp["expiry_ms"]:
+                behind[email] = exp["expiry_ms"]
+    missing = [email for email in expected if email not in panel]
+    orphans = [email for email in panel if email not in known and _OUR_EMAIL_RE.match(email or "")]
+
+    report = {
+        "server_id": server.idServerVPN,
+        "server": server.nameVPN,
+        "panel_clients": len(panel),
+        "expected_active": len(expected),
+        "drift": sorted(drift),
+        "missing": sorted(missing),
+        "orphans": sorted(orphans),
+        "repaired": False,
+    }
+
+    remove = _aged_orphans(server.idServerVPN, orphans) if RECONCILE_REMOVE_ORPHANS else set()
+    if repair and (behind or missing or remove):
+        if behind or remove:
+            await xui.apply_inbound_changes(inbound.id, expiry_by_email=behind, remove_emails=remove)
+        if missing:
+            await xui.add_clients_bulk(inbound.id, [{"email": email, "uuid": expected[email]["uuid"],
+                "sub_id": expected[email]["sub_id"], "expiry_time": expected[email]["expiry_ms"]} for email in missing])
+        report["repaired"] = True
+
+    return report
+
+
+async def reconcile_all(repair: bool = RECONCILE_REPAIR) -> dict:
+    global last_report
+    async with async_session() as session:
+        servers = (await session.scalars(select(ServersVPN).where(ServersVPN.is_active == True))).all()
+
+    reports = []
+    for server in servers:
+        try:
+            report = await reconcile_server(server, repair=repair)
+        except Exception as e:
+            logger.warning("Reconcile failed: server=%s err=%s", server.nameVPN, e)
+            report = {"server_id": server.idServerVPN, "server": server.nameVPN, "error": str(e)}
+        else:
+            if report["drift"] or report["missing"] or report["orphans"]:
+                logger.warning("Reconcile: server=%s drift=%d missing=%d orphans=%d repaired=%s", server.nameVPN,
+                    len(report["drift"]), len(report["missing"]), len(report["orphans"]), report["repaired"])
+        reports.append(report)
+
+    last_report = {"finished_at": datetime.now(timezone.utc).isoformat(), "repair": repair, "servers": reports}
+    return last_report
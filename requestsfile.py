@@ -1,19 +1,26 @@
 import os
 import re
+import time
 from sqlalchemy import select, update, delete
 from models import (async_session, User, UserWallet, WalletOperation, WalletTransaction, VPNSubscription, TypesVPN,
     CountriesVPN, ServersVPN, Tariff, ExchangeRate, Order, Payment, ReferralConfig, ReferralEarning,
     UserFreeDaysBalance, UserRewardOp, UserCheckin, PromoCode, PromoCodeUsage, BundlePlan, BundleSubscription,
-    BundleTariff, BundleServer)
+    BundleTariff, BundleServer, BundleSubscriptionItem, ClientEmailSequence)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from typing import List
 from datetime import datetime, timezone, timedelta
 from decimal import Decimal
 from sqlalchemy import select, func, exists
 from sqlalchemy.orm import aliased
 from urllib.parse import quote, urlparse
-from xui_api import XUIApi
+import panel_health
+import subscriptionrequests as subrq
+import pricingrequests as pricerq
+from xui_api import get_xui
 
 PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "https://artcryvpnbot.lunaweb.ru").rstrip("/")
+# прятать из витрины серверы с открытой цепью (иначе только флаг is_healthy)
+HIDE_UNHEALTHY_SERVERS = os.getenv("HIDE_UNHEALTHY_SERVERS", "0") == "1"
 
 
 # USERS
@@ -303,8 +310,7 @@ async def get_servers_full():
         for t in tariffs:
             tariffs_map.setdefault(t.server_id, []).append(t)
 
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "XTR_USDT"))
-        rate_val = rate.rate if rate else Decimal("1")
+        prices = await pricerq.price_matrix()
 
         result = []
         bundle_server_ids = set(await session.scalars(select(BundleServer.server_id).distinct()))
@@ -313,11 +319,14 @@ async def get_servers_full():
             tariffs_list = []
             for t in tariffs_rows:
                 tariffs_list.append({"idTarif": t.idTarif,"days": t.days,
-                    "price_usdt": str(t.price_tarif),"price_stars": int(t.price_tarif / rate_val)})
+                    "price_usdt": str(t.price_tarif),"price_stars": prices.tariff_stars(t)})
 
             result.append({"idServerVPN": s.idServerVPN,"nameVPN": s.nameVPN,"type_vpn": type_vpn.nameType if type_vpn else "",
                 "type_description": type_vpn.descriptionType if type_vpn else "","country": country.nameCountry if country else "",
-                "tariffs": tariffs_list, "is_bundle": s.idServerVPN in bundle_server_ids})
+                "tariffs": tariffs_list, "is_bundle": s.idServerVPN in bundle_server_ids,
+                "is_healthy": panel_health.is_healthy(s.idServerVPN)})
+        if HIDE_UNHEALTHY_SERVERS:
+            result = [r for r in result if r["is_healthy"]]
         return result
 
 
@@ -369,6 +378,75 @@ def build_single_subscription_url(token: str) -> str:
     return f"{PUBLIC_BASE_URL}/api/vpn/sub/{token}"
 
 
+async def _token_current(token: str, resolved: subrq.ResolvedToken, model) -> bool:
+    """токен из кэша ещё действителен: не ротирован и срок не менялся (проверка по индексу access_token).
+    False — перечитываем подписку целиком"""
+    if not resolved.needs_recheck():
+        return True
+    async with async_session() as session:
+        expires_at = await session.scalar(select(model.expires_at).where(model.access_token == token))
+    if expires_at is None or expires_at != resolved.expires_at:
+        subrq.invalidate_token(token)
+        return False
+    resolved.checked_at = time.monotonic()
+    return True
+
+
+async def resolve_single_token(token: str) -> subrq.ResolvedToken:
+    """access_token одиночной подписки -> адрес подписки на панели (из LRU, иначе один запрос в БД)"""
+    resolved = subrq.get_token(token)
+    if resolved and resolved.kind == "single" and await _token_current(token, resolved, VPNSubscription):
+        return resolved
+
+    async with async_session() as session:
+        row = (await session.execute(select(VPNSubscription, ServersVPN)
+            .outerjoin(ServersVPN, ServersVPN.idServerVPN == VPNSubscription.idServerVPN)
+            .where(VPNSubscription.access_token == token))).first()
+    if not row:
+        raise ValueError("SUBSCRIPTION_NOT_FOUND")
+    sub, server = row
+    if not server:
+        raise ValueError("SERVER_NOT_FOUND")
+    url = build_subscription_url(server, sub.subscription_id)
+    if not url:
+        raise ValueError("SUBSCRIPTION_URL_UNAVAILABLE")
+
+    resolved = subrq.ResolvedToken("single", sub.expires_at, [(server.idServerVPN, url)],
+        clients={server.idServerVPN: (server, sub.provider_client_uuid)})
+    subrq.put_token(token, resolved)
+    return resolved
+
+
+async def resolve_bundle_token(token: str) -> subrq.ResolvedToken:
+    """access_token bundle-подписки -> адреса подписок всех её серверов"""
+    resolved = subrq.get_token(token)
+    if resolved and resolved.kind == "bundle" and await _token_current(token, resolved, BundleSubscription):
+        return resolved
+
+    async with async_session() as session:
+        bundle_sub = await session.scalar(select(BundleSubscription).where(BundleSubscription.access_token == token))
+        if not bundle_sub:
+            raise ValueError("BUNDLE_SUBSCRIPTION_NOT_FOUND")
+        items = (await session.execute(select(BundleSubscriptionItem, ServersVPN)
+            .join(ServersVPN, BundleSubscriptionItem.server_id == ServersVPN.idServerVPN)
+            .where(BundleSubscriptionItem.bundle_subscription_id == bundle_sub.id))).all()
+    if not items:
+        raise ValueError("BUNDLE_ITEMS_NOT_FOUND")
+
+    sub_urls, clients = [], {}
+    for item, server in items:
+        url = build_subscription_url(server, item.subscription_id or bundle_sub.subscription_id)
+        if url:
+            sub_urls.append((server.idServerVPN, url))
+            clients[server.idServerVPN] = (server, item.client_uuid)
+    if not sub_urls:
+        raise ValueError("SUBSCRIPTION_URL_UNAVAILABLE")
+
+    resolved = subrq.ResolvedToken("bundle", bundle_sub.expires_at, sub_urls, bundle_id=bundle_sub.id, clients=clients)
+    subrq.put_token(token, resolved)
+    return resolved
+
+
 # MY VPNs
 async def get_my_vpns(tg_id: int) -> List[dict]:
     async with async_session() as session:
@@ -428,8 +506,7 @@ async def get_subscriptions_by_server(user_id: int, server_id: int) -> List[dict
 async def get_bundle_plans_active() -> List[dict]:
     async with async_session() as session:
         plans = (await session.scalars(select(BundlePlan).where(BundlePlan.is_active == True))).all()
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "XTR_USDT"))
-        rate_val = rate.rate if rate else Decimal("1")
+        prices = await pricerq.price_matrix()
         result = []
         for p in plans:
             tariffs = (await session.scalars(
@@ -438,14 +515,11 @@ async def get_bundle_plans_active() -> List[dict]:
             )).all()
             tariffs_data = []
             for t in tariffs:
-                price_stars = int(Decimal(t.price_usdt) / rate_val)
-                if price_stars < 1:
-                    price_stars = 1
                 tariffs_data.append({
                     "id": t.id,
                     "days": t.days,
                     "price_usdt": str(t.price_usdt),
-                    "price_stars": price_stars
+                    "price_stars": prices.bundle_tariff_stars(t)
                 })
             result.append({
                 "id": p.id,
@@ -463,8 +537,7 @@ async def get_my_bundle_vpns(tg_id: int) -> List[dict]:
             return []
 
         now = datetime.now(timezone.utc)
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "XTR_USDT"))
-        rate_val = rate.rate if rate else Decimal("1")
+        prices = await pricerq.price_matrix()
         rows = await session.execute(
             select(BundleSubscription, BundlePlan)
             .join(BundlePlan, BundleSubscription.bundle_plan_id == BundlePlan.id)
@@ -481,14 +554,11 @@ async def get_my_bundle_vpns(tg_id: int) -> List[dict]:
             )).all()
             tariffs_data = []
             for t in tariffs:
-                price_stars = int(Decimal(t.price_usdt) / rate_val)
-                if price_stars < 1:
-                    price_stars = 1
                 tariffs_data.append({
                     "id": t.id,
                     "days": t.days,
                     "price_usdt": str(t.price_usdt),
-                    "price_stars": price_stars
+                    "price_stars": prices.bundle_tariff_stars(t)
                 })
             result.append({
                 "bundle_subscription_id": sub.id,
@@ -525,56 +595,69 @@ async def has_active_subscription(tg_id: int) -> bool:
         return bool(await session.scalar(q)) or bool(await session.scalar(bundle_q))
 
 
-async def generate_unique_client_email(session,user_id: int,server: ServersVPN,xui: XUIApi) -> str:
-    country = await session.get(CountriesVPN, server.idCountry)
-    country_name = country.nameCountry
+_EMAIL_NUM_RE = re.compile(r",(\d+)(?:-plan)?$")
 
-    inbound = await xui.get_inbound_by_port(server.inbound_port)
+
+async def _panel_email_num(user_id: int, server: ServersVPN, country_name: str, kind: str) -> int:
+    """максимальный номер среди клиентов на панели — там бывают сироты без строки в БД"""
+    inbound = await get_xui(server).get_inbound_by_port(server.inbound_port)
     if not inbound:
         raise Exception("Inbound not found")
+    suffix = "-plan" if kind == "bundle" else ""
+    pattern = re.compile(rf"^{re.escape(country_name)}\s*-\s*{user_id},(\d+){re.escape(suffix)}$")
+    nums = [int(m.group(1)) for c in inbound.settings.clients or []
+        if (m := pattern.match((c.email or "").split("@")[0]))]
+    return max(nums, default=0)
 
-    existing = inbound.settings.clients or []
 
-    prefix = f"{country_name} - {user_id},"
-    pattern = re.compile(rf"^{re.escape(country_name)}\s*-\s*{user_id},(\d+)$")
-    nums = []
-    for c in existing:
-        email = (c.email or "").split("@")[0]
-        match = pattern.match(email)
-        if match:
-            try:
-                nums.append(int(match.group(1)))
-            except ValueError:
-                pass
+async def _seed_email_num(user_id: int, server: ServersVPN, kind: str, country_name: str) -> int:
+    """максимальный номер среди уже выданных email — в БД и на панели (для первой выдачи после перехода на счётчик)"""
+    server_id = server.idServerVPN
+    async with async_session() as session:
+        if kind == "bundle":
+            emails = await session.scalars(select(BundleSubscriptionItem.client_email)
+                .join(BundleSubscription, BundleSubscription.id == BundleSubscriptionItem.bundle_subscription_id)
+                .where(BundleSubscription.idUser == user_id, BundleSubscriptionItem.server_id == server_id))
+        else:
+            emails = await session.scalars(select(VPNSubscription.provider_client_email)
+                .where(VPNSubscription.idUser == user_id, VPNSubscription.idServerVPN == server_id))
+        nums = [int(m.group(1)) for e in emails if (m := _EMAIL_NUM_RE.search((e or "").split("@")[0]))]
+    return max(max(nums, default=0), await _panel_email_num(user_id, server, country_name, kind))
 
-    next_num = max(nums) + 1 if nums else 1
-    return f"{prefix}{next_num}"
 
+async def next_client_email_num(user_id: int, server: ServersVPN, kind: str, country_name: str) -> int:
+    """атомарно выдать следующий номер. Отдельная транзакция: номер не откатывается
+    вместе с покупкой, иначе повторили бы email клиента, уже созданного на панели"""
+    server_id = server.idServerVPN
+    async with async_session() as session:
+        num = await session.scalar(update(ClientEmailSequence)
+            .where(ClientEmailSequence.idUser == user_id, ClientEmailSequence.server_id == server_id,
+                ClientEmailSequence.kind == kind)
+            .values(last_num=ClientEmailSequence.last_num + 1)
+            .returning(ClientEmailSequence.last_num))
+        if num is None:
+            seed = await _seed_email_num(user_id, server, kind, country_name)
+            num = await session.scalar(pg_insert(ClientEmailSequence)
+                .values(idUser=user_id, server_id=server_id, kind=kind, last_num=seed + 1)
+                .on_conflict_do_update(constraint="uq_client_email_seq",
+                    set_={"last_num": ClientEmailSequence.last_num + 1})
+                .returning(ClientEmailSequence.last_num))
+        await session.commit()
+        return num
 
-async def generate_unique_bundle_client_email(session, user_id: int, server: ServersVPN, xui: XUIApi) -> str:
+
+async def generate_unique_client_email(session, user_id: int, server: ServersVPN) -> str:
     country = await session.get(CountriesVPN, server.idCountry)
-    country_name = country.nameCountry
+    prefix = f"{country.nameCountry} - {user_id},"
+    num = await next_client_email_num(user_id, server, "single", country.nameCountry)
+    return f"{prefix}{num}"
 
-    inbound = await xui.get_inbound_by_port(server.inbound_port)
-    if not inbound:
-        raise Exception("Inbound not found")
 
-    existing = inbound.settings.clients or []
-
-    prefix = f"{country_name} - {user_id},"
-    pattern = re.compile(rf"^{re.escape(country_name)}\s*-\s*{user_id},(\d+)-plan$")
-    nums = []
-    for c in existing:
-        email = (c.email or "").split("@")[0]
-        match = pattern.match(email)
-        if match:
-            try:
-                nums.append(int(match.group(1)))
-            except ValueError:
-                pass
-
-    next_num = max(nums) + 1 if nums else 1
-    return f"{prefix}{next_num}-plan"
+async def generate_unique_bundle_client_email(session, user_id: int, server: ServersVPN) -> str:
+    country = await session.get(CountriesVPN, server.idCountry)
+    prefix = f"{country.nameCountry} - {user_id},"
+    num = await next_client_email_num(user_id, server, "bundle", country.nameCountry)
+    return f"{prefix}{num}-plan"
 
 
 # REFERRALS
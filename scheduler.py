@@ -1,10 +1,19 @@
+import os
 from datetime import datetime, timezone
 
 from sqlalchemy import select
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from models import async_session, VPNSubscription, Order, User
+from models import async_session, VPNSubscription, Order, User, ServersVPN
 from bot_instance import bot
+from xui_api import get_xui
+import panel_health
+import reconcilerequests as recrq
+import subscriptionrequests as subrq
+import trafficrequests as trafficrq
+
+
+RECONCILE_INTERVAL_MIN = int(os.getenv("RECONCILE_INTERVAL_MIN", "30"))
 
 
 """Находит активные VPN-подписки с истёкшим expires_at, помечает их как:
@@ -58,6 +67,25 @@ async def expire_orders_task():
         print(f"🧾 Expired {len(orders)} pending orders")
 
 
+async def probe_unhealthy_panels():
+    """пробный логин на панели с открытой цепью — закрывает цепь, если панель ожила"""
+    server_ids = panel_health.due_for_probe()
+    if not server_ids:
+        return
+
+    async with async_session() as session:
+        servers = (await session.scalars(select(ServersVPN).where(ServersVPN.idServerVPN.in_(server_ids)))).all()
+
+    for server in servers:
+        ok = await get_xui(server).probe()
+        print(f"{'✅' if ok else '⛔'} Panel probe {server.nameVPN}: {panel_health.get_health(server.idServerVPN).state}")
+
+
+async def reconcile_panels_task():
+    report = await recrq.reconcile_all()
+    print(f"🧮 Reconcile finished: {len(report['servers'])} server(s), repair={report['repair']}")
+
+
 def start_scheduler():
     scheduler = AsyncIOScheduler(timezone="UTC")
 
@@ -67,6 +95,18 @@ def start_scheduler():
     scheduler.add_job(expire_orders_task,trigger="interval",minutes=1,id="expire_orders_task",
         max_instances=1,replace_existing=True,)
 
+    scheduler.add_job(reconcile_panels_task,trigger="interval",minutes=RECONCILE_INTERVAL_MIN,id="reconcile_panels",
+        max_instances=1,replace_existing=True,coalesce=True)
+
+    scheduler.add_job(subrq.evict_idle_bundles,trigger="interval",seconds=600,id="bundle_payload_evict",
+        max_instances=1,replace_existing=True,coalesce=True)
+
+    scheduler.add_job(trafficrq.ingest_all,trigger="interval",seconds=trafficrq.TRAFFIC_INGEST_SEC,id="traffic_ingest",
+        max_instances=1,replace_existing=True,coalesce=True)
+
+    scheduler.add_job(probe_unhealthy_panels,trigger="interval",seconds=15,id="panel_health_probe",
+        max_instances=1,replace_existing=True,coalesce=True)
+
     scheduler.start()
     print("🕒 VPN subscription status scheduler started")
     print("🕒 Scheduler started (orders expiration)")
@@ -0,0 +1,98 @@
+import os
+import base64
+from urllib.parse import quote, urlencode, urlparse
+
+from py3xui import Inbound
+from py3xui.client.client import Client
+
+from xui_api import get_xui
+
+
+# proxy — отдаём то, что вернул сервер подписок панели; local — собираем ссылки сами из кэша инбаунда
+SUBSCRIPTION_RENDER_MODE = os.getenv("SUBSCRIPTION_RENDER_MODE", "proxy")
+
+
+def server_host(server) -> str | None:
+    """хост сервера для клиентов: из api_url панели, иначе server_ip"""
+    if server.api_url:
+        parsed = urlparse(server.api_url)
+        if parsed.hostname:
+            return parsed.hostname
+    return server.server_ip or None
+
+
+def _first(value) -> str:
+    if isinstance(value, list):
+        return value[0] if value else ""
+    return value or ""
+
+
+def render_vless_links(inbound: Inbound, client: Client, host: str) -> list[str] | None:
+    """vless-ссылки клиента как их строит 3x-ui; None — конфигурация, которую не умеем (отдадим прокси)"""
+    stream = inbound.stream_settings
+    if inbound.protocol != "vless" or stream.network not in ("tcp", "xhttp"):
+        return None
+
+    params = {"type": stream.network, "encryption": "none"}
+    if stream.network == "tcp":
+        header = (stream.tcp_settings or {}).get("header") or {}
+        if header.get("type", "none") != "none":
+            return None
+    else:
+        xhttp = stream.xhttp_settings or {}
+        params["path"] = xhttp.get("path", "/")
+        if xhttp.get("host"):
+            params["host"] = xhttp["host"]
+        params["mode"] = xhttp.get("mode", "auto")
+
+    params["security"] = stream.security
+    if stream.security == "reality":
+        reality = stream.reality_settings or {}
+        settings = reality.get("settings") or {}
+        params["pbk"] = settings.get("publicKey", "")
+        params["fp"] = settings.get("fingerprint", "")
+        params["sni"] = _first(reality.get("serverNames"))
+        params["sid"] = _first(reality.get("shortIds"))
+        if settings.get("spiderX"):
+            params["spx"] = settings["spiderX"]
+    elif stream.security == "tls":
+        tls = stream.tls_settings or {}
+        settings = tls.get("settings") or {}
+        params["sni"] = tls.get("serverName", "")
+        params["fp"] = settings.get("fingerprint", "")
+        if tls.get("alpn"):
+            params["alpn"] = ",".join(tls["alpn"])
+    elif stream.security != "none":
+        return None
+
+    if client.flow and stream.network == "tcp" and stream.security in ("reality", "tls"):
+        params["flow"] = client.flow
+
+    query = urlencode({k: v for k, v in params.items() if v != ""}, quote_via=quote)
+    targets = [(p.get("dest") or host, p.get("port") or inbound.port, p.get("remark", ""))
+        for p in stream.external_proxy or []] or [(host, inbound.port, "")]
+
+    links = []
+    for address, port, proxy_remark in targets:
+        remark = "-".join(x for x in (inbound.remark, client.email, proxy_remark) if x)
+        links.append(f"vless://{client.id}@{address}:{port}?{query}#{quote(remark)}")
+    return links
+
+
+async def render_for_client(server, client_uuid: str) -> str | None:
+    """base64-подписка клиента, собранная из кэша инбаунда; None — рендер недоступен, нужен прокси"""
+    host = server_host(server)
+    if not host:
+        return None
+    snap = await get_xui(server).cached_snapshot_by_port(server.inbound_port)
+    if not snap:
+        return None
+    client = snap.by_uuid.get(client_uuid)
+    if not client:
+        return None
+    if not client.enable:
+        return ""
+    links = render_vless_links(snap.inbound, client, host)
+    if links is None:
+        return None
+    return base64.b64encode("\n".join(links).encode("utf-8")).decode("utf-8")
@@ -0,0 +1,138 @@
+"""Отдача подписок (/api/vpn/sub/*, /api/vpn/bundle/sub/*) отдельно от бота и платежей.
+
+Роутер подключается в main, но модуль можно запустить и сам по себе, на своих воркерах:
+    uvicorn subscription_app:app --workers 4
+Тянет только модели, кэши подписок и клиент 3x-ui — без aiogram, yookassa и платёжных модулей.
+
+Кэши и фоновые задачи — на процесс: каждый воркер uvicorn сам опрашивает панели (traffic_ingest)
+и выкидывает из памяти давно не запрашиваемые bundle (bundle_payload_evict); сами bundle пересобираются
+только по запросу, не чаще раза в BUNDLE_REFRESH_SEC.
+Интервал traffic_ingest растягивается в SUB_APP_WORKERS раз (по умолчанию WEB_CONCURRENCY — его же
+читает uvicorn для --workers), так что суммарный опрос панелей не растёт с числом воркеров.
+Инвалидации токенов основного процесса сюда не доходят: токен из кэша старше TOKEN_RECHECK_SEC (5 сек)
+сверяется с БД, так что ротация access_token и продление видны почти сразу.
+"""
+import os
+import logging
+from contextlib import asynccontextmanager
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from fastapi import APIRouter, FastAPI, HTTPException, Request
+
+import requestsfile as rq
+import subscriptionrequests as subrq
+import trafficrequests as trafficrq
+import rate_limiter
+import panel_health
+from xui_api import close_all_xui
+
+
+logger = logging.getLogger(__name__)
+
+SUB_PROFILE_TITLE = os.getenv("SUB_PROFILE_TITLE", "Artcry VPN")
+SUB_UPDATE_INTERVAL_HOURS = os.getenv("SUB_UPDATE_INTERVAL_HOURS", "1")
+SUB_SUPPORT_URL = os.getenv("SUB_SUPPORT_URL", "https://t.me/testvpnartcrybot")
+SUB_WEB_PAGE_URL = os.getenv("SUB_WEB_PAGE_URL", "https://t.me/testvpnartcrybot")
+SUB_APP_WORKERS = max(int(os.getenv("SUB_APP_WORKERS", os.getenv("WEB_CONCURRENCY", "1"))), 1)
+
+router = APIRouter()
+
+
+@router.get("/api/vpn/sub/{token}")
+async def single_subscription(token: str, request: Request):
+    ip = subrq.client_ip(request)
+    throttled = not rate_limiter.allow_subscription_poll(token, ip)
+    if throttled and subrq.peek_single(token) is None:
+        raise HTTPException(429, "TOO_MANY_REQUESTS", headers={"Retry-After": str(rate_limiter.subscription_retry_after(token, ip))})
+
+    try:
+        sub = await rq.resolve_single_token(token)
+    except ValueError as e:
+        msg = str(e)
+        if msg == "SUBSCRIPTION_NOT_FOUND":
+            raise HTTPException(404, "Subscription not found")
+        if msg == "SERVER_NOT_FOUND":
+            raise HTTPException(404, "Server not found")
+        raise HTTPException(400, msg)
+
+    server_id, url = sub.sub_urls[0]
+    try:
+        if throttled:
+            content = subrq.peek_single(token) or ""  # лимит исчерпан — отдаём последний ответ
+        else:
+            content = await subrq.get_single_content(token, url, server_id, sub.clients.get(server_id))
+    except panel_health.PanelUnavailable:
+        raise HTTPException(503, "PANEL_UNAVAILABLE")
+    except Exception as e:
+        logger.exception("Single sub fetch error: %s", e)
+        raise HTTPException(502, "SUBSCRIPTION_FETCH_FAILED")
+
+    expire_ts = int(sub.expires_at.timestamp())
+    headers = {
+        "profile-title": SUB_PROFILE_TITLE,
+        "profile-update-interval": SUB_UPDATE_INTERVAL_HOURS,
+        "support-url": SUB_SUPPORT_URL,
+        "profile-web-page-url": SUB_WEB_PAGE_URL,
+        "subscription-userinfo": trafficrq.userinfo_header(sub.clients, expire_ts),
+        "update-always": "true",
+    }
+    return subrq.subscription_response(request, content, expire_ts, headers)
+
+
+@router.get("/api/vpn/bundle/sub/{access_token}")
+async def bundle_subscription(access_token: str, request: Request):
+    ip = subrq.client_ip(request)
+    throttled = not rate_limiter.allow_subscription_poll(access_token, ip)
+
+    try:
+        bundle_sub = await rq.resolve_bundle_token(access_token)
+    except ValueError as e:
+        msg = str(e)
+        if msg == "BUNDLE_SUBSCRIPTION_NOT_FOUND":
+            raise HTTPException(404, "Bundle subscription not found")
+        if msg == "BUNDLE_ITEMS_NOT_FOUND":
+            raise HTTPException(404, "Bundle subscription items not found")
+        raise HTTPException(400, msg)
+
+    if throttled:
+        encoded = subrq.peek_bundle(bundle_sub.bundle_id)  # лимит исчерпан — только из памяти
+        if encoded is None:
+            raise HTTPException(429, "TOO_MANY_REQUESTS",
+                headers={"Retry-After": str(rate_limiter.subscription_retry_after(access_token, ip))})
+    else:
+        encoded = await subrq.get_bundle_payload(bundle_sub.bundle_id, bundle_sub.sub_urls, bundle_sub.clients)
+    expire_ts = int(bundle_sub.expires_at.timestamp())
+    headers = {
+        "profile-title": SUB_PROFILE_TITLE,
+        "profile-update-interval": SUB_UPDATE_INTERVAL_HOURS,
+        "support-url": SUB_SUPPORT_URL,
+        "profile-web-page-url": SUB_WEB_PAGE_URL,
+        "subscription-userinfo": trafficrq.userinfo_header(bundle_sub.clients, expire_ts),
+        "update-always": "true",
+    }
+    return subrq.subscription_response(request, encoded, expire_ts, headers)
+
+# ======================
+# отдельный процесс
+# ======================
+@asynccontextmanager
+async def lifespan(app_: FastAPI):
+    # таблицы создаёт основной бэкенд; здесь только фоновые задачи над кэшами этого процесса.
+    # Планировщик свой у каждого воркера — опрос трафика реже в SUB_APP_WORKERS раз
+    # ротацию токена и продления основной процесс инвалидирует только у себя — сверяем токены с БД
+    subrq.TOKEN_RECHECK_SEC = float(os.getenv("TOKEN_RECHECK_SEC", "5"))
+    scheduler = AsyncIOScheduler(timezone="UTC")
+    scheduler.add_job(subrq.evict_idle_bundles,trigger="interval",seconds=600,id="bundle_payload_evict",
+        max_instances=1,replace_existing=True,coalesce=True)
+    scheduler.add_job(trafficrq.ingest_all,trigger="interval",seconds=trafficrq.TRAFFIC_INGEST_SEC * SUB_APP_WORKERS,
+        id="traffic_ingest",max_instances=1,replace_existing=True,coalesce=True)
+    scheduler.start()
+    print("✅ Subscription server ready!")
+    yield
+    scheduler.shutdown(wait=False)
+    await close_all_xui()
+    await subrq.close_subscription_http()
+
+
+app = FastAPI(title="ArtCry VPN subscriptions", lifespan=lifespan)
+app.include_router(router)
@@ -0,0 +1,536 @@
+import os
+import gzip
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+import ipaddress
+from collections import OrderedDict
+from datetime import datetime
+
+import httpx
+from fastapi import Request, Response
+
+import panel_health
+import sub_links
+
+
+try:
+    import brotli  # необязательная зависимость: без неё отдаём только gzip
+except ImportError:
+    brotli = None
+
+
+logger = logging.getLogger("subscriptions")
+
+# сколько секунд отдаём контент подписки из памяти без похода на панель
+SUB_CACHE_TTL = float(os.getenv("SUB_CACHE_TTL", "60"))
+# после TTL ещё столько отдаём старый контент, обновляя его в фоне
+SUB_CACHE_STALE_SEC = float(os.getenv("SUB_CACHE_STALE_SEC", "600"))
+SUB_CACHE_MAX = int(os.getenv("SUB_CACHE_MAX", "20000"))
+SUB_FETCH_TIMEOUT = float(os.getenv("SUB_FETCH_TIMEOUT", "10"))
+# bundle старше этого при запросе отдаём из памяти и пересобираем в фоне (только по запросу — без опроса впустую)
+BUNDLE_REFRESH_SEC = float(os.getenv("BUNDLE_REFRESH_SEC", "300"))
+# старше этого старое не отдаём — клиент ждёт сборку
+BUNDLE_STALE_SEC = float(os.getenv("BUNDLE_STALE_SEC", "3600"))
+# bundle, который никто не запрашивал столько времени, выкидываем из памяти
+BUNDLE_IDLE_SEC = float(os.getenv("BUNDLE_IDLE_SEC", "10800"))
+# сколько ждём серверы при сборке bundle; не успевшие берём из последнего удачного ответа
+BUNDLE_SUB_DEADLINE_SEC = float(os.getenv("BUNDLE_SUB_DEADLINE_SEC", "8"))
+# неполный bundle пересобираем не реже этого
+BUNDLE_PARTIAL_RETRY_SEC = float(os.getenv("BUNDLE_PARTIAL_RETRY_SEC", "30"))
+# страховка на случай пропущенной инвалидации access_token
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))
+# токен из кэша старше этого сверяем с БД одним коротким запросом; 0 — не сверяем (инвалидации в своём процессе).
+# Отдельный subscription_app инвалидаций основного процесса не видит — там по умолчанию 5 сек
+TOKEN_RECHECK_SEC = float(os.getenv("TOKEN_RECHECK_SEC", "0"))
+TOKEN_CACHE_MAX = int(os.getenv("TOKEN_CACHE_MAX", "50000"))
+# тела меньше этого не сжимаем
+SUB_COMPRESS_MIN_BYTES = int(os.getenv("SUB_COMPRESS_MIN_BYTES", "512"))
+SUB_COMPRESSED_CACHE_MAX = int(os.getenv("SUB_COMPRESSED_CACHE_MAX", "5000"))
+# прокси (адреса/подсети через запятую), которым верим в X-Real-IP; остальным — только адрес соединения
+SUB_TRUSTED_PROXIES = [ipaddress.ip_network(net.strip(), strict=False)
+    for net in os.getenv("SUB_TRUSTED_PROXIES", "127.0.0.1,::1").split(",") if net.strip()]
+
+
+class SubscriptionFetchError(Exception):
+    """сервер подписок панели не отдал контент"""
+
+
+class SingleFlight:
+    """одновременные вызовы с одним ключом ждут один и тот же запрос"""
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Future] = {}
+
+    def _done(self, key: str, fut: asyncio.Future):
+        if self._calls.get(key) is fut:
+            self._calls.pop(key, None)
+        if not fut.cancelled():
+            fut.exception()  # помечаем как прочитанное, даже если все ждущие ушли
+
+    async def do(self, key: str, fn):
+        fut = self._calls.get(key)
+        if fut is None or fut.done():
+            fut = asyncio.ensure_future(fn())
+            self._calls[key] = fut
+            fut.add_done_callback(lambda f: self._done(key, f))
+        # shield: отмена одного клиента не отменяет запрос остальным
+        return await asyncio.shield(fut)
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+
+class CachedContent:
+    def __init__(self, url: str, text: str):
+        self.url = url
+        self.text = text
+        self.fetched_at = time.monotonic()
+
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+
+_http: httpx.AsyncClient | None = None
+_cache: dict[str, CachedContent] = {}
+_refreshing: set[str] = set()
+_bundles: dict[int, "BundlePayload"] = {}
+_bundle_tasks: dict[int, asyncio.Task] = {}
+_bundle_parts: "OrderedDict[str, str]" = OrderedDict()  # url -> последний непустой ответ сервера
+_part_tasks: set[asyncio.Task] = set()  # догружаются после дедлайна
+_tokens: "OrderedDict[str, ResolvedToken]" = OrderedDict()
+_flight = SingleFlight()
+_compressed: "OrderedDict[tuple[str, str], bytes]" = OrderedDict()
+
+
+def _client() -> httpx.AsyncClient:
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(
+            verify=False,  # сервер подписок панели на самоподписанном сертификате
+            timeout=httpx.Timeout(SUB_FETCH_TIMEOUT, connect=5),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60),
+            headers={"User-Agent": "ArtCryVPN/1.0"},
+        )
+    return _http
+
+
+async def close_subscription_http():
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+
+
+async def fetch_subscription(url: str, server_id: int | None = None, client: tuple | None = None) -> str:
+    """асинхронно забрать подписку с панели; учитывает circuit breaker сервера.
+    client = (server, client_uuid): в режиме local сначала пробуем собрать ссылки сами"""
+    if client is not None and sub_links.SUBSCRIPTION_RENDER_MODE == "local":
+        try:
+            text = await sub_links.render_for_client(*client)
+        except Exception as e:
+            logger.warning("Local sub render failed, proxying: %s err=%s", url, e)
+            text = None
+        if text is not None:
+            return text
+    return await _flight.do(url, lambda: _proxy_fetch(url, server_id))
+
+
+async def _proxy_fetch(url: str, server_id: int | None) -> str:
+    health = panel_health.get_health(server_id) if server_id is not None else None
+    if health and not health.allow():
+        raise panel_health.PanelUnavailable(f"server {server_id}: panel unavailable")
+    started = time.monotonic()
+    try:
+        resp = await _client().get(url)
+        if resp.status_code != 200:
+            raise SubscriptionFetchError(f"status={resp.status_code}")
+    except (httpx.HTTPError, SubscriptionFetchError) as e:
+        if health:
+            health.record(False, time.monotonic() - started, repr(e))
+        raise SubscriptionFetchError(str(e)) from e
+    if health:
+        health.record(True, time.monotonic() - started)
+    return resp.text
+
+
+def _store(token: str, url: str, text: str):
+    if token not in _cache and len(_cache) >= SUB_CACHE_MAX:
+        _cache.pop(next(iter(_cache)))  # самый старый по вставке
+    _cache[token] = CachedContent(url, text)
+
+
+async def _refresh(token: str, url: str, server_id: int | None, client: tuple | None):
+    try:
+        _store(token, url, await fetch_subscription(url, server_id, client))
+    except Exception as e:
+        logger.warning("Single sub background refresh failed: %s err=%s", url, e)
+    finally:
+        _refreshing.discard(token)
+
+
+async def get_single_content(token: str, url: str, server_id: int | None = None, client: tuple | None = None) -> str:
+    """контент одиночной подписки: свежий кэш -> stale-while-revalidate -> запрос к панели"""
+    entry = _cache.get(token)
+    if entry and entry.url == url:
+        age = entry.age()
+        if age < SUB_CACHE_TTL:
+            return entry.text
+        if age < SUB_CACHE_TTL + SUB_CACHE_STALE_SEC:
+            if token not in _refreshing:
+                _refreshing.add(token)
+                asyncio.create_task(_refresh(token, url, server_id, client))
+            return entry.text
+
+    try:
+        text = await fetch_subscription(url, server_id, client)
+    except Exception:
+        if entry and entry.url == url:
+            logger.warning("Single sub fetch failed, serving stale copy: %s", url)
+            return entry.text
+        raise
+    _store(token, url, text)
+    return text
+
+
+def peek_single(token: str) -> str | None:
+    """последний отданный контент без похода на панель (для ответа троттлингованному клиенту)"""
+    entry = _cache.get(token)
+    return entry.text if entry else None
+
+
+def invalidate_subscription(token: str):
+    _cache.pop(token, None)
+
+
+# ————————— BUNDLE —————————
+class BundlePayload:
+    """собранная bundle-подписка: base64 объединённых строк всех серверов"""
+
+    def __init__(self, urls: tuple, encoded: str, merged: int, clients: dict | None = None, missing: tuple = ()):
+        self.urls = urls  # ((server_id, url), ...)
+        self.clients = clients or {}  # server_id -> (server, client_uuid) для локального рендера
+        self.encoded = encoded
+        self.merged = merged
+        self.missing = missing  # server_id, не ответившие к дедлайну
+        self.built_at = time.monotonic()
+        self.accessed_at = self.built_at
+
+    def age(self) -> float:
+        return time.monotonic() - self.built_at
+
+    def needs_rebuild(self) -> bool:
+        limit = min(BUNDLE_REFRESH_SEC, BUNDLE_PARTIAL_RETRY_SEC) if self.missing else BUNDLE_REFRESH_SEC
+        return self.age() > limit
+
+
+def _remember_part(url: str, text: str):
+    if not text.strip():
+        return
+    _bundle_parts[url] = text
+    _bundle_parts.move_to_end(url)
+    while len(_bundle_parts) > SUB_CACHE_MAX:
+        _bundle_parts.popitem(last=False)
+
+
+def _part_done(task: asyncio.Task):
+    _part_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.warning("Bundle sub part failed: %s", task.exception())
+
+
+async def _fetch_bundle_part(server_id: int, url: str, client: tuple | None = None, retries: int = 2, delay_sec: float = 0.6) -> str:
+    last = ""
+    for attempt in range(retries + 1):
+        try:
+            text = await fetch_subscription(url, server_id, client)
+            _remember_part(url, text)
+            return text
+        except panel_health.PanelUnavailable:
+            logger.warning("Bundle sub skipped, panel unavailable: %s", url)
+            return ""
+        except SubscriptionFetchError as e:
+            if url.startswith("https://"):
+                http_url = "http://" + url[len("https://"):]
+                try:
+                    last = await fetch_subscription(http_url, server_id)
+                    logger.info("Bundle sub fetch fallback to http: %s", http_url)
+                    _remember_part(url, last)
+                    return last
+                except Exception:
+                    pass
+            logger.warning("Bundle sub fetch failed: %s err=%s", url, e)
+        if attempt < retries:
+            await asyncio.sleep(delay_sec)
+    logger.warning("Bundle sub empty after retries: %s", url)
+    return last
+
+
+def _decode_if_base64(line: str) -> list[str]:
+    # Try to decode base64 subscriptions into URI lines.
+    try:
+        decoded = base64.b64decode(line + "==", validate=False).decode("utf-8", errors="ignore")
+        decoded_lines = [l.strip() for l in decoded.splitlines() if l.strip()]
+        if decoded_lines:
+            return decoded_lines
+    except Exception:
+        pass
+    return [line]
+
+
+def merge_subscription_texts(texts: list[str]) -> tuple[str, int, int]:
+    """склеить подписки серверов: раскодировать base64, убрать дубли, закодировать обратно"""
+    raw_lines = [line.strip() for text in texts for line in text.splitlines() if line.strip()]
+    merged, seen = [], set()
+    for line in raw_lines:
+        for item in _decode_if_base64(line):
+            if item in seen:
+                continue
+            seen.add(item)
+            merged.append(item)
+    encoded = base64.b64encode("\n".join(merged).encode("utf-8")).decode("utf-8")
+    return encoded, len(raw_lines), len(merged)
+
+
+async def build_bundle_payload(bundle_id: int, sub_urls: list[tuple[int, str]], clients: dict | None = None) -> BundlePayload:
+    """собрать bundle за BUNDLE_SUB_DEADLINE_SEC: опоздавшие серверы подставляем из последнего удачного ответа"""
+    clients = clients or {}
+    tasks = [asyncio.create_task(_fetch_bundle_part(server_id, url, clients.get(server_id)))
+        for server_id, url in sub_urls]
+    if tasks:
+        await asyncio.wait(tasks, timeout=BUNDLE_SUB_DEADLINE_SEC)
+
+    texts, missing = [], []
+    for (server_id, url), task in zip(sub_urls, tasks):
+        text = ""
+        if task.done() and not task.cancelled() and not task.exception():
+            text = task.result()
+        elif not task.done():
+            # не отменяем: догрузится и попадёт в _bundle_parts к следующей пересборке
+            _part_tasks.add(task)
+            task.add_done_callback(_part_done)
+        else:
+            _part_done(task)
+        if not text.strip():
+            missing.append(server_id)
+            text = _bundle_parts.get(url, "")
+            logger.warning("Bundle sub part missing bundle=%s server=%s backfilled=%s url=%s",
+                bundle_id, server_id, bool(text), url)
+        texts.append(text)
+
+    encoded, raw, merged = merge_subscription_texts(texts)
+    logger.info("Bundle sub aggregated bundle=%s raw=%s merged=%s urls=%s missing=%s",
+        bundle_id, raw, merged, len(sub_urls), missing)
+
+    payload = BundlePayload(tuple(sub_urls), encoded, merged, clients, tuple(missing))
+    old = _bundles.get(bundle_id)
+    if old:
+        payload.accessed_at = old.accessed_at
+    _bundles[bundle_id] = payload
+    return payload
+
+
+def _schedule_rebuild(bundle_id: int, sub_urls, clients: dict | None = None) -> asyncio.Task:
+    task = _bundle_tasks.get(bundle_id)
+    if task and not task.done():
+        return task
+
+    async def run():
+        try:
+            return await build_bundle_payload(bundle_id, list(sub_urls), clients)
+        finally:
+            _bundle_tasks.pop(bundle_id, None)
+
+    task = _bundle_tasks[bundle_id] = asyncio.create_task(run())
+    return task
+
+
+async def get_bundle_payload(bundle_id: int, sub_urls: list[tuple[int, str]], clients: dict | None = None) -> str:
+    """объединённая подписка из памяти; собираем на месте при первом запросе, смене серверов
+    или если payload старше BUNDLE_STALE_SEC, иначе устаревший пересобираем в фоне"""
+    entry = _bundles.get(bundle_id)
+    if entry and entry.urls == tuple(sub_urls) and entry.age() <= BUNDLE_STALE_SEC:
+        entry.accessed_at = time.monotonic()
+        if entry.needs_rebuild():
+            _schedule_rebuild(bundle_id, entry.urls, clients or entry.clients)
+        return entry.encoded
+    # shield: отключившийся клиент не отменяет сборку остальным, кто её ждёт
+    payload = await asyncio.shield(_schedule_rebuild(bundle_id, sub_urls, clients))
+    payload.accessed_at = time.monotonic()
+    return payload.encoded
+
+
+def peek_bundle(bundle_id: int) -> str | None:
+    entry = _bundles.get(bundle_id)
+    return entry.encoded if entry else None
+
+
+def invalidate_bundle(bundle_id: int):
+    """состав/сроки bundle поменялись — пересобрать в фоне, пока отдаём старое"""
+    entry = _bundles.get(bundle_id)
+    if entry:
+        try:
+            _schedule_rebuild(bundle_id, entry.urls, entry.clients)
+        except RuntimeError:
+            _bundles.pop(bundle_id, None)  # нет цикла событий — просто забываем
+
+
+def forget_bundle(bundle_id: int):
+    """bundle удалён / у плана сменились серверы — выкидываем payload и токены, соберём заново по запросу"""
+    _bundles.pop(bundle_id, None)
+    for token, resolved in list(_tokens.items()):
+        if resolved.bundle_id == bundle_id:
+            _tokens.pop(token, None)
+            _cache.pop(token, None)
+
+
+def invalidate_server_bundles(server_id: int):
+    """сервер изменили/удалили — адреса подписок могли поменяться"""
+    for bundle_id, entry in list(_bundles.items()):
+        if any(sid == server_id for sid, _ in entry.urls):
+            _bundles.pop(bundle_id, None)
+
+
+async def evict_idle_bundles():
+    """выкинуть давно не запрашиваемые bundle; пересборка — только по запросу (get_bundle_payload),
+    иначе каждый активный bundle опрашивал бы все свои серверы раз в BUNDLE_REFRESH_SEC"""
+    now = time.monotonic()
+    for bundle_id, entry in list(_bundles.items()):
+        if now - entry.accessed_at > BUNDLE_IDLE_SEC:
+            _bundles.pop(bundle_id, None)
+
+
+# ————————— ACCESS TOKENS —————————
+class ResolvedToken:
+    """всё, что нужно обработчику подписки по access_token, без похода в БД"""
+
+    def __init__(self, kind: str, expires_at: datetime, sub_urls: list[tuple[int, str]], bundle_id: int | None = None,
+            clients: dict | None = None):
+        self.kind = kind  # single / bundle
+        self.expires_at = expires_at
+        self.sub_urls = sub_urls  # [(server_id, url), ...]
+        self.clients = clients or {}  # server_id -> (server, client_uuid)
+        self.bundle_id = bundle_id
+        self.stored_at = time.monotonic()
+        self.checked_at = self.stored_at
+
+    def needs_recheck(self) -> bool:
+        return TOKEN_RECHECK_SEC > 0 and time.monotonic() - self.checked_at > TOKEN_RECHECK_SEC
+
+
+def get_token(token: str) -> ResolvedToken | None:
+    resolved = _tokens.get(token)
+    if not resolved:
+        return None
+    if time.monotonic() - resolved.stored_at > TOKEN_CACHE_TTL:
+        _tokens.pop(token, None)
+        return None
+    _tokens.move_to_end(token)
+    return resolved
+
+
+def put_token(token: str, resolved: ResolvedToken):
+    _tokens[token] = resolved
+    _tokens.move_to_end(token)
+    while len(_tokens) > TOKEN_CACHE_MAX:
+        _tokens.popitem(last=False)
+
+
+def invalidate_token(token: str | None):
+    """ротация токена / продление / правка подписки"""
+    if not token:
+        return
+    _tokens.pop(token, None)
+    _cache.pop(token, None)
+
+
+def invalidate_server_tokens(server_id: int):
+    for token, resolved in list(_tokens.items()):
+        if any(sid == server_id for sid, _ in resolved.sub_urls):
+            _tokens.pop(token, None)
+            _cache.pop(token, None)
+
+
+# ————————— HTTP RESPONSE —————————
+def make_etag(content: str, expire_ts: int, userinfo: str = "") -> str:
+    """сильный ETag: содержимое подписки + срок + subscription-userinfo (трафик меняется без смены содержимого)"""
+    digest = hashlib.sha256(f"{expire_ts}|{userinfo}|{content}".encode("utf-8")).hexdigest()[:32]
+    return f'"{digest}"'
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def _pick_encoding(accept_encoding: str | None) -> str | None:
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.lower()] = q
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def _compress(etag: str, encoding: str, body: bytes) -> bytes:
+    key = (etag, encoding)
+    data = _compressed.get(key)
+    if data is None:
+        data = brotli.compress(body) if encoding == "br" else gzip.compress(body, compresslevel=6)
+        _compressed[key] = data
+        while len(_compressed) > SUB_COMPRESSED_CACHE_MAX:
+            _compressed.popitem(last=False)
+    else:
+        _compressed.move_to_end(key)
+    return data
+
+
+def _is_trusted_proxy(host: str | None) -> bool:
+    try:
+        addr = ipaddress.ip_address(host)
+    except (TypeError, ValueError):
+        return False
+    return any(addr in net for net in SUB_TRUSTED_PROXIES)
+
+
+def client_ip(request: Request) -> str | None:
+    # за nginx реальный адрес приходит в X-Real-IP; напрямую заголовок подделывается — не верим
+    peer = request.client.host if request.client else None
+    if _is_trusted_proxy(peer):
+        return request.headers.get("x-real-ip") or peer
+    return peer
+
+
+def subscription_response(request: Request, content: str, expire_ts: int, headers: dict) -> Response:
+    """ответ подписки: ETag + If-None-Match -> 304, сжатие gzip/br по Accept-Encoding"""
+    base_etag = make_etag(content, expire_ts, headers.get("subscription-userinfo", ""))
+    body = content.encode("utf-8")
+    encoding = _pick_encoding(request.headers.get("accept-encoding")) if len(body) >= SUB_COMPRESS_MIN_BYTES else None
+    # у каждого content-coding свой сильный ETag: байты тела разные
+    etag = f'{base_etag[:-1]}-{encoding}"' if encoding else base_etag
+    headers = {**headers, "ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    if encoding:
+        body = _compress(base_etag, encoding, body)
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="text/plain; charset=utf-8", headers=headers)
@@ -4,9 +4,10 @@ from datetime import datetime, timedelta, timezone
 from fastapi import HTTPException
 
 from models import async_session, User, Order, UserTask, UserReward, VPNSubscription, ServersVPN
-from xui_api import XUIApi
+from xui_api import get_xui
 import uuid as uuid_lib
 import requestsfile as rq
+import subscriptionrequests as subrq
 
 
 TASKS = [
@@ -127,6 +128,7 @@ async def activate_reward(user_id: int, reward_id: int, server_id: int):
         reward.activated_at = datetime.utcnow()
 
         await session.commit()
+        subrq.invalidate_token(result["subscription"].access_token)
         return {"mode": result["mode"], "subscription_id": result["subscription"].id}
 
 
@@ -154,7 +156,7 @@ async def _apply_free_days_to_subscription(session, user_id: int, server_id: int
     now = datetime.now(timezone.utc)
 
     if sub:
-        xui = XUIApi(server.api_url, server.xui_username, server.xui_password)
+        xui = get_xui(server)
         inbound = await xui.get_inbound_by_port(server.inbound_port)
         if not inbound:
             raise HTTPException(500, "Inbound not found")
@@ -192,8 +194,8 @@ async def _apply_free_days_to_subscription(session, user_id: int, server_id: int
         await rq.recalc_server_load(session, server_id)
         return {"mode": "extend", "subscription": sub}
 
-    xui = XUIApi(server.api_url, server.xui_username, server.xui_password)
-    client_email = await rq.generate_unique_client_email(session, user_id, server, xui)
+    xui = get_xui(server)
+    client_email = await rq.generate_unique_client_email(session, user_id, server)
     inbound = await xui.get_inbound_by_port(server.inbound_port)
     if not inbound:
         raise HTTPException(500, "Inbound not found")
@@ -323,6 +325,7 @@ async def activate_free_days(user_id: int, server_id: int, days: int, subscripti
             raise HTTPException(400, str(exc))
 
         await session.commit()
+        subrq.invalidate_token(result["subscription"].access_token)
         await session.refresh(balance)
 
         sub = result["subscription"]
@@ -0,0 +1,114 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import buyextendrequests as berq
+import requestsfile as rq
+from xui_api import _extended_expiry
+
+
+class FakeXUI:
+    """клиенты одного сервера в памяти; fail — add/extend падают"""
+
+    def __init__(self):
+        self.clients = {}  # email -> {"uuid", "expiry"}
+        self.fail = False
+        self.extends = 0
+
+    async def get_inbound_by_port(self, port):
+        return SimpleNamespace(id=1, port=port)
+
+    async def add_client(self, inbound_id, email, days, sub_id=None):
+        if self.fail:
+            raise Exception("panel down")
+        client = {"uuid": f"uuid-{email}", "expiry": 0, "sub_id": sub_id}
+        self.clients[email] = client
+        return {"uuid": client["uuid"], "email": email, "sub_id": sub_id}
+
+    async def remove_client(self, inbound_id, client_uuid):
+        self.clients = {e: c for e, c in self.clients.items() if c["uuid"] != client_uuid}
+
+    async def extend_client(self, inbound_id, client_email, days, sub_id=None, expiry_ms=None):
+        if self.fail:
+            raise Exception("panel down")
+        client = self.clients[client_email]
+        new_expiry = _extended_expiry(client["expiry"], days, expiry_ms)
+        if new_expiry != client["expiry"]:
+            self.extends += 1
+        client["expiry"] = new_expiry
+        return {"email": client_email, "new_expiry": new_expiry, "sub_id": sub_id}
+
+
+class FakeSession:
+    def __init__(self, items=()):
+        self.items = list(items)
+        self.added = []
+
+    def add(self, obj):
+        self.added.append(obj)
+
+    async def flush(self):
+        for obj in self.added:
+            if getattr(obj, "id", None) is None:
+                obj.id = 1
+
+    async def scalars(self, query):
+        return SimpleNamespace(all=lambda: self.items)
+
+
+class BundleProvisionTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.servers = [SimpleNamespace(idServerVPN=i, nameVPN=f"srv{i}", inbound_port=443) for i in (1, 2, 3)]
+        self.xuis = {s.idServerVPN: FakeXUI() for s in self.servers}
+        self.old_get_xui, self.old_email = berq.get_xui, rq.generate_unique_bundle_client_email
+        berq.get_xui = lambda server: self.xuis[server.idServerVPN]
+
+        async def email(session, user_id, server):
+            return f"{server.nameVPN} - {user_id},1"
+
+        rq.generate_unique_bundle_client_email = email
+        self.plan = SimpleNamespace(id=5)
+
+    def tearDown(self):
+        berq.get_xui, rq.generate_unique_bundle_client_email = self.old_get_xui, self.old_email
+
+    async def test_failed_server_rolls_back_created_clients(self):
+        self.xuis[2].fail = True
+        with self.assertRaises(Exception):
+            await berq.create_bundle_subscription(FakeSession(), 7, self.plan, self.servers, 30)
+        self.assertEqual([x.clients for x in self.xuis.values()], [{}, {}, {}])
+
+    async def test_all_servers_provisioned(self):
+        session = FakeSession()
+        bundle_sub = await berq.create_bundle_subscription(session, 7, self.plan, self.servers, 30)
+        self.assertTrue(bundle_sub.subscription_url)
+        self.assertEqual(len([o for o in session.added if isinstance(o, berq.BundleSubscriptionItem)]), 3)
+        self.assertTrue(all(len(x.clients) == 1 for x in self.xuis.values()))
+
+    async def test_retry_after_partial_extend_does_not_extend_twice(self):
+        expires_at = datetime.now(timezone.utc) + timedelta(days=10)
+        items = []
+        for server in self.servers:
+            email = f"{server.nameVPN} - 7,1"
+            self.xuis[server.idServerVPN].clients[email] = {"uuid": f"uuid-{email}", "expiry": berq._to_ms(expires_at)}
+            items.append(SimpleNamespace(server_id=server.idServerVPN, client_email=email, subscription_id="sub"))
+
+        # первая попытка: третий сервер лёг, транзакция откатилась — срок в БД прежний
+        self.xuis[3].fail = True
+        bundle_sub = SimpleNamespace(id=1, subscription_id="sub", expires_at=expires_at)
+        with self.assertRaises(Exception):
+            await berq.extend_bundle_subscription(FakeSession(items), bundle_sub, self.plan, self.servers, 30,
+                until=berq.renewal_target(expires_at, 30))
+
+        self.xuis[3].fail = False
+        bundle_sub = SimpleNamespace(id=1, subscription_id="sub", expires_at=expires_at)
+        until = berq.renewal_target(expires_at, 30)
+        await berq.extend_bundle_subscription(FakeSession(items), bundle_sub, self.plan, self.servers, 30, until=until)
+
+        self.assertEqual(bundle_sub.expires_at, until)
+        self.assertEqual({x.clients[f"srv{i} - 7,1"]["expiry"] for i, x in self.xuis.items()}, {berq._to_ms(until)})
+        self.assertEqual([x.extends for x in self.xuis.values()], [1, 1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from types import SimpleNamespace
+
+from sqlalchemy.dialects import postgresql
+
+import invoicerequests as invrq
+import main
+import pricingrequests as pricerq
+
+
+def sql(query) -> str:
+    return str(query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+
+
+class FakeSession:
+    """отдаёт заранее собранную строку LEFT JOIN; None — строки в таблице нет"""
+
+    def __init__(self, row=None, scalar=None):
+        self.row = row
+        self.scalar_result = scalar
+        self.queries = []
+        self.commits = 0
+
+    async def execute(self, query):
+        self.queries.append(query)
+        return SimpleNamespace(one=lambda: self.row)
+
+    async def scalar(self, query):
+        self.queries.append(query)
+        return self.scalar_result
+
+    async def commit(self):
+        self.commits += 1
+
+
+def order(status, expired=False):
+    delta = timedelta(minutes=-1 if expired else 30)
+    return SimpleNamespace(id=1, status=status, expires_at=datetime.now(timezone.utc) + delta)
+
+
+class LoadInvoiceContextTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        pricerq.invalidate()
+        pricerq._matrix = pricerq.PriceMatrix({"XTR_USDT": Decimal("0.5")}, [], [])
+
+    def tearDown(self):
+        pricerq.invalidate()
+
+    async def test_missing_rows_are_none(self):
+        user = SimpleNamespace(idUser=7)
+        session = FakeSession((user, None, None, None, None, None, None, None, None))
+        ctx = await invrq.load_invoice_context(session, 555, tariff_id=3, rate_pair="RUB_USDT")
+        self.assertIs(ctx.user, user)
+        for name in ("active", "tariff", "sub", "server", "bundle_tariff", "plan", "bundle_sub", "rate", "first_server_id"):
+            self.assertIsNone(getattr(ctx, name), name)
+
+        text = sql(session.queries[0])
+        self.assertEqual(text.count("LEFT OUTER JOIN"), 8)  # одна строка, даже если пользователя/тарифа нет
+        self.assertIn("'paid'", text)
+
+    async def test_no_user_and_no_rate_pair(self):
+        session = FakeSession((None,) * 9)
+        ctx = await invrq.load_invoice_context(session, 555)
+        self.assertIsNone(ctx.user)
+        self.assertIsNone(ctx.rate)
+        self.assertIn("false", sql(session.queries[0]).lower())  # без id не джойним ни одну строку
+
+    async def test_prices_from_cached_rate(self):
+        tariff = SimpleNamespace(price_tarif=Decimal("3"), days=30)
+        session = FakeSession((None, None, tariff, None, None, None, None, None, None))
+        ctx = await invrq.load_invoice_context(session, 555, tariff_id=3, rate_pair="XTR_USDT")
+        self.assertEqual(ctx.rate, Decimal("0.5"))
+        self.assertEqual(ctx.stars_price(), 6)
+        self.assertEqual(ctx.days, 30)
+
+    async def test_expired_pending_order_released(self):
+        active = order("pending", expired=True)
+        session = FakeSession((None, active, None, None, None, None, None, None, None))
+        ctx = await invrq.load_invoice_context(session, 555)
+        self.assertIsNone(ctx.active)
+        self.assertEqual(active.status, "expired")
+        self.assertEqual(session.commits, 1)
+
+    async def test_paid_order_stays_active(self):
+        active = order("paid", expired=True)  # оплачен, ждёт выдачи — новый инвойс не нужен
+        session = FakeSession((None, active, None, None, None, None, None, None, None))
+        ctx = await invrq.load_invoice_context(session, 555)
+        self.assertIs(ctx.active, active)
+        self.assertEqual(active.status, "paid")
+        self.assertEqual(session.commits, 0)
+
+
+class ActiveOrderTests(unittest.IsolatedAsyncioTestCase):
+    async def test_paid_order_is_active(self):
+        paid = order("paid", expired=True)
+        session = FakeSession(scalar=paid)
+        self.assertIs(await main.get_active_order_for_user(session, 7), paid)
+        self.assertEqual(paid.status, "paid")
+        self.assertIn("'paid'", sql(session.queries[0]))
+
+    async def test_expired_pending_order_not_active(self):
+        pending = order("pending", expired=True)
+        session = FakeSession(scalar=pending)
+        self.assertIsNone(await main.get_active_order_for_user(session, 7))
+        self.assertEqual(pending.status, "expired")
+
+    async def test_no_order(self):
+        self.assertIsNone(await main.get_active_order_for_user(FakeSession(), 7))
+
+
+if __name__ == "__main__":
+    unittest.main()
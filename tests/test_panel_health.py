@@ -0,0 +1,55 @@
+import unittest
+
+import panel_health
+from panel_health import PanelHealth, CLOSED, OPEN, HALF_OPEN
+
+
+class PanelHealthTests(unittest.TestCase):
+    def test_opens_after_error_rate(self):
+        health = PanelHealth(1)
+        for _ in range(panel_health.PANEL_CB_MIN_CALLS - 1):
+            health.record(False, 0.1, "timeout")
+        self.assertEqual(health.state, CLOSED)
+        health.record(False, 0.1, "timeout")
+        self.assertEqual(health.state, OPEN)
+        self.assertFalse(health.allow())
+
+    def test_slow_success_counts_as_failure(self):
+        health = PanelHealth(1)
+        for _ in range(panel_health.PANEL_CB_MIN_CALLS):
+            health.record(True, panel_health.PANEL_CB_SLOW_SEC + 1)
+        self.assertEqual(health.state, OPEN)
+
+    def test_half_open_single_trial_then_close(self):
+        health = PanelHealth(1)
+        health._open()
+        health.opened_at -= panel_health.PANEL_CB_OPEN_SEC
+        self.assertTrue(health.probe_due())
+        self.assertTrue(health.allow())
+        self.assertEqual(health.state, HALF_OPEN)
+        self.assertFalse(health.allow())  # второй запрос ждёт исхода пробного
+        health.record(True, 0.1)
+        self.assertEqual(health.state, CLOSED)
+        self.assertTrue(health.allow())
+
+    def test_half_open_failure_reopens(self):
+        health = PanelHealth(1)
+        health._open()
+        health.opened_at -= panel_health.PANEL_CB_OPEN_SEC
+        self.assertTrue(health.allow())
+        health.record(False, 0.1, "connect error")
+        self.assertEqual(health.state, OPEN)
+        self.assertFalse(health.allow())
+
+    def test_cancelled_trial_frees_slot(self):
+        health = PanelHealth(1)
+        health._open()
+        health.opened_at -= panel_health.PANEL_CB_OPEN_SEC
+        self.assertTrue(health.allow())
+        health.release()
+        self.assertEqual(health.state, HALF_OPEN)
+        self.assertTrue(health.allow())
+
+
+if __name__ == "__main__":
+    unittest.main()
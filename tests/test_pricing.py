@@ -0,0 +1,85 @@
+import unittest
+from contextlib import asynccontextmanager
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pricingrequests as pricerq
+
+
+def tariff(idTarif, price):
+    return SimpleNamespace(idTarif=idTarif, price_tarif=Decimal(price))
+
+
+def bundle_tariff(id, price):
+    return SimpleNamespace(id=id, price_usdt=Decimal(price))
+
+
+class PriceMatrixTests(unittest.TestCase):
+    def test_prices_in_all_currencies(self):
+        m = pricerq.PriceMatrix({"XTR_USDT": Decimal("0.013"), "RUB_USDT": Decimal("95")},
+            [tariff(1, "3.5"), tariff(2, "0.005")], [bundle_tariff(7, "10")])
+        self.assertEqual(m.tariff(1).stars, 269)
+        self.assertEqual(m.tariff(1).rub, Decimal("332.5"))
+        self.assertEqual(m.tariff(2).stars, 1)  # минимум 1 Star
+        self.assertEqual(m.bundle_tariff(7).stars, 769)
+        self.assertIsNone(m.tariff(3))
+
+    def test_without_rates(self):
+        m = pricerq.PriceMatrix({}, [tariff(1, "3")], [])
+        self.assertEqual(m.tariff(1).stars, 3)
+        self.assertIsNone(m.tariff(1).rub)
+
+    def test_stale_entry_recomputed_from_row(self):
+        m = pricerq.PriceMatrix({"XTR_USDT": Decimal("0.5")}, [tariff(1, "3")], [bundle_tariff(7, "2")])
+        self.assertEqual(m.tariff_stars(tariff(1, "3")), 6)
+        self.assertEqual(m.tariff_stars(tariff(1, "4")), 8)
+        self.assertEqual(m.tariff_stars(tariff(9, "1")), 2)
+        self.assertEqual(m.bundle_tariff_stars(bundle_tariff(7, "2")), 4)
+
+
+class PriceMatrixCacheTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.old_session = pricerq.async_session
+        self.rows = [SimpleNamespace(pair="XTR_USDT", rate=Decimal("0.5"))]
+        self.on_read = None
+
+        @asynccontextmanager
+        async def session():
+            yield self
+
+        pricerq.async_session = session
+        pricerq.invalidate()
+
+    def tearDown(self):
+        pricerq.async_session = self.old_session
+        pricerq.invalidate()
+
+    async def scalars(self, query):
+        if self.on_read:
+            self.on_read()
+        return _Rows(self.rows if "exchange_rates" in str(query) else [])
+
+    async def test_cached_until_invalidate(self):
+        m = await pricerq.price_matrix()
+        self.assertIs(await pricerq.price_matrix(), m)
+        pricerq.invalidate()
+        self.assertIsNot(await pricerq.price_matrix(), m)
+
+    async def test_rebuild_racing_invalidate_not_cached(self):
+        # курс поменяли, пока шла сборка: её результат отдаём, но не кэшируем
+        self.on_read = pricerq.invalidate
+        stale = await pricerq.price_matrix()
+        self.on_read = None
+        self.rows = [SimpleNamespace(pair="XTR_USDT", rate=Decimal("0.25"))]
+        fresh = await pricerq.price_matrix()
+        self.assertIsNot(fresh, stale)
+        self.assertEqual(fresh.rates["XTR_USDT"], Decimal("0.25"))
+
+
+class _Rows(list):
+    def all(self):
+        return list(self)
+
+
+if __name__ == "__main__":
+    unittest.main()
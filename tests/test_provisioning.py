@@ -0,0 +1,231 @@
+import asyncio
+import unittest
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from sqlalchemy.dialects import postgresql
+
+import provisioningrequests as provrq
+from models import Order, ProvisioningJob, Tariff, User, VPNSubscription
+
+
+class FakeDB:
+    """строки по (модель, id); сессия видит закоммиченное, пишет только изменённые поля — как ORM"""
+
+    def __init__(self):
+        self.rows = {}
+
+    def put(self, model, **fields):
+        self.rows[(model, fields["id"])] = dict(fields)
+
+    def row(self, model, id):
+        return self.rows[(model, id)]
+
+    @asynccontextmanager
+    async def session(self):
+        yield FakeSession(self)
+
+
+class FakeSession:
+    def __init__(self, db: FakeDB):
+        self.db = db
+        self.loaded = {}  # (модель, id) -> (объект, снимок полей при загрузке)
+
+    def _load(self, key):
+        fields = dict(self.db.rows[key])
+        obj = self.loaded[key][0] if key in self.loaded else SimpleNamespace()
+        vars(obj).clear()
+        vars(obj).update(fields)
+        self.loaded[key] = (obj, fields)
+        return obj
+
+    async def get(self, model, id):
+        key = (model, id)
+        if key not in self.db.rows:
+            return None
+        return self.loaded[key][0] if key in self.loaded else self._load(key)
+
+    async def refresh(self, obj, attribute_names=None, with_for_update=False):
+        for key, (loaded, _) in self.loaded.items():
+            if loaded is obj:
+                self._load(key)
+
+    async def scalar(self, query):
+        self.query = str(query.compile(dialect=postgresql.dialect()))
+        jobs = [k for k, r in self.db.rows.items() if k[0] is ProvisioningJob and r["status"] == "pending"]
+        return self._load(jobs[0]) if jobs else None
+
+    async def scalars(self, query):
+        jobs = [self._load(k) for k in self.db.rows if k[0] is ProvisioningJob]
+        return SimpleNamespace(all=lambda: jobs)
+
+    async def execute(self, stmt):
+        # только UPDATE аренды из _heartbeat
+        params = stmt.compile().params
+        row = self.db.row(ProvisioningJob, params["id_1"])
+        hit = row["locked_by"] == params["locked_by_1"] and row["status"] == params["status_1"]
+        if hit:
+            row["locked_at"] = params["locked_at"]
+        return SimpleNamespace(rowcount=int(hit))
+
+    async def commit(self):
+        for key, (obj, seen) in list(self.loaded.items()):
+            changed = {k: v for k, v in vars(obj).items() if seen.get(k) != v}
+            self.db.rows[key].update(changed)
+            self.loaded[key] = (obj, dict(self.db.rows[key]))
+
+    async def rollback(self):
+        for key in list(self.loaded):
+            self._load(key)
+
+
+class ProvisioningJobTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.db = FakeDB()
+        self.expires_at = datetime.now(timezone.utc) + timedelta(days=10)
+        self.db.put(User, id=1, tg_id=555)
+        self.db.put(Tariff, id=3, days=30)
+        self.db.put(VPNSubscription, id=9, expires_at=self.expires_at)
+        self.db.put(Order, id=2, idUser=1, idTarif=3, subscription_id=9, purpose_order="extension",
+            bundle_tariff_id=None, status="paid", provider="stars")
+        self.db.put(ProvisioningJob, id=4, order_id=2, status="pending", attempts=0, locked_at=None, locked_by=None,
+            progress=None, last_error=None, next_run_at=datetime.now(timezone.utc), created_at=datetime.now(timezone.utc),
+            finished_at=None)
+
+        self.extends, self.notified, self.fail_after_extend = [], [], None
+        self.old = (provrq.async_session, provrq.berq.pay_and_extend_vpn, provrq.rq.process_referral_reward,
+            provrq._notify)
+
+        async def pay_and_extend_vpn(subscription_id, tariff_id, until=None):
+            # как настоящая: своя транзакция, срок только вперёд до until
+            sub = self.db.row(VPNSubscription, subscription_id)
+            self.extends.append(until)
+            sub["expires_at"] = max(sub["expires_at"], until)
+            if self.fail_after_extend:
+                self.fail_after_extend()
+            return {"days_added": 30, "expires_at_human": str(sub["expires_at"])}
+
+        async def no_referral(session, order):
+            pass
+
+        async def notify(tg_id, text, order_id):
+            self.notified.append(text)
+
+        provrq.async_session = self.db.session
+        provrq.berq.pay_and_extend_vpn = pay_and_extend_vpn
+        provrq.rq.process_referral_reward = no_referral
+        provrq._notify = notify
+
+    def tearDown(self):
+        (provrq.async_session, provrq.berq.pay_and_extend_vpn, provrq.rq.process_referral_reward,
+            provrq._notify) = self.old
+
+    def job(self):
+        return self.db.row(ProvisioningJob, 4)
+
+    async def test_claim_takes_lease(self):
+        session = FakeSession(self.db)
+
+        @asynccontextmanager
+        async def one_session():
+            yield session
+
+        provrq.async_session = one_session
+        job_id, lease = await provrq._claim_job()
+        self.assertEqual(job_id, 4)
+        self.assertIn("FOR UPDATE SKIP LOCKED", session.query)
+        self.assertEqual((self.job()["status"], self.job()["attempts"], self.job()["locked_by"]), ("running", 1, lease))
+        self.assertEqual(self.db.row(Order, 2)["status"], "processing")
+        provrq.async_session = self.db.session
+        self.assertIsNone(await provrq._claim_job())
+
+    async def test_extension_done_once(self):
+        job_id, lease = await provrq._claim_job()
+        await provrq.run_job(job_id, lease)
+        self.assertEqual(self.job()["status"], "done")
+        self.assertEqual(self.db.row(Order, 2)["status"], "completed")
+        self.assertEqual(self.db.row(VPNSubscription, 9)["expires_at"], self.expires_at + timedelta(days=30))
+        self.assertEqual(len(self.notified), 1)
+
+    async def test_retried_extension_adds_no_extra_days(self):
+        def referral_failed():
+            self.fail_after_extend = None
+            raise Exception("referral failed")
+
+        # продление на панели и в БД прошло, а финальный коммит — нет
+        self.fail_after_extend = referral_failed
+        job_id, lease = await provrq._claim_job()
+        await provrq.run_job(job_id, lease)
+        self.assertEqual(self.job()["status"], "pending")
+        self.assertEqual(self.job()["last_error"], "referral failed")
+        self.assertGreater(self.job()["next_run_at"], datetime.now(timezone.utc))
+
+        self.job()["next_run_at"] = datetime.now(timezone.utc)
+        job_id, lease = await provrq._claim_job()
+        await provrq.run_job(job_id, lease)
+        self.assertEqual(self.job()["status"], "done")
+        self.assertEqual(self.extends[0], self.extends[1])  # повтор доводит до того же срока
+        self.assertEqual(self.db.row(VPNSubscription, 9)["expires_at"], self.expires_at + timedelta(days=30))
+
+    async def test_lost_lease_cannot_finish(self):
+        job_id, lease = await provrq._claim_job()
+
+        def taken_over():
+            self.job()["locked_by"] = "other-worker"  # наш heartbeat отстал, задачу забрали
+
+        extend = provrq.berq.pay_and_extend_vpn
+
+        async def slow_extend(subscription_id, tariff_id, until=None):
+            result = await extend(subscription_id, tariff_id, until)
+            taken_over()
+            return result
+
+        provrq.berq.pay_and_extend_vpn = slow_extend
+        await provrq.run_job(job_id, lease)
+        self.assertEqual((self.job()["status"], self.job()["locked_by"]), ("running", "other-worker"))
+        self.assertEqual(self.db.row(Order, 2)["status"], "processing")
+        self.assertEqual(self.notified, [])
+
+    async def test_dead_after_max_attempts(self):
+        def panel_down():
+            raise Exception("panel down")
+
+        self.fail_after_extend = panel_down
+        self.job()["attempts"] = provrq.PROVISIONING_MAX_ATTEMPTS - 1
+        job_id, lease = await provrq._claim_job()
+        await provrq.run_job(job_id, lease)
+        self.assertEqual(self.job()["status"], "dead")
+        self.assertIsNotNone(self.job()["finished_at"])
+        self.assertEqual(self.db.row(Order, 2)["status"], "failed")
+        self.assertEqual(len(self.notified), 1)
+
+        self.fail_after_extend = None
+        self.assertEqual(await provrq.retry_job(4), {"id": 4, "status": "pending"})
+        self.assertEqual((self.job()["status"], self.job()["attempts"]), ("pending", 0))
+        self.assertEqual(self.db.row(Order, 2)["status"], "paid")
+        with self.assertRaises(ValueError):
+            await provrq.retry_job(4)  # уже не dead
+        self.assertEqual([j["status"] for j in await provrq.list_jobs()], ["pending"])
+
+    async def test_heartbeat_renews_until_lease_lost(self):
+        job_id, lease = await provrq._claim_job()
+        claimed_at = self.job()["locked_at"]
+        old_beat, provrq.PROVISIONING_HEARTBEAT_SEC = provrq.PROVISIONING_HEARTBEAT_SEC, 0.01
+        try:
+            heartbeat = asyncio.create_task(provrq._heartbeat(job_id, lease))
+            await asyncio.sleep(0.05)
+            self.assertGreater(self.job()["locked_at"], claimed_at)
+            self.job()["locked_by"] = "other-worker"
+            await asyncio.wait_for(heartbeat, 1)  # аренду забрали — heartbeat сам выходит
+        finally:
+            provrq.PROVISIONING_HEARTBEAT_SEC = old_beat
+
+    def test_backoff_grows_and_caps(self):
+        self.assertEqual(provrq.backoff_sec(1), provrq.PROVISIONING_BACKOFF_SEC)
+        self.assertEqual(provrq.backoff_sec(2), provrq.PROVISIONING_BACKOFF_SEC * 2)
+        self.assertEqual(provrq.backoff_sec(50), provrq.PROVISIONING_BACKOFF_MAX_SEC)
+
+
+if __name__ == "__main__":
+    unittest.main()
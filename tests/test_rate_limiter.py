@@ -0,0 +1,40 @@
+import unittest
+
+import rate_limiter
+
+
+class RateLimiterTests(unittest.TestCase):
+    def setUp(self):
+        rate_limiter.subscription_token_limiter.clear()
+        rate_limiter.subscription_ip_limiter.clear()
+
+    def test_bucket_burst_then_refill(self):
+        limiter = rate_limiter.RateLimiter(burst=2, per_min=60)
+        self.assertTrue(limiter.allow("tok"))
+        self.assertTrue(limiter.allow("tok"))
+        self.assertFalse(limiter.allow("tok"))
+        self.assertEqual(limiter.retry_after("tok"), 1)
+
+        limiter.bucket("tok").updated -= 1
+        self.assertTrue(limiter.allow("tok"))
+        self.assertTrue(limiter.allow("other"))
+
+    def test_oldest_keys_evicted(self):
+        limiter = rate_limiter.RateLimiter(burst=1, per_min=1, max_keys=2)
+        for key in ("a", "b", "c"):
+            limiter.allow(key)
+        self.assertEqual(list(limiter._buckets), ["b", "c"])
+
+    def test_denied_poll_does_not_spend_other_budget(self):
+        ip_bucket = rate_limiter.subscription_ip_limiter.bucket("10.0.0.1")
+        token_bucket = rate_limiter.subscription_token_limiter.bucket("tok")
+        token_bucket.tokens = 0
+        before = ip_bucket.tokens
+
+        self.assertFalse(rate_limiter.allow_subscription_poll("tok", "10.0.0.1"))
+        self.assertAlmostEqual(ip_bucket.tokens, before, places=1)
+        self.assertGreater(rate_limiter.subscription_retry_after("tok", "10.0.0.1"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
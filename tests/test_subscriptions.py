@@ -0,0 +1,326 @@
+import asyncio
+import base64
+import gzip
+import json
+import unittest
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from py3xui import Inbound
+from starlette.requests import Request
+
+import requestsfile as rq
+import sub_links
+import subscriptionrequests as subrq
+
+
+class SingleSubscriptionCacheTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.hits = 0
+        self.panel_down = False
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            self.hits += 1
+            if self.panel_down:
+                return httpx.Response(502)
+            return httpx.Response(200, text=f"vless://config-{self.hits}")
+
+        subrq._cache.clear()
+        subrq._http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    async def asyncTearDown(self):
+        await subrq.close_subscription_http()
+
+    async def test_fresh_hit_served_from_memory(self):
+        first = await subrq.get_single_content("tok", "https://panel:2096/sub/a")
+        second = await subrq.get_single_content("tok", "https://panel:2096/sub/a")
+        self.assertEqual(first, second)
+        self.assertEqual(self.hits, 1)
+
+    async def test_stale_served_and_refreshed_in_background(self):
+        await subrq.get_single_content("tok", "https://panel:2096/sub/a")
+        subrq._cache["tok"].fetched_at -= subrq.SUB_CACHE_TTL + 1
+        stale = await subrq.get_single_content("tok", "https://panel:2096/sub/a")
+        self.assertEqual(stale, "vless://config-1")
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.hits, 2)
+        self.assertEqual(subrq._cache["tok"].text, "vless://config-2")
+
+    async def test_expired_entry_survives_panel_error(self):
+        await subrq.get_single_content("tok", "https://panel:2096/sub/a")
+        subrq._cache["tok"].fetched_at -= subrq.SUB_CACHE_TTL + subrq.SUB_CACHE_STALE_SEC + 1
+        self.panel_down = True
+        self.assertEqual(await subrq.get_single_content("tok", "https://panel:2096/sub/a"), "vless://config-1")
+
+    async def test_error_without_cache_raises(self):
+        self.panel_down = True
+        with self.assertRaises(subrq.SubscriptionFetchError):
+            await subrq.get_single_content("tok", "https://panel:2096/sub/a")
+
+    async def test_concurrent_fetches_coalesced(self):
+        async def slow_handler(request: httpx.Request) -> httpx.Response:
+            self.hits += 1
+            await asyncio.sleep(0.05)
+            return httpx.Response(200, text="vless://shared")
+
+        subrq._http = httpx.AsyncClient(transport=httpx.MockTransport(slow_handler))
+        texts = await asyncio.gather(*[subrq.fetch_subscription("https://panel:2096/sub/a") for _ in range(5)])
+        self.assertEqual(texts, ["vless://shared"] * 5)
+        self.assertEqual(self.hits, 1)
+        self.assertEqual(subrq._flight.in_flight(), 0)
+
+
+class BundlePayloadStoreTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.hits = 0
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            self.hits += 1
+            lines = f"vless://{request.url.host}\nvless://shared"
+            return httpx.Response(200, text=base64.b64encode(lines.encode()).decode())
+
+        subrq._bundles.clear()
+        subrq._bundle_parts.clear()
+        subrq._http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        self.urls = [(1, "https://fi.panel:2096/sub/x"), (2, "https://nl.panel:2096/sub/x")]
+
+    async def asyncTearDown(self):
+        await subrq.close_subscription_http()
+
+    async def test_merged_once_then_served_from_memory(self):
+        encoded = await subrq.get_bundle_payload(10, self.urls)
+        lines = base64.b64decode(encoded).decode().splitlines()
+        self.assertEqual(lines, ["vless://fi.panel", "vless://shared", "vless://nl.panel"])
+
+        self.assertEqual(await subrq.get_bundle_payload(10, self.urls), encoded)
+        self.assertEqual(self.hits, 2)
+
+    async def test_cancelled_caller_does_not_cancel_build(self):
+        async def slow(request: httpx.Request) -> httpx.Response:
+            await asyncio.sleep(0.05)
+            return httpx.Response(200, text=base64.b64encode(f"vless://{request.url.host}".encode()).decode())
+
+        subrq._http = httpx.AsyncClient(transport=httpx.MockTransport(slow))
+        first = asyncio.create_task(subrq.get_bundle_payload(10, self.urls))
+        second = asyncio.create_task(subrq.get_bundle_payload(10, self.urls))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        encoded = await second
+        self.assertEqual(base64.b64decode(encoded).decode().splitlines(), ["vless://fi.panel", "vless://nl.panel"])
+        self.assertTrue(first.cancelled())
+
+    async def test_stale_rebuilt_on_access_only(self):
+        encoded = await subrq.get_bundle_payload(10, self.urls)
+        subrq._bundles[10].built_at -= subrq.BUNDLE_REFRESH_SEC + 1
+        await subrq.evict_idle_bundles()
+        self.assertEqual(self.hits, 2)  # фон сам панели не опрашивает
+
+        self.assertEqual(await subrq.get_bundle_payload(10, self.urls), encoded)  # старое сразу, сборка в фоне
+        await asyncio.gather(*subrq._bundle_tasks.values())
+        self.assertEqual(self.hits, 4)
+        await subrq.get_bundle_payload(10, self.urls)
+        self.assertEqual(self.hits, 4)
+
+    async def test_too_stale_waits_for_rebuild(self):
+        await subrq.get_bundle_payload(10, self.urls)
+        subrq._bundles[10].built_at -= subrq.BUNDLE_STALE_SEC + 1
+        await subrq.get_bundle_payload(10, self.urls)
+        self.assertEqual(self.hits, 4)
+        self.assertLess(subrq._bundles[10].age(), 1)
+
+    async def test_idle_bundle_evicted(self):
+        await subrq.get_bundle_payload(10, self.urls)
+        subrq._bundles[10].accessed_at -= subrq.BUNDLE_IDLE_SEC + 1
+        await subrq.evict_idle_bundles()
+        self.assertNotIn(10, subrq._bundles)
+
+    async def test_server_change_drops_payload(self):
+        await subrq.get_bundle_payload(10, self.urls)
+        subrq.invalidate_server_bundles(2)
+        self.assertNotIn(10, subrq._bundles)
+
+    async def test_deadline_backfills_slow_server(self):
+        await subrq.get_bundle_payload(10, self.urls)
+        subrq._bundles.clear()
+
+        async def slow_nl(request: httpx.Request) -> httpx.Response:
+            if request.url.host == "nl.panel":
+                await asyncio.sleep(1)
+            return httpx.Response(200, text=f"vless://{request.url.host}-new")
+
+        subrq._http = httpx.AsyncClient(transport=httpx.MockTransport(slow_nl))
+        old_deadline, subrq.BUNDLE_SUB_DEADLINE_SEC = subrq.BUNDLE_SUB_DEADLINE_SEC, 0.05
+        try:
+            payload = await subrq.build_bundle_payload(10, self.urls)
+        finally:
+            subrq.BUNDLE_SUB_DEADLINE_SEC = old_deadline
+        lines = base64.b64decode(payload.encoded).decode().splitlines()
+        self.assertEqual(lines, ["vless://fi.panel-new", "vless://nl.panel", "vless://shared"])
+        self.assertEqual(payload.missing, (2,))
+        self.assertEqual(len(subrq._part_tasks), 1)
+        for task in list(subrq._part_tasks):
+            task.cancel()
+
+
+class AccessTokenCacheTests(unittest.TestCase):
+    def setUp(self):
+        subrq._tokens.clear()
+
+    def test_lru_ttl_and_server_invalidation(self):
+        resolved = subrq.ResolvedToken("single", None, [(3, "https://de.panel:2096/sub/a")])
+        subrq.put_token("tok", resolved)
+        self.assertIs(subrq.get_token("tok"), resolved)
+
+        subrq.invalidate_server_tokens(3)
+        self.assertIsNone(subrq.get_token("tok"))
+
+        subrq.put_token("tok", resolved)
+        resolved.stored_at -= subrq.TOKEN_CACHE_TTL + 1
+        self.assertIsNone(subrq.get_token("tok"))
+
+    def test_forget_bundle_drops_payload_and_tokens(self):
+        subrq.put_token("b-tok", subrq.ResolvedToken("bundle", None, [(1, "https://fi.panel:2096/sub/x")], bundle_id=10))
+        subrq.put_token("other", subrq.ResolvedToken("bundle", None, [(1, "https://fi.panel:2096/sub/y")], bundle_id=11))
+        subrq._bundles[10] = object()
+        subrq.forget_bundle(10)
+        self.assertNotIn(10, subrq._bundles)
+        self.assertIsNone(subrq.get_token("b-tok"))
+        self.assertIsNotNone(subrq.get_token("other"))
+
+
+class TokenRecheckTests(unittest.IsolatedAsyncioTestCase):
+    """отдельный subscription_app: токен из кэша сверяем с БД, ротация/продление видны через TOKEN_RECHECK_SEC"""
+
+    def setUp(self):
+        subrq._tokens.clear()
+        self.expires_at = datetime(2027, 1, 1, tzinfo=timezone.utc)
+        self.db_expires_at = self.expires_at
+        self.queries = 0
+        self.old_session, self.old_recheck = rq.async_session, subrq.TOKEN_RECHECK_SEC
+
+        @asynccontextmanager
+        async def session():
+            yield self
+
+        rq.async_session = session
+        subrq.TOKEN_RECHECK_SEC = 5
+        self.resolved = subrq.ResolvedToken("bundle", self.expires_at, [(1, "https://fi.panel:2096/sub/x")], bundle_id=10)
+        subrq.put_token("tok", self.resolved)
+
+    def tearDown(self):
+        rq.async_session, subrq.TOKEN_RECHECK_SEC = self.old_session, self.old_recheck
+
+    async def scalar(self, query):
+        self.queries += 1
+        return self.db_expires_at
+
+    async def test_fresh_hit_skips_db(self):
+        self.assertIs(await rq.resolve_bundle_token("tok"), self.resolved)
+        self.assertEqual(self.queries, 0)
+
+    async def test_unchanged_token_rechecked(self):
+        self.resolved.checked_at -= 6
+        self.assertIs(await rq.resolve_bundle_token("tok"), self.resolved)
+        self.assertEqual(self.queries, 1)
+        await rq.resolve_bundle_token("tok")
+        self.assertEqual(self.queries, 1)
+
+    async def test_rotated_or_renewed_token_dropped(self):
+        self.resolved.checked_at -= 6
+        self.db_expires_at = None  # access_token ротировали
+        self.assertFalse(await rq._token_current("tok", self.resolved, rq.BundleSubscription))
+        self.assertIsNone(subrq.get_token("tok"))
+
+        subrq.put_token("tok", self.resolved)
+        self.db_expires_at = self.expires_at + timedelta(days=30)  # продлили в основном процессе
+        self.assertFalse(await rq._token_current("tok", self.resolved, rq.BundleSubscription))
+        self.assertIsNone(subrq.get_token("tok"))
+
+
+class LocalRenderTests(unittest.TestCase):
+    def make_inbound(self, **stream):
+        stream_settings = {"network": "tcp", "security": "reality", "realitySettings": {
+            "serverNames": ["www.microsoft.com"], "shortIds": ["ab12"],
+            "settings": {"publicKey": "PUBKEY", "fingerprint": "chrome", "spiderX": "/"}}}
+        stream_settings.update(stream)
+        return Inbound.model_validate({
+            "id": 1, "port": 443, "protocol": "vless", "enable": True, "remark": "FI",
+            "settings": json.dumps({"clients": [{"id": "uuid-1", "email": "Finland - 7,1", "enable": True,
+                "flow": "xtls-rprx-vision", "subId": "sub1"}], "decryption": "none"}),
+            "streamSettings": json.dumps(stream_settings),
+            "sniffing": json.dumps({"enabled": False}),
+        })
+
+    def test_reality_link(self):
+        inbound = self.make_inbound()
+        links = sub_links.render_vless_links(inbound, inbound.settings.clients[0], "fi.example.com")
+        self.assertEqual(links, ["vless://uuid-1@fi.example.com:443?type=tcp&encryption=none&security=reality"
+            "&pbk=PUBKEY&fp=chrome&sni=www.microsoft.com&sid=ab12&spx=%2F&flow=xtls-rprx-vision#FI-Finland%20-%207%2C1"])
+
+    def test_unsupported_transport_falls_back(self):
+        inbound = self.make_inbound(network="kcp")
+        self.assertIsNone(sub_links.render_vless_links(inbound, inbound.settings.clients[0], "fi.example.com"))
+
+
+def make_request(client: tuple[str, int] | None = None, **headers) -> Request:
+    raw = [(k.replace("_", "-").encode(), v.encode()) for k, v in headers.items()]
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": raw, "client": client})
+
+
+class SubscriptionResponseTests(unittest.TestCase):
+    content = "dmxlc3M6Ly91dWlkQGhvc3Q6NDQz" * 40
+
+    def test_etag_and_not_modified(self):
+        first = subrq.subscription_response(make_request(), self.content, 1700000000, {"update-always": "true"})
+        self.assertEqual(first.status_code, 200)
+        etag = first.headers["etag"]
+        self.assertEqual(first.headers["cache-control"], "no-cache")
+
+        again = subrq.subscription_response(make_request(if_none_match=etag), self.content, 1700000000, {})
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.body, b"")
+
+        renewed = subrq.subscription_response(make_request(if_none_match=etag), self.content, 1800000000, {})
+        self.assertEqual(renewed.status_code, 200)
+
+    def test_traffic_change_busts_etag(self):
+        headers = {"subscription-userinfo": "upload=1; download=2; total=0; expire=1700000000"}
+        first = subrq.subscription_response(make_request(), self.content, 1700000000, headers)
+        headers = {"subscription-userinfo": "upload=1; download=9; total=0; expire=1700000000"}
+        again = subrq.subscription_response(make_request(if_none_match=first.headers["etag"]), self.content,
+            1700000000, headers)
+        self.assertEqual(again.status_code, 200)
+
+    def test_gzip_negotiation(self):
+        resp = subrq.subscription_response(make_request(accept_encoding="gzip, deflate"), self.content, 1, {})
+        self.assertEqual(resp.headers["content-encoding"], "gzip")
+        self.assertEqual(gzip.decompress(resp.body).decode(), self.content)
+        self.assertEqual(resp.headers["vary"], "Accept-Encoding")
+
+        plain = subrq.subscription_response(make_request(accept_encoding="gzip;q=0"), self.content, 1, {})
+        self.assertNotIn("content-encoding", plain.headers)
+        self.assertNotEqual(plain.headers["etag"], resp.headers["etag"])
+
+        # ETag сжатого ответа не подходит для несжатого и наоборот
+        again = subrq.subscription_response(make_request(if_none_match=resp.headers["etag"], accept_encoding="gzip"),
+            self.content, 1, {})
+        self.assertEqual(again.status_code, 304)
+        other = subrq.subscription_response(make_request(if_none_match=resp.headers["etag"]), self.content, 1, {})
+        self.assertEqual(other.status_code, 200)
+
+
+class ClientIpTests(unittest.TestCase):
+    def test_real_ip_only_from_trusted_proxy(self):
+        via_nginx = make_request(client=("127.0.0.1", 5000), x_real_ip="203.0.113.7")
+        self.assertEqual(subrq.client_ip(via_nginx), "203.0.113.7")
+
+        direct = make_request(client=("198.51.100.2", 5000), x_real_ip="203.0.113.7")
+        self.assertEqual(subrq.client_ip(direct), "198.51.100.2")
+
+        self.assertEqual(subrq.client_ip(make_request(client=("127.0.0.1", 5000))), "127.0.0.1")
+        self.assertIsNone(subrq.client_ip(make_request(x_real_ip="203.0.113.7")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import json
+import unittest
+from types import SimpleNamespace
+
+from py3xui import Inbound
+
+import trafficrequests as trafficrq
+
+
+def make_inbound(clients: list[tuple[str, str]], stats: list[dict]) -> Inbound:
+    return Inbound.model_validate({
+        "id": 1, "port": 443, "protocol": "vless", "enable": True, "remark": "main",
+        "settings": json.dumps({"clients": [{"id": uuid, "email": email, "enable": True} for uuid, email in clients],
+            "decryption": "none"}),
+        "streamSettings": json.dumps({"network": "tcp", "security": "reality"}),
+        "sniffing": json.dumps({"enabled": False}),
+        "clientStats": [{"id": n, "inboundId": 1, "enable": True, "expiryTime": 0, "reset": 0, **st}
+            for n, st in enumerate(stats, 1)],
+    })
+
+
+class TrafficUsageTests(unittest.TestCase):
+    def setUp(self):
+        trafficrq._usage.clear()
+        trafficrq.ingest_inbound(1, make_inbound(
+            [("uuid-1", "Finland - 7,1"), ("uuid-2", "Finland - 8,1")],
+            [{"email": "Finland - 7,1", "up": 100, "down": 200, "total": 1000},
+             {"email": "Finland - 8,1", "up": 5, "down": 6, "total": 0},
+             {"email": "gone", "up": 1, "down": 1, "total": 0}]))
+        trafficrq.ingest_inbound(2, make_inbound(
+            [("uuid-3", "Netherlands - 7,1-plan")],
+            [{"email": "Netherlands - 7,1-plan", "up": 10, "down": 20, "total": 500}]))
+
+    def test_ingest_maps_stats_to_uuid(self):
+        self.assertEqual(trafficrq._usage[1], {"uuid-1": (100, 200, 1000), "uuid-2": (5, 6, 0)})
+
+    def test_sum_across_servers(self):
+        clients = {1: (SimpleNamespace(), "uuid-1"), 2: (SimpleNamespace(), "uuid-3")}
+        self.assertEqual(trafficrq.usage_for(clients), (110, 220, 1500))
+        self.assertEqual(trafficrq.userinfo_header(clients, 1700000000),
+            "upload=110; download=220; total=1500; expire=1700000000")
+
+    def test_unlimited_server_makes_total_unlimited(self):
+        clients = {1: (SimpleNamespace(), "uuid-2"), 2: (SimpleNamespace(), "uuid-3")}
+        self.assertEqual(trafficrq.usage_for(clients), (15, 26, 0))
+
+    def test_no_data_yet(self):
+        clients = {3: (SimpleNamespace(), "uuid-9")}
+        self.assertIsNone(trafficrq.usage_for(clients))
+        self.assertEqual(trafficrq.userinfo_header(clients, 1700000000), "expire=1700000000")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import unittest
+from decimal import Decimal
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.exc import IntegrityError
+
+import main
+from models import Payment, User, UserWallet, WalletOperation, WebhookEvent, async_session
+import webhookrequests as whrq
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+class WebhookEventTests(unittest.IsolatedAsyncioTestCase):
+    INVOICE_ID = "test-invoice-999000112"
+
+    @classmethod
+    def setUpClass(cls):
+        required = ["DB_USER", "DB_PASSWORD", "DB_HOST", "DB_PORT", "DB_NAME"]
+        if not all(os.getenv(k) for k in required):
+            raise unittest.SkipTest("Database env vars not set")
+
+    async def asyncSetUp(self):
+        async with async_session() as session:
+            user = User(tg_id=999000112, tg_username="test_webhook", userRole="user")
+            session.add(user)
+            await session.flush()
+            wallet = UserWallet(idUser=user.idUser, balance_usdt=Decimal("0"))
+            op = WalletOperation(idUser=user.idUser, type="deposit", amount_usdt=Decimal("2"),
+                provider="cryptobot", status="pending")
+            session.add_all([wallet, op])
+            await session.flush()
+            session.add(Payment(wallet_operation_id=op.id, provider="cryptobot",
+                provider_payment_id=self.INVOICE_ID, status="pending"))
+            await session.commit()
+            self.user_id, self.op_id = user.idUser, op.id
+
+        self.event_key = f"invoice_paid:{self.INVOICE_ID}"
+        self.data = {"update_type": "invoice_paid",
+            "payload": {"invoice_id": self.INVOICE_ID, "payload": f"wallet:{self.op_id}"}}
+        self.old_bot, main.bot = main.bot, FakeBot()
+        self.complete = main.wrq.complete_wallet_deposit
+
+    async def asyncTearDown(self):
+        main.bot, main.wrq.complete_wallet_deposit = self.old_bot, self.complete
+        async with async_session() as session:
+            await session.execute(delete(WebhookEvent).where(WebhookEvent.event_key == self.event_key))
+            await session.execute(delete(Payment).where(Payment.provider_payment_id == self.INVOICE_ID))
+            await session.execute(delete(WalletOperation).where(WalletOperation.id == self.op_id))
+            await session.execute(delete(UserWallet).where(UserWallet.idUser == self.user_id))
+            await session.execute(delete(User).where(User.idUser == self.user_id))
+            await session.commit()
+
+    async def balance(self) -> Decimal:
+        async with async_session() as session:
+            return await session.scalar(select(UserWallet.balance_usdt).where(UserWallet.idUser == self.user_id))
+
+    async def test_duplicate_event_replays_stored_response(self):
+        first = await main.crypto_webhook(self.data)
+        self.assertEqual(first, {"ok": True, "wallet_operation_id": self.op_id})
+
+        second = await main.crypto_webhook(self.data)
+        self.assertEqual(second, first)  # ответ из журнала, а не «уже обработан»
+        self.assertEqual(await self.balance(), Decimal("2"))
+        self.assertEqual(len(main.bot.sent), 1)
+
+        async with async_session() as session:
+            self.assertIsNone(await whrq.begin_event(session, "cryptobot", self.event_key))
+            await session.rollback()
+
+    async def test_failed_handler_leaves_event_retryable(self):
+        async def broken(session, wallet_operation_id):
+            raise RuntimeError("db hiccup")
+
+        main.wrq.complete_wallet_deposit = broken
+        with self.assertRaises(RuntimeError):
+            await main.crypto_webhook(self.data)
+
+        async with async_session() as session:
+            events = await session.scalar(select(func.count()).select_from(WebhookEvent)
+                .where(WebhookEvent.provider == "cryptobot", WebhookEvent.event_key == self.event_key))
+            payment = await session.scalar(select(Payment.status).where(Payment.provider_payment_id == self.INVOICE_ID))
+        self.assertEqual(events, 0)
+        self.assertEqual(payment, "pending")
+
+        main.wrq.complete_wallet_deposit = self.complete
+        self.assertEqual(await main.crypto_webhook(self.data), {"ok": True, "wallet_operation_id": self.op_id})
+        self.assertEqual(await self.balance(), Decimal("2"))
+
+    async def test_replay_without_outcome_is_ok(self):
+        async with async_session() as session:
+            self.assertIsNotNone(await whrq.begin_event(session, "cryptobot", self.event_key))
+            await session.commit()
+        async with async_session() as session:
+            self.assertEqual(await whrq.replay(session, "cryptobot", self.event_key), {"ok": True})
+
+    async def test_payment_provider_id_unique(self):
+        async with async_session() as session:
+            session.add(Payment(wallet_operation_id=self.op_id, provider="cryptobot",
+                provider_payment_id=self.INVOICE_ID, status="pending"))
+            with self.assertRaises(IntegrityError):
+                await session.commit()
+
+        # тот же id у другого провайдера — другой платёж
+        async with async_session() as session:
+            session.add(Payment(wallet_operation_id=self.op_id, provider="telegram_stars",
+                provider_payment_id=self.INVOICE_ID, status="paid"))
+            await session.commit()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,345 @@
+import json
+import time
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+import httpx
+
+import panel_metrics
+from panel_health import PanelHealth
+import reconcilerequests as recrq
+from xui_api import XUIApi
+
+
+class FakePanel:
+    """Минимальная 3x-ui: login + inbounds/list/get + addClient + update + updateClient + getClientTraffics + delClient."""
+
+    def __init__(self):
+        self.logins = 0
+        self.calls = []
+        self.session_valid = True
+        self.has_update_client = True
+        self.clients = [
+            {"id": "uuid-1", "email": "Finland - 7,1", "enable": True, "expiryTime": 0, "subId": "sub1"},
+        ]
+
+    def inbound(self):
+        return {
+            "id": 1, "port": 443, "protocol": "vless", "enable": True, "remark": "main",
+            "settings": json.dumps({"clients": self.clients, "decryption": "none"}),
+            "streamSettings": json.dumps({"network": "tcp", "security": "reality"}),
+            "sniffing": json.dumps({"enabled": False}),
+        }
+
+    def ok(self, obj=None):
+        return httpx.Response(200, json={"success": True, "msg": "", "obj": obj},
+            headers={"set-cookie": "3x-ui=session; Path=/"})
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        self.calls.append((request.method, path))
+        if path.endswith("/login"):
+            self.logins += 1
+            self.session_valid = True
+            return self.ok()
+        if not self.session_valid or "3x-ui=session" not in request.headers.get("cookie", ""):
+            return httpx.Response(404)
+        if path.endswith("/inbounds/list"):
+            return self.ok([self.inbound()])
+        if "/inbounds/get/" in path:
+            return self.ok(self.inbound())
+        if path.endswith("/addClient"):
+            body = json.loads(request.content)
+            self.clients.extend(json.loads(body["settings"])["clients"])
+            return self.ok()
+        if "/inbounds/update/" in path:
+            body = json.loads(request.content)
+            self.clients = json.loads(body["settings"])["clients"]
+            return self.ok()
+        if "/updateClient/" in path and self.has_update_client:
+            client_id = path.rsplit("/", 1)[1]
+            updated = json.loads(json.loads(request.content)["settings"])["clients"][0]
+            self.clients = [updated if c["id"] == client_id else c for c in self.clients]
+            return self.ok()
+        if "/getClientTraffics/" in path:
+            email = path.rsplit("/", 1)[1]
+            client = next((c for c in self.clients if c["email"] == email), None)
+            return self.ok({"email": email, "enable": client["enable"], "expiryTime": client["expiryTime"]}
+                if client else None)
+        if "/delClient/" in path:
+            client_id = path.rsplit("/", 1)[1]
+            self.clients = [c for c in self.clients if c["id"] != client_id]
+            return self.ok()
+        return httpx.Response(404)
+
+
+def make_xui(panel: FakePanel) -> XUIApi:
+    xui = XUIApi("https://panel.local:2053/secret", "admin", "pass")
+    xui._http = httpx.AsyncClient(base_url=xui.api_url + "/", transport=httpx.MockTransport(panel.handler))
+    return xui
+
+
+class XUIApiTransportTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.panel = FakePanel()
+        self.xui = make_xui(self.panel)
+
+    async def asyncTearDown(self):
+        await self.xui.aclose()
+
+    async def test_login_once_and_keep_session(self):
+        await self.xui.get_inbounds()
+        await self.xui.get_inbound(1)
+        self.assertEqual(self.panel.logins, 1)
+        self.assertTrue(all(path.startswith("/secret/") for _, path in self.panel.calls))
+
+    async def test_relogin_on_expired_session(self):
+        await self.xui.get_inbounds()
+        self.panel.session_valid = False
+        self.xui.invalidate_inbounds()
+        inbound = await self.xui.get_inbound_by_port(443)
+        self.assertEqual(inbound.id, 1)
+        self.assertEqual(self.panel.logins, 2)
+
+    async def test_add_extend_remove_client(self):
+        added = await self.xui.add_client(1, "Finland - 7,2", days=30, sub_id="sub2")
+        self.assertEqual(added["sub_id"], "sub2")
+
+        extended = await self.xui.extend_client(1, "Finland - 7,2", days=7)
+        self.assertEqual(extended["new_expiry"], added["expiry_time"] + 7 * 86400000)
+        self.assertEqual(extended["sub_id"], "sub2")
+
+        await self.xui.remove_client(1, added["uuid"])
+        self.assertEqual([c["email"] for c in self.panel.clients], ["Finland - 7,1"])
+
+    async def test_extend_uses_update_client(self):
+        added = await self.xui.add_client(1, "Finland - 7,2", days=30, sub_id="sub2")
+        await self.xui.extend_client(1, "Finland - 7,2", days=7)
+        self.assertFalse(any("/inbounds/update/" in p for _, p in self.panel.calls))
+        client = next(c for c in self.panel.clients if c["email"] == "Finland - 7,2")
+        self.assertEqual(client["id"], added["uuid"])
+        self.assertEqual(client["limitIp"], 2)
+        self.assertEqual(client["expiryTime"], added["expiry_time"] + 7 * 86400000)
+        self.assertEqual(len(self.panel.clients), 2)
+
+    async def test_extend_to_target_is_idempotent(self):
+        added = await self.xui.add_client(1, "Finland - 7,2", days=30, sub_id="sub2")
+        target = added["expiry_time"] + 7 * 86400000
+        first = await self.xui.extend_client(1, "Finland - 7,2", days=7, expiry_ms=target)
+        self.panel.calls.clear()
+        again = await self.xui.extend_client(1, "Finland - 7,2", days=7, expiry_ms=target)
+        self.assertEqual(first["new_expiry"], target)
+        self.assertEqual(again["new_expiry"], target)
+        self.assertFalse(any("/updateClient/" in p for _, p in self.panel.calls))  # повтор только читает срок
+        self.assertEqual(self.panel.clients[-1]["expiryTime"], target)
+
+    async def test_extend_reads_expiry_under_inbound_lock(self):
+        await self.xui.add_client(1, "Finland - 7,2", days=30, sub_id="sub2")
+        self.panel.calls.clear()
+        lock = self.xui._inbound_locks.setdefault(1, asyncio.Lock())
+        await lock.acquire()
+        task = asyncio.create_task(self.xui.extend_client(1, "Finland - 7,2", days=7))
+        await asyncio.sleep(0.05)
+        self.assertFalse(task.done())  # ждёт перезапись инбаунда
+        lock.release()
+        await task
+        calls = [p for _, p in self.panel.calls if not p.endswith("/login")]
+        self.assertEqual(len(calls), 2)
+        self.assertIn("/getClientTraffics/", calls[0])
+        self.assertIn("/updateClient/", calls[1])
+
+    async def test_extends_against_stale_snapshot_add_both_periods(self):
+        added = await self.xui.add_client(1, "Finland - 7,2", days=30, sub_id="sub2")
+        await self.xui.get_inbounds()  # снимок в кэше, дальше панель меняют мимо него
+        client = next(c for c in self.panel.clients if c["email"] == "Finland - 7,2")
+        client["expiryTime"] += 7 * 86400000  # продление из другого процесса
+        await self.xui.extend_client(1, "Finland - 7,2", days=7)
+        await self.xui.extend_client(1, "Finland - 7,2", days=7)
+        client = next(c for c in self.panel.clients if c["email"] == "Finland - 7,2")
+        self.assertEqual(client["expiryTime"], added["expiry_time"] + 21 * 86400000)
+
+    async def test_panel_error_on_expiry_read_does_not_extend(self):
+        await self.xui.add_client(1, "Finland - 7,2", days=30, sub_id="sub2")
+        self.panel.clients = [c for c in self.panel.clients if c["email"] != "Finland - 7,2"]
+        with self.assertRaises(Exception):
+            await self.xui.extend_client(1, "Finland - 7,2", days=7)
+        self.assertFalse(any("/updateClient/" in p for _, p in self.panel.calls))
+
+    async def test_list_fetched_before_write_keeps_written_snapshot(self):
+        await self.xui.get_inbounds()
+        stale = dict(self.panel.inbound())
+        real_handler = self.panel.handler
+
+        def handler(request):
+            if request.url.path.endswith("/inbounds/list"):
+                # пока ответ «летел», успели продлить клиента
+                self.xui._inbounds[1].put_client(self.xui._inbounds[1].by_email["Finland - 7,1"].model_copy(
+                    update={"expiry_time": 123}))
+                return self.panel.ok([stale])
+            return real_handler(request)
+
+        self.xui._http = httpx.AsyncClient(base_url=self.xui.api_url + "/", transport=httpx.MockTransport(handler))
+        await self.xui.get_inbounds()
+        self.assertEqual(self.xui._inbounds[1].by_email["Finland - 7,1"].expiry_time, 123)
+
+    async def test_extend_falls_back_without_update_client(self):
+        self.panel.has_update_client = False
+        added = await self.xui.add_client(1, "Finland - 7,2", days=30, sub_id="sub2")
+        extended = await self.xui.extend_client(1, "Finland - 7,2", days=7)
+        self.assertEqual(extended["new_expiry"], added["expiry_time"] + 7 * 86400000)
+        self.assertFalse(self.xui._has_update_client)
+
+        self.panel.calls.clear()
+        await self.xui.extend_client(1, "Finland - 7,2", days=1)
+        self.assertFalse(any("/updateClient/" in p for _, p in self.panel.calls))
+
+    async def test_bulk_add_and_extend_single_request(self):
+        added = await self.xui.add_clients_bulk(1, [
+            {"email": "Finland - 7,2", "days": 30},
+            {"email": "Finland - 7,3", "days": 30, "sub_id": "sub3"},
+        ])
+        self.assertEqual(sum(1 for _, p in self.panel.calls if p.endswith("/addClient")), 1)
+        self.assertTrue(added[0]["sub_id"])
+        self.assertEqual(added[1]["sub_id"], "sub3")
+        self.assertEqual(len(self.panel.clients), 3)
+
+        results = await self.xui.extend_clients_bulk(1, {"Finland - 7,2": 7, "Finland - 7,3": 1, "missing": 1})
+        self.assertEqual(sum(1 for _, p in self.panel.calls if "/inbounds/update/" in p), 1)
+        self.assertEqual(results["Finland - 7,2"]["new_expiry"], added[0]["expiry_time"] + 7 * 86400000)
+        self.assertEqual(results["missing"], {"error": "Client not found"})
+        expiry = {c["email"]: c["expiryTime"] for c in self.panel.clients}
+        self.assertEqual(expiry["Finland - 7,3"], added[1]["expiry_time"] + 86400000)
+
+    async def test_apply_inbound_changes_and_readd(self):
+        await self.xui.add_client(1, "Finland - 7,2", days=30, sub_id="sub2")
+        self.panel.calls.clear()
+        await self.xui.apply_inbound_changes(1, expiry_by_email={"Finland - 7,1": 12345}, remove_emails={"Finland - 7,2"})
+        self.assertEqual(sum(1 for _, p in self.panel.calls if "/inbounds/update/" in p), 1)
+        self.assertEqual(self.panel.clients[0]["expiryTime"], 12345)
+        self.assertEqual(len(self.panel.clients), 1)
+
+        await self.xui.add_clients_bulk(1, [{"email": "Finland - 7,2", "uuid": "uuid-2", "sub_id": "sub2", "expiry_time": 999}])
+        readded = self.panel.clients[-1]
+        self.assertEqual((readded["id"], readded["expiryTime"]), ("uuid-2", 999))
+
+    async def test_records_panel_metrics(self):
+        panel_metrics.reset_metrics()
+        await self.xui.get_inbounds()
+        self.panel.session_valid = False
+        self.xui.invalidate_inbounds()
+        await self.xui.get_inbound(1)
+
+        stats = panel_metrics.metrics_snapshot()["servers"][self.xui.api_url]
+        self.assertEqual(stats["login"]["calls"], 2)
+        self.assertEqual(stats["get_inbounds"]["calls"], 1)
+        self.assertGreater(stats["get_inbounds"]["bytes_received"], 0)
+        self.assertEqual(stats["get_inbound"]["relogins"], 1)
+        self.assertEqual(stats["get_inbound"]["errors"], 0)
+
+    async def test_cancelled_request_not_counted(self):
+        await self.xui.get_inbounds()
+        panel_metrics.reset_metrics()
+        self.xui.health = PanelHealth(1)
+
+        async def hanging(request):
+            await asyncio.sleep(10)
+
+        self.xui._http._transport = httpx.MockTransport(hanging)
+        task = asyncio.create_task(self.xui.get_inbounds())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(len(self.xui.health.samples), 0)
+        self.assertNotIn(self.xui.api_url, panel_metrics.metrics_snapshot()["servers"])
+
+    async def test_inbound_cache_and_write_through(self):
+        await self.xui.get_inbound_by_port(443)
+        await self.xui.get_inbound_by_port(443)
+        await self.xui.find_client(1, "Finland - 7,1")
+        reads = [p for _, p in self.panel.calls if "/inbounds/list" in p or "/inbounds/get/" in p]
+        self.assertEqual(len(reads), 1)
+
+        added = await self.xui.add_client(1, "Finland - 7,2", days=30, sub_id="sub2")
+        client = await self.xui.find_client(1, "Finland - 7,2")
+        self.assertEqual(str(client.id), added["uuid"])
+
+        await self.xui.remove_client(1, added["uuid"])
+        self.assertIsNone(await self.xui.find_client(1, "Finland - 7,2"))
+        reads = [p for _, p in self.panel.calls if "/inbounds/list" in p or "/inbounds/get/" in p]
+        self.assertEqual(len(reads), 1)
+
+
+class ReconcileTests(unittest.IsolatedAsyncioTestCase):
+    DAY_MS = 86400000
+
+    async def asyncSetUp(self):
+        self.panel = FakePanel()
+        self.xui = make_xui(self.panel)
+        self.server = SimpleNamespace(idServerVPN=1, nameVPN="Finland", inbound_port=443)
+        self.now_ms = int(time.time() * 1000)
+        self.panel.clients = [
+            {"id": "uuid-1", "email": "Finland - 7,1", "enable": True, "expiryTime": self.now_ms + self.DAY_MS, "subId": "s1"},
+            {"id": "uuid-2", "email": "Finland - 7,2", "enable": True, "expiryTime": self.now_ms + 9 * self.DAY_MS, "subId": "s2"},
+            {"id": "uuid-9", "email": "Finland - 9,1", "enable": True, "expiryTime": self.now_ms + self.DAY_MS, "subId": "s9"},
+        ]
+        self.expected = {
+            "Finland - 7,1": {"uuid": "uuid-1", "sub_id": "s1", "expiry_ms": self.now_ms + 5 * self.DAY_MS},
+            "Finland - 7,2": {"uuid": "uuid-2", "sub_id": "s2", "expiry_ms": self.now_ms + 3 * self.DAY_MS},
+            "Finland - 7,3": {"uuid": "uuid-3", "sub_id": "s3", "expiry_ms": self.now_ms + 2 * self.DAY_MS},
+        }
+        self.known = set(self.expected)
+        recrq._orphan_seen.clear()
+        self.old_remove, recrq.RECONCILE_REMOVE_ORPHANS = recrq.RECONCILE_REMOVE_ORPHANS, True
+
+    async def asyncTearDown(self):
+        recrq.RECONCILE_REMOVE_ORPHANS = self.old_remove
+        await self.xui.aclose()
+
+    def expiry(self, email):
+        return next(c["expiryTime"] for c in self.panel.clients if c["email"] == email)
+
+    async def test_report_only(self):
+        report = await recrq.reconcile_inbound(self.xui, self.server, self.expected, self.known, repair=False)
+        self.assertEqual(report["drift"], ["Finland - 7,1", "Finland - 7,2"])
+        self.assertEqual(report["missing"], ["Finland - 7,3"])
+        self.assertEqual(report["orphans"], ["Finland - 9,1"])
+        self.assertFalse(any("/inbounds/update/" in p or "/addClient" in p for _, p in self.panel.calls))
+
+    async def test_repair_moves_expiry_forward_only(self):
+        report = await recrq.reconcile_inbound(self.xui, self.server, self.expected, self.known, repair=True)
+        self.assertTrue(report["repaired"])
+        self.assertEqual(self.expiry("Finland - 7,1"), self.expected["Finland - 7,1"]["expiry_ms"])
+        # на панели срок позже (продление успело раньше БД) — не откатываем
+        self.assertEqual(self.expiry("Finland - 7,2"), self.now_ms + 9 * self.DAY_MS)
+        readded = next(c for c in self.panel.clients if c["email"] == "Finland - 7,3")
+        self.assertEqual((readded["id"], readded["subId"]), ("uuid-3", "s3"))
+        writes = [p for m, p in self.panel.calls if m == "POST" and not p.endswith("/login")]
+        self.assertEqual(len(writes), 2)
+
+    async def test_renewal_between_reads_not_undone(self):
+        await self.xui.get_inbounds()
+        # продление легло на панель после того, как сверка прочитала БД
+        self.panel.clients[0]["expiryTime"] = self.now_ms + 30 * self.DAY_MS
+        await self.xui.apply_inbound_changes(1, expiry_by_email={"Finland - 7,1": self.now_ms + 5 * self.DAY_MS})
+        self.assertEqual(self.expiry("Finland - 7,1"), self.now_ms + 30 * self.DAY_MS)
+
+    async def test_orphan_removed_after_grace(self):
+        await recrq.reconcile_inbound(self.xui, self.server, self.expected, self.known, repair=True)
+        self.assertIn("Finland - 9,1", [c["email"] for c in self.panel.clients])  # может быть покупкой в процессе
+
+        recrq._orphan_seen[(1, "Finland - 9,1")] -= recrq.RECONCILE_ORPHAN_GRACE_SEC
+        await recrq.reconcile_inbound(self.xui, self.server, self.expected, self.known, repair=True)
+        self.assertNotIn("Finland - 9,1", [c["email"] for c in self.panel.clients])
+
+    async def test_orphan_forgotten_once_known(self):
+        await recrq.reconcile_inbound(self.xui, self.server, self.expected, self.known, repair=False)
+        self.assertIn((1, "Finland - 9,1"), recrq._orphan_seen)
+        self.known.add("Finland - 9,1")
+        await recrq.reconcile_inbound(self.xui, self.server, self.expected, self.known, repair=False)
+        self.assertNotIn((1, "Finland - 9,1"), recrq._orphan_seen)
+
+
+if __name__ == "__main__":
+    unittest.main()
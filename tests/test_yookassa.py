@@ -0,0 +1,57 @@
+import json
+import unittest
+from decimal import Decimal
+
+import httpx
+
+import yookassarequests as ykrq
+
+
+class YooKassaClientTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.calls = []
+        self.fail_first = 0
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            # заглушка API ЮKassa: POST /v3/payments
+            self.calls.append(request)
+            if len(self.calls) <= self.fail_first:
+                return httpx.Response(503)
+            body = json.loads(request.content)
+            return httpx.Response(200, json={"id": "pay-1", "status": "pending", "amount": body["amount"],
+                "confirmation": {"type": "redirect", "confirmation_url": "https://yoomoney.ru/checkout/pay-1"}})
+
+        self.old_delay, ykrq.YOOKASSA_RETRY_DELAY_SEC = ykrq.YOOKASSA_RETRY_DELAY_SEC, 0
+        ykrq._http = httpx.AsyncClient(base_url="https://api.yookassa.ru/v3/", auth=("shop", "secret"),
+            transport=httpx.MockTransport(handler))
+
+    async def asyncTearDown(self):
+        ykrq.YOOKASSA_RETRY_DELAY_SEC = self.old_delay
+        await ykrq.close_yookassa_http()
+
+    async def test_create_payment(self):
+        payment_id, url = await ykrq.create_yookassa_payment(7, Decimal("199.999"), "Buy VPN", {"purpose": "wallet"})
+        self.assertEqual((payment_id, url), ("pay-1", "https://yoomoney.ru/checkout/pay-1"))
+
+        request = self.calls[0]
+        self.assertEqual(request.url.path, "/v3/payments")
+        self.assertTrue(request.headers["authorization"].startswith("Basic "))
+        body = json.loads(request.content)
+        self.assertEqual(body["amount"], {"value": "200.00", "currency": "RUB"})
+        self.assertEqual(body["metadata"], {"order_id": "7", "purpose": "wallet"})
+
+    async def test_retry_reuses_idempotence_key(self):
+        self.fail_first = 2
+        await ykrq.create_yookassa_payment(7, Decimal("100"), "Buy VPN")
+        keys = {r.headers["idempotence-key"] for r in self.calls}
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(len(keys), 1)
+
+    async def test_gives_up_after_retries(self):
+        self.fail_first = ykrq.YOOKASSA_RETRIES + 1
+        with self.assertRaises(ykrq.YooKassaError):
+            await ykrq.create_yookassa_payment(7, Decimal("100"), "Buy VPN")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import asyncio
+import logging
+
+from sqlalchemy import select
+
+from models import async_session, ServersVPN
+from xui_api import get_xui
+import panel_health
+
+
+logger = logging.getLogger("traffic")
+
+TRAFFIC_INGEST_SEC = int(os.getenv("TRAFFIC_INGEST_SEC", "300"))
+
+# server_id -> {client_uuid: (upload, download, total)}; total — лимит в байтах, 0 — без лимита
+_usage: dict[int, dict[str, tuple[int, int, int]]] = {}
+
+
+def ingest_inbound(server_id: int, inbound) -> int:
+    """clientStats инбаунда -> память; clientStats знают email, подписки — uuid, поэтому сводим через settings"""
+    uuid_by_email = {c.email: str(c.id) for c in inbound.settings.clients or []}
+    stats = {}
+    for stat in inbound.client_stats or []:
+        client_uuid = uuid_by_email.get(stat.email)
+        if client_uuid:
+            stats[client_uuid] = (stat.up or 0, stat.down or 0, stat.total or 0)
+    _usage[server_id] = stats
+    return len(stats)
+
+
+async def ingest_server(server: ServersVPN) -> int:
+    # inbounds/list уже содержит clientStats всех клиентов — один запрос на сервер
+    inbounds = await get_xui(server).get_inbounds()
+    for inbound in inbounds:
+        if inbound.port == server.inbound_port:
+            return ingest_inbound(server.idServerVPN, inbound)
+    return 0
+
+
+async def ingest_all():
+    async with async_session() as session:
+        servers = (await session.scalars(select(ServersVPN).where(ServersVPN.is_active == True))).all()
+
+    # панели с открытой цепью пропускаем — остаются прошлые цифры
+    servers = [s for s in servers if panel_health.is_healthy(s.idServerVPN)]
+    results = await asyncio.gather(*[ingest_server(s) for s in servers], return_exceptions=True)
+    for server, result in zip(servers, results):
+        if isinstance(result, Exception):
+            logger.warning("Traffic ingest failed: server=%s err=%s", server.nameVPN, result)
+
+
+def usage_for(clients: dict) -> tuple[int, int, int] | None:
+    """сумма по серверам подписки: clients = {server_id: (server, client_uuid)}; None — данных ещё нет"""
+    found, unlimited = False, False
+    upload = download = total = 0
+    for server_id, (_, client_uuid) in clients.items():
+        stats = _usage.get(server_id, {}).get(str(client_uuid))
+        if not stats:
+            continue
+        found = True
+        upload += stats[0]
+        download += stats[1]
+        total += stats[2]
+        unlimited = unlimited or not stats[2]
+    if not found:
+        return None
+    return upload, download, 0 if unlimited else total
+
+
+def userinfo_header(clients: dict, expire_ts: int) -> str:
+    usage = usage_for(clients)
+    if not usage:
+        return f"expire={expire_ts}"
+    upload, download, total = usage
+    return f"upload={upload}; download={download}; total={total}; expire={expire_ts}"
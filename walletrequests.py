@@ -2,9 +2,10 @@ from decimal import Decimal
 from sqlalchemy import select
 from models import (
     User, UserWallet, WalletOperation, WalletTransaction,
-    Order, Payment, ExchangeRate
+    Order, Payment
 )
 from models import async_session
+import pricingrequests as pricerq
 
 
 # =========================
@@ -28,13 +29,11 @@ async def create_stars_deposit(tg_id: int, amount_usdt: Decimal):
         if not user:
             raise Exception("User not found")
 
-        rate = await session.scalar(select(ExchangeRate).where(ExchangeRate.pair == "XTR_USDT"))
+        rate = await pricerq.get_rate("XTR_USDT")
         if not rate:
             raise Exception("Exchange rate not set")
 
-        stars_amount = int(amount_usdt / rate.rate)
-        if stars_amount < 1:
-            stars_amount = 1
+        stars_amount = pricerq.stars_from_usdt(amount_usdt, rate)
 
         op = WalletOperation(
             idUser=user.idUser,
@@ -0,0 +1,28 @@
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import WebhookEvent
+
+
+async def begin_event(session, provider: str, event_key: str) -> int | None:
+    """insert-first: строка события пишется в транзакции обработки.
+    None — событие уже обработано (или прямо сейчас обрабатывается параллельной доставкой:
+    INSERT дождётся её коммита на уникальном индексе и тоже вернёт None).
+    Если обработка упадёт до коммита — строка откатится и повторная доставка пройдёт заново."""
+    return await session.scalar(pg_insert(WebhookEvent)
+        .values(provider=provider, event_key=event_key)
+        .on_conflict_do_nothing(index_elements=["provider", "event_key"])
+        .returning(WebhookEvent.id))
+
+
+async def replay(session, provider: str, event_key: str) -> dict:
+    """сохранённый ответ для повторной доставки"""
+    outcome = await session.scalar(select(WebhookEvent.outcome)
+        .where(WebhookEvent.provider == provider, WebhookEvent.event_key == event_key))
+    return outcome or {"ok": True}
+
+
+async def finish_event(session, event_id: int, outcome: dict) -> dict:
+    """запомнить результат; коммит — вместе с остальной обработкой"""
+    await session.execute(update(WebhookEvent).where(WebhookEvent.id == event_id).values(outcome=outcome))
+    return outcome
@@ -1,49 +1,284 @@
+import os
+import ssl
+import json
+import time
 import uuid
 import asyncio
-import requests
-import urllib3
+import logging
+import httpx
 from datetime import datetime, timedelta
-from py3xui import Api
+from py3xui import Inbound
 from py3xui.client.client import Client  # корректный импорт клиента
+from panel_health import PanelHealth, PanelUnavailable, get_health
+import panel_metrics
 
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+logger = logging.getLogger(__name__)
 
-_old_request = requests.Session.request
+# 3x-ui по умолчанию держит сессию 60 минут — логинимся заново чуть раньше
+XUI_SESSION_TTL = int(os.getenv("XUI_SESSION_TTL", "1800"))
+XUI_CONNECT_TIMEOUT = float(os.getenv("XUI_CONNECT_TIMEOUT", "5"))
+XUI_READ_TIMEOUT = float(os.getenv("XUI_READ_TIMEOUT", "15"))
+XUI_MAX_CONNECTIONS = int(os.getenv("XUI_MAX_CONNECTIONS", "10"))
+XUI_CONNECT_RETRIES = int(os.getenv("XUI_CONNECT_RETRIES", "2"))
+XUI_INBOUND_CACHE_TTL = float(os.getenv("XUI_INBOUND_CACHE_TTL", "30"))
 
-def _patched_request(self, method, url, **kwargs):
-    kwargs["verify"] = False
-    return _old_request(self, method, url, **kwargs)
+# панели на самоподписанных / IP-сертификатах — проверку не делаем.
+# Один контекст на процесс: не грузим его заново на каждый пул
+_ssl_context = ssl.create_default_context()
+_ssl_context.check_hostname = False
+_ssl_context.verify_mode = ssl.CERT_NONE
 
-requests.Session.request = _patched_request
+
+# эндпоинт панели -> имя операции в метриках
+_OPS = (
+    ("login", "login"),
+    ("inbounds/list", "get_inbounds"),
+    ("inbounds/get/", "get_inbound"),
+    ("addClient", "add_client"),
+    ("updateClient/", "extend_client"),
+    ("inbounds/update/", "update_inbound"),
+    ("delClient/", "remove_client"),
+    ("getClientTraffics/", "get_client_traffics"),
+)
+
+
+def _op_name(path: str) -> str:
+    for marker, op in _OPS:
+        if marker in path:
+            return op
+    return path
+
+
+class XUIAuthError(Exception):
+    """сессия панели протухла: 401/403/404, редирект или html-страница логина вместо json"""
+
+
+def _extended_expiry(old_expiry: int, days: int, expiry_ms: int | None = None) -> int:
+    """продление от текущего срока, если он ещё не истёк, иначе от сейчас.
+    expiry_ms — готовый целевой срок (повтор выдачи): ставим его, но назад не двигаем"""
+    if expiry_ms is not None:
+        return max(old_expiry, expiry_ms)
+    now_ms = int(datetime.utcnow().timestamp() * 1000)
+    add_ms = days * 86400000
+    return old_expiry + add_ms if old_expiry > now_ms else now_ms + add_ms
+
+
+class InboundSnapshot:
+    """inbound с панели + индексы клиентов по email и uuid"""
+
+    def __init__(self, inbound: Inbound):
+        self.inbound = inbound
+        self.fetched_at = time.monotonic()
+        self.changed_at = self.fetched_at  # последняя своя запись в снимок
+        self.reindex()
+
+    def reindex(self):
+        clients = self.inbound.settings.clients or []
+        self.by_email = {c.email: c for c in clients}
+        self.by_uuid = {str(c.id): c for c in clients}
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.fetched_at < XUI_INBOUND_CACHE_TTL
+
+    def put_client(self, client: Client):
+        clients = [c for c in self.inbound.settings.clients or [] if c.email != client.email]
+        clients.append(client)
+        self.inbound.settings.clients = clients
+        self.changed_at = time.monotonic()
+        self.reindex()
+
+    def drop_client(self, client_uuid: str):
+        self.inbound.settings.clients = [c for c in self.inbound.settings.clients or [] if str(c.id) != client_uuid]
+        self.changed_at = time.monotonic()
+        self.reindex()
 
 
 class XUIApi:
-    """API-обёртка над py3xui, совместимая с 3x-ui 2.x/3.x"""
+    """Асинхронный клиент 3x-ui 2.x/3.x поверх httpx (пул соединений на панель)"""
 
     def __init__(self, api_url: str, username: str, password: str):
-        self.api = Api(
-            host=api_url,
-            username=username,
-            password=password
+        self.api_url = api_url.rstrip("/")
+        self.username = username
+        self.password = password
+        self._http = httpx.AsyncClient(
+            base_url=self.api_url + "/",
+            verify=_ssl_context,
+            timeout=httpx.Timeout(XUI_READ_TIMEOUT, connect=XUI_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=XUI_MAX_CONNECTIONS,
+                max_keepalive_connections=XUI_MAX_CONNECTIONS,
+                keepalive_expiry=60,
+            ),
+            headers={"Accept": "application/json", "User-Agent": "ArtCryVPN/1.0"},
         )
         self._logged_in = False
+        self._login_at = 0.0
+        self._session_gen = 0
         self._lock = asyncio.Lock()
-
-    async def login(self):
+        self._inbounds: dict[int, InboundSnapshot] = {}
+        self._port_index: dict[int, int] = {}
+        self._refresh_task: asyncio.Task | None = None
+        self._inbound_locks: dict[int, asyncio.Lock] = {}
+        self._has_update_client: bool | None = None  # None — ещё не проверяли на этой панели
+        self.health: PanelHealth | None = None  # выставляет get_xui
+        self.server_id: int | None = None
+
+    async def aclose(self):
+        await self._http.aclose()
+
+    @property
+    def metrics_key(self) -> str:
+        return str(self.server_id) if self.server_id is not None else self.api_url
+
+    async def login(self, stale_gen: int | None = None):
         async with self._lock:
-            if not self._logged_in:
-                await asyncio.to_thread(self.api.login)
+            if stale_gen is not None and stale_gen != self._session_gen:
+                return  # сессию уже обновил параллельный запрос
+            expired = time.monotonic() - self._login_at > XUI_SESSION_TTL
+            if stale_gen is not None or not self._logged_in or expired:
+                self._http.cookies.clear()
+                started = time.monotonic()
+                try:
+                    resp = await self._send_raw("POST", "login", json={"username": self.username, "password": self.password})
+                    data = self._parse(resp)
+                except Exception as e:
+                    panel_metrics.record_call(self.metrics_key, "login", time.monotonic() - started, False, repr(e))
+                    raise
+                panel_metrics.record_call(self.metrics_key, "login", time.monotonic() - started, bool(data.get("success")), data.get("msg"))
+                if not data.get("success"):
+                    raise Exception(f"3x-ui login failed: {data.get('msg')}")
                 self._logged_in = True
+                self._login_at = time.monotonic()
+                self._session_gen += 1
+
+    async def _send_raw(self, method: str, path: str, **kwargs) -> httpx.Response:
+        # повторяем только если соединение так и не установилось — запрос не ушёл на панель
+        op = _op_name(path)
+        for attempt in range(XUI_CONNECT_RETRIES + 1):
+            try:
+                resp = await self._http.request(method, path, **kwargs)
+                panel_metrics.record_bytes(self.metrics_key, op, len(resp.request.content or b""), len(resp.content))
+                return resp
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                if attempt >= XUI_CONNECT_RETRIES:
+                    raise
+                panel_metrics.record_retry(self.metrics_key, op)
+                await asyncio.sleep(0.5 * (attempt + 1))
+
+    @staticmethod
+    def _parse(resp: httpx.Response) -> dict:
+        if resp.status_code in (401, 403, 404) or resp.is_redirect:
+            raise XUIAuthError(f"status={resp.status_code}")
+        resp.raise_for_status()
+        try:
+            return resp.json()
+        except ValueError:
+            raise XUIAuthError("non-json response")
+
+    async def _request(self, method: str, path: str, **kwargs):
+        """запрос к API панели с одним прозрачным перелогином при истёкшей сессии; возвращает obj"""
+        if self.health and not self.health.allow():
+            raise PanelUnavailable(f"3x-ui {self.api_url}: panel unavailable")
+        started = time.monotonic()
+        ok, error = True, None
+        try:
+            await self.login()
+            gen = self._session_gen
+            try:
+                data = self._parse(await self._send_raw(method, path, **kwargs))
+            except XUIAuthError:
+                panel_metrics.record_retry(self.metrics_key, _op_name(path), "relogin")
+                await self.login(stale_gen=gen)
+                data = self._parse(await self._send_raw(method, path, **kwargs))
+            if not data.get("success"):
+                raise Exception(f"3x-ui: {data.get('msg')}")
+        except asyncio.CancelledError:
+            # отменили нас (таймаут/отключение клиента), а не панель — в статистику не пишем
+            ok = None
+            raise
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            # панель не ответила / 5xx; 404 и success=false — панель жива
+            ok, error = False, repr(e)
+            raise
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            latency = time.monotonic() - started
+            if ok is None:
+                if self.health:
+                    self.health.release()
+            else:
+                if self.health:
+                    self.health.record(ok, latency, None if ok else error)
+                panel_metrics.record_call(self.metrics_key, _op_name(path), latency, error is None, error)
+        return data.get("obj")
+
+    async def probe(self) -> bool:
+        """пробный логин для полуоткрытой цепи (фоновая проверка)"""
+        if not self.health or not self.health.allow():
+            return False
+        started = time.monotonic()
+        ok, error = True, None
+        try:
+            await self.login(stale_gen=self._session_gen)
+        except asyncio.CancelledError:
+            self.health.release()
+            raise
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            ok, error = False, repr(e)
+        except Exception as e:
+            error = repr(e)
+        self.health.record(ok, time.monotonic() - started, error)
+        return ok
+
+    async def _update_inbound(self, inbound_id: int, inbound: Inbound):
+        await self._request("POST", f"panel/api/inbounds/update/{inbound_id}", json=inbound.to_json())
 
     # ---------------- INBOUNDS ----------------
+    def _store(self, inbound: Inbound) -> InboundSnapshot:
+        snap = InboundSnapshot(inbound)
+        self._inbounds[inbound.id] = snap
+        self._port_index[inbound.port] = inbound.id
+        return snap
+
+    def invalidate_inbounds(self):
+        self._inbounds.clear()
+        self._port_index.clear()
+
+    async def _snapshot(self, inbound_id: int, fresh: bool = False) -> InboundSnapshot | None:
+        snap = self._inbounds.get(inbound_id)
+        if snap and not fresh and snap.is_fresh():
+            return snap
+        obj = await self._request("GET", f"panel/api/inbounds/get/{inbound_id}")
+        if not obj:
+            self._inbounds.pop(inbound_id, None)
+            return None
+        return self._store(Inbound.model_validate(obj))
+
     async def get_inbounds(self):
-        await self.login()
-        return await asyncio.to_thread(self.api.inbound.get_list)
+        started = time.monotonic()
+        obj = await self._request("GET", "panel/api/inbounds/list")
+        inbounds = [Inbound.model_validate(i) for i in obj or []]
+        # список запрошен до нашей записи (продление/добавление) — в снимке она уже есть, а в ответе может не быть
+        kept = {i: snap for i, snap in self._inbounds.items() if snap.changed_at > started}
+        self.invalidate_inbounds()
+        for inbound in inbounds:
+            if inbound.id in kept:
+                self._inbounds[inbound.id] = kept[inbound.id]
+                self._port_index[inbound.port] = inbound.id
+            else:
+                self._store(inbound)
+        return [self._inbounds[inbound.id].inbound for inbound in inbounds]
 
 
     async def get_inbound_by_port(self, port: int):
-        """получить inbound по порту"""
+        """получить inbound по порту (из кэша, пока он свежий)"""
+        inbound_id = self._port_index.get(port)
+        snap = self._inbounds.get(inbound_id) if inbound_id is not None else None
+        if snap and snap.is_fresh():
+            return snap.inbound
         inbounds = await self.get_inbounds()
         for inbound in inbounds:
             if inbound.port == port:
@@ -51,148 +286,228 @@ class XUIApi:
         return None
 
 
-    async def get_inbound(self, inbound_id: int):
-        await self.login()
-        return await asyncio.to_thread(self.api.inbound.get_by_id, inbound_id)
-    
+    async def cached_snapshot_by_port(self, port: int) -> InboundSnapshot | None:
+        """снимок из кэша даже после TTL (обновляем в фоне) — для отдачи подписок, где важнее не ждать панель"""
+        inbound_id = self._port_index.get(port)
+        snap = self._inbounds.get(inbound_id) if inbound_id is not None else None
+        if not snap:
+            await self.get_inbound_by_port(port)
+            inbound_id = self._port_index.get(port)
+            return self._inbounds.get(inbound_id) if inbound_id is not None else None
+        if not snap.is_fresh() and (self._refresh_task is None or self._refresh_task.done()):
+            self._refresh_task = asyncio.create_task(self._refresh_inbounds())
+        return snap
 
-    # ————————— CLIENTS —————————
-    async def add_client(self, inbound_id: int, email: str, days: int, sub_id: str | None = None):
-        await self.login()
+    async def _refresh_inbounds(self):
+        try:
+            await self.get_inbounds()
+        except Exception as e:
+            logger.warning("3x-ui %s: background inbound refresh failed: %s", self.api_url, e)
 
-        inbound = await asyncio.to_thread(self.api.inbound.get_by_id, inbound_id)
-        if not inbound:
-            raise Exception("Inbound не найден")
 
-        client_uuid = str(uuid.uuid4())
-        expiry_time = int((datetime.utcnow() + timedelta(days=days)).timestamp() * 1000)
+    async def get_inbound(self, inbound_id: int, fresh: bool = False):
+        snap = await self._snapshot(inbound_id, fresh=fresh)
+        return snap.inbound if snap else None
 
-        try:
-            new_client = Client(
-                id=client_uuid,
-                email=email,
-                enable=True,
-                expiry_time=expiry_time,
-                sub_id=sub_id,
-                limit_ip=2
-            )
-        except TypeError:
-            new_client = Client(
-                id=client_uuid,
-                email=email,
-                enable=True,
-                expiry_time=expiry_time
-            )
-            if sub_id:
-                try:
-                    setattr(new_client, "sub_id", sub_id)
-                    setattr(new_client, "subId", sub_id)
-                except Exception:
-                    pass
-            try:
-                setattr(new_client, "limit_ip", 2)
-                setattr(new_client, "limitIp", 2)
-            except Exception:
-                pass
 
-        await asyncio.to_thread(self.api.client.add, inbound_id, [new_client])
+    async def find_client(self, inbound_id: int, email: str) -> Client | None:
+        snap = await self._snapshot(inbound_id)
+        return snap.by_email.get(email) if snap else None
 
-        client_sub_id = None
-        if sub_id:
-            client_sub_id = sub_id
-        else:
-            try:
-                fetched = await asyncio.to_thread(self.api.client.get_by_email, email)
-                for key in ("sub_id", "subId", "subid"):
-                    client_sub_id = getattr(fetched, key, None)
-                    if client_sub_id:
-                        break
-                if not client_sub_id and hasattr(fetched, "model_dump"):
-                    data = fetched.model_dump()
-                    client_sub_id = data.get("sub_id") or data.get("subId")
-                if not client_sub_id and hasattr(fetched, "dict"):
-                    data = fetched.dict()
-                    client_sub_id = data.get("sub_id") or data.get("subId")
-            except Exception:
-                client_sub_id = None
-        if not client_sub_id:
-            try:
-                inbound = await asyncio.to_thread(self.api.inbound.get_by_id, inbound_id)
-                for c in inbound.settings.clients or []:
-                    if c.email == email:
-                        for key in ("sub_id", "subId", "subid"):
-                            client_sub_id = getattr(c, key, None)
-                            if client_sub_id:
-                                break
-                        if not client_sub_id and hasattr(c, "model_dump"):
-                            data = c.model_dump()
-                            client_sub_id = data.get("sub_id") or data.get("subId")
-                        if not client_sub_id and hasattr(c, "dict"):
-                            data = c.dict()
-                            client_sub_id = data.get("sub_id") or data.get("subId")
-                        break
-            except Exception:
-                client_sub_id = None
 
-        return {
-            "uuid": client_uuid,
-            "email": email,
-            "expiry_time": expiry_time,
-            "sub_id": client_sub_id
-        }
+    # ————————— CLIENTS —————————
+    async def add_client(self, inbound_id: int, email: str, days: int, sub_id: str | None = None):
+        results = await self.add_clients_bulk(inbound_id, [{"email": email, "days": days, "sub_id": sub_id}])
+        return results[0]
 
 
-    async def extend_client(self, inbound_id: int, client_email: str, days: int, sub_id: str | None = None):
-        await self.login()
+    async def add_clients_bulk(self, inbound_id: int, specs: list[dict]) -> list[dict]:
+        """добавить N клиентов одним addClient.
+        spec: {"email", "days" | "expiry_time", "uuid"?, "sub_id"?, "limit_ip"?};
+        sub_id генерируем сами — без чтения назад"""
+        snap = await self._snapshot(inbound_id)
+        if not snap:
+            raise Exception("Inbound не найден")
 
-        inbound = await asyncio.to_thread(self.api.inbound.get_by_id,inbound_id)
-        if not inbound:
+        now = datetime.utcnow()
+        new_clients, results = [], []
+        for spec in specs:
+            client_uuid = spec.get("uuid") or str(uuid.uuid4())
+            if spec.get("expiry_time") is not None:
+                expiry_time = int(spec["expiry_time"])
+            else:
+                expiry_time = int((now + timedelta(days=spec["days"])).timestamp() * 1000)
+            sub_id = spec.get("sub_id") or uuid.uuid4().hex[:16]
+            new_clients.append({"id": client_uuid, "email": spec["email"], "enable": True,
+                "expiryTime": expiry_time, "limitIp": spec.get("limit_ip", 2), "subId": sub_id})
+            results.append({"uuid": client_uuid, "email": spec["email"], "expiry_time": expiry_time, "sub_id": sub_id})
+        if not new_clients:
+            return []
+
+        await self._request("POST", "panel/api/inbounds/addClient",
+            json={"id": inbound_id, "settings": json.dumps({"clients": new_clients})})
+        for c in new_clients:
+            snap.put_client(Client.model_validate(c))
+        return results
+
+
+    async def extend_clients_bulk(self, inbound_id: int, days_by_email: dict[str, int]) -> dict[str, dict]:
+        """продлить N клиентов одной перезаписью инбаунда; {email: {new_expiry, sub_id} | {error}}"""
+        async with self._inbound_locks.setdefault(inbound_id, asyncio.Lock()):
+            # перезаписываем инбаунд целиком — только свежая копия
+            snap = await self._snapshot(inbound_id, fresh=True)
+            if not snap:
+                raise Exception("Inbound not found")
+
+            results, changed = {}, False
+            for email, days in days_by_email.items():
+                client = snap.by_email.get(email)
+                if not client:
+                    results[email] = {"error": "Client not found"}
+                    continue
+                client.expiry_time = _extended_expiry(client.expiry_time or 0, days)
+                client.enable = True
+                results[email] = {"new_expiry": client.expiry_time, "sub_id": client.sub_id or None}
+                changed = True
+
+            if changed:
+                try:
+                    await self._update_inbound(inbound_id, snap.inbound)
+                except Exception:
+                    self._inbounds.pop(inbound_id, None)  # в кэше уже изменённые сроки
+                    raise
+        return results
+
+
+    async def apply_inbound_changes(self, inbound_id: int, expiry_by_email: dict[str, int] | None = None,
+            remove_emails: set[str] | None = None) -> Inbound:
+        """сдвинуть сроки вперёд и удалить клиентов одной перезаписью инбаунда (сверка с БД).
+        Срок только увеличиваем: сверху мог успеть лечь более поздний срок от продления"""
+        expiry_by_email = expiry_by_email or {}
+        remove_emails = remove_emails or set()
+        async with self._inbound_locks.setdefault(inbound_id, asyncio.Lock()):
+            snap = await self._snapshot(inbound_id, fresh=True)
+            if not snap:
+                raise Exception("Inbound not found")
+            expiry_by_email = {email: expiry for email, expiry in expiry_by_email.items()
+                if email in snap.by_email and (snap.by_email[email].expiry_time or 0) < expiry}
+            if not expiry_by_email and not (remove_emails & snap.by_email.keys()):
+                return snap.inbound
+
+            clients = []
+            for c in snap.inbound.settings.clients or []:
+                if c.email in remove_emails:
+                    continue
+                if c.email in expiry_by_email:
+                    c.expiry_time = expiry_by_email[c.email]
+                clients.append(c)
+            snap.inbound.settings.clients = clients
+            try:
+                await self._update_inbound(inbound_id, snap.inbound)
+            except Exception:
+                self._inbounds.pop(inbound_id, None)
+                raise
+            snap.reindex()
+            return snap.inbound
+
+
+    @staticmethod
+    def _client_settings(client: Client) -> dict:
+        """клиент в том виде, как он лежит в settings инбаунда"""
+        exclude = {"inbound_id", "up", "down", "total", "uuid"}
+        if not client.password:
+            exclude.add("password")
+        return client.model_dump(by_alias=True, exclude_none=True, exclude=exclude)
+
+    async def extend_client(self, inbound_id: int, client_email: str, days: int, sub_id: str | None = None,
+            expiry_ms: int | None = None):
+        """продлить на days; с expiry_ms — довести срок до expiry_ms (повторный вызов ничего не добавит)"""
+        if self._has_update_client is not False:
+            # тот же лок, что у перезаписи инбаунда целиком — иначе она затрёт наш срок
+            async with self._inbound_locks.setdefault(inbound_id, asyncio.Lock()):
+                result = await self._extend_client_update(inbound_id, client_email, days, sub_id, expiry_ms)
+            if result is not None:
+                return result
+        return await self._extend_client_rewrite(inbound_id, client_email, days, sub_id, expiry_ms)
+
+    async def _client_stats(self, client_email: str) -> dict:
+        """срок и enable клиента прямо с панели (client_traffics — маленький ответ).
+        Ошибки не глотаем: продлевать от устаревшего срока — значит потерять оплаченные дни"""
+        stats = await self._request("GET", f"panel/api/inbounds/getClientTraffics/{client_email}")
+        if not stats:
+            raise Exception("Client not found")
+        return stats
+
+    async def _extend_client_update(self, inbound_id: int, client_email: str, days: int, sub_id: str | None = None,
+            expiry_ms: int | None = None):
+        """продление одним updateClient; None — на панели нет updateClient"""
+        snap = await self._snapshot(inbound_id)
+        if snap and client_email not in snap.by_email:
+            snap = await self._snapshot(inbound_id, fresh=True)
+        if not snap:
             raise Exception("Inbound not found")
-
-        old_client = None
-        for c in inbound.settings.clients or []:
-            if c.email == client_email:
-                old_client = c
-                break
-
+        old_client = snap.by_email.get(client_email)
         if not old_client:
             raise Exception("Client not found")
 
-        # считаем новое время
-        now_ms = int(datetime.utcnow().timestamp() * 1000)
-        add_ms = days * 86400000
-
-        old_expiry = old_client.expiry_time or 0
-        new_expiry = (
-            old_expiry + add_ms
-            if old_expiry > now_ms
-            else now_ms + add_ms
-        )
-
-        client_uuid = old_client.id
+        # срок — с панели под локом инбаунда: снимок может быть старше чужого продления (другой процесс)
+        stats = await self._client_stats(client_email)
+        old_expiry = int(stats.get("expiryTime") or 0)
+        new_expiry = _extended_expiry(old_expiry, days, expiry_ms)
         if not sub_id:
-            for key in ("sub_id", "subId", "subid"):
-                sub_id = getattr(old_client, key, None)
-                if sub_id:
-                    break
-            if not sub_id and hasattr(old_client, "model_dump"):
-                data = old_client.model_dump()
-                sub_id = data.get("sub_id") or data.get("subId")
-            if not sub_id and hasattr(old_client, "dict"):
-                data = old_client.dict()
-                sub_id = data.get("sub_id") or data.get("subId")
-
-        # удаляем клиента
-        inbound.settings.clients = [
-            c for c in inbound.settings.clients
-            if c.email != client_email
-        ]
-
-        await asyncio.to_thread(self.api.inbound.update,inbound_id,inbound)
-        await asyncio.sleep(0.3)
-
-        # создаём нового (С ТЕМ ЖЕ UUID)
+            sub_id = old_client.sub_id or None
+        if expiry_ms is not None and stats.get("enable") and old_expiry == new_expiry:
+            return {"email": client_email, "new_expiry": new_expiry, "sub_id": sub_id}  # уже продлён прошлой попыткой
+
+        new_client = old_client.model_copy(update={"enable": True, "expiry_time": new_expiry, "sub_id": sub_id or ""})
         try:
+            await self._request("POST", f"panel/api/inbounds/updateClient/{old_client.id}",
+                json={"id": inbound_id, "settings": json.dumps({"clients": [self._client_settings(new_client)]})})
+        except XUIAuthError:
+            # 404 и после перелогина — на этой панели нет updateClient
+            if self._has_update_client:
+                raise
+            logger.warning("3x-ui %s: updateClient недоступен, продлеваем перезаписью инбаунда", self.api_url)
+            self._has_update_client = False
+            return None
+
+        self._has_update_client = True
+        # пока ждали панель, снимок мог смениться фоновым get_inbounds — пишем в текущий
+        snap = self._inbounds.get(inbound_id) or snap
+        snap.put_client(new_client)
+        return {"email": client_email, "new_expiry": new_expiry, "sub_id": sub_id}
+
+
+    async def _extend_client_rewrite(self, inbound_id: int, client_email: str, days: int, sub_id: str | None = None,
+            expiry_ms: int | None = None):
+        """старый путь для панелей без updateClient: две перезаписи инбаунда целиком"""
+        async with self._inbound_locks.setdefault(inbound_id, asyncio.Lock()):
+            # инбаунд переписывается целиком — только свежая копия, иначе потеряем чужих клиентов
+            snap = await self._snapshot(inbound_id, fresh=True)
+            if not snap:
+                raise Exception("Inbound not found")
+            inbound = snap.inbound
+
+            old_client = snap.by_email.get(client_email)
+            if not old_client:
+                raise Exception("Client not found")
+
+            new_expiry = _extended_expiry(old_client.expiry_time or 0, days, expiry_ms)
+
+            client_uuid = old_client.id
+            if not sub_id:
+                sub_id = old_client.sub_id or None
+
+            # удаляем клиента
+            inbound.settings.clients = [
+                c for c in inbound.settings.clients
+                if c.email != client_email
+            ]
+
+            await self._update_inbound(inbound_id, inbound)
+            await asyncio.sleep(0.3)
+
+            # создаём нового (С ТЕМ ЖЕ UUID)
             new_client = Client(
                 id=client_uuid,
                 email=client_email,
@@ -202,46 +517,65 @@ class XUIApi:
                 up=0,
                 down=0,
                 limit_ip=2,
-                sub_id=sub_id
+                sub_id=sub_id or ""
             )
-        except TypeError:
-            new_client = Client(
-                id=client_uuid,
-                email=client_email,
-                enable=True,
-                expiry_time=new_expiry,
-                total_gb=0,
-                up=0,
-                down=0
-            )
-            try:
-                setattr(new_client, "limit_ip", 2)
-                setattr(new_client, "limitIp", 2)
-                if sub_id:
-                    setattr(new_client, "sub_id", sub_id)
-                    setattr(new_client, "subId", sub_id)
-            except Exception:
-                pass
 
-        inbound.settings.clients.append(new_client)
+            inbound.settings.clients.append(new_client)
 
-        await asyncio.to_thread(self.api.inbound.update,inbound_id,inbound)
+            await self._update_inbound(inbound_id, inbound)
+            snap.reindex()
 
         return {"email": client_email,"new_expiry": new_expiry, "sub_id": sub_id}
 
 
     async def remove_client(self, inbound_id: int, client_uuid: str):
-        await self.login()
+        snap = await self._snapshot(inbound_id)
+        if snap and client_uuid not in snap.by_uuid:
+            snap = await self._snapshot(inbound_id, fresh=True)  # клиента могли добавить мимо кэша
+        if not snap or client_uuid not in snap.by_uuid:
+            raise Exception("Client not found")
+
+        await self._request("POST", f"panel/api/inbounds/{inbound_id}/delClient/{client_uuid}")
+        snap.drop_client(client_uuid)
+        return True
+
+
+# ————————— REGISTRY —————————
+# один залогиненный XUIApi на сервер на весь процесс; ключ — idServerVPN,
+# при смене api_url/логина/пароля инстанс пересоздаётся автоматически
+_registry: dict[int, tuple[tuple[str, str, str], XUIApi]] = {}
+
+
+def _close_later(xui: XUIApi):
+    try:
+        asyncio.get_running_loop().create_task(xui.aclose())
+    except RuntimeError:
+        pass
+
+
+def get_xui(server) -> XUIApi:
+    creds = (server.api_url, server.xui_username, server.xui_password)
+    entry = _registry.get(server.idServerVPN)
+    if entry and entry[0] == creds:
+        return entry[1]
+    if entry:
+        _close_later(entry[1])
+    xui = XUIApi(*creds)
+    xui.health = get_health(server.idServerVPN)
+    xui.server_id = server.idServerVPN
+    _registry[server.idServerVPN] = (creds, xui)
+    return xui
+
 
-        inbound = await asyncio.to_thread(self.api.inbound.get_by_id,inbound_id)
+def invalidate_xui(server_id: int):
+    """сбросить клиент сервера (смена кредов / удаление сервера)"""
+    entry = _registry.pop(server_id, None)
+    if entry:
+        _close_later(entry[1])
 
-        for client in inbound.settings.clients or []:
-            if client.id == client_uuid:
-                await asyncio.to_thread(
-                    self.api.client.delete,
-                    inbound_id,
-                    client.id
-                )
-                return True
 
-        raise Exception("Client not found")
\ No newline at end of file
+async def close_all_xui():
+    entries = list(_registry.values())
+    _registry.clear()
+    for _, xui in entries:
+        await xui.aclose()
@@ -1,21 +1,83 @@
-from yookassa import Configuration, Payment
 from decimal import Decimal
+import asyncio
+import logging
 import uuid
 import os
 
+import httpx
 
-Configuration.account_id = os.getenv("YOOKASSA_SHOP_ID")
-Configuration.secret_key = os.getenv("YOOKASSA_SECRET_KEY")
 
-async def create_yookassa_payment(order_id: int,amount_rub: Decimal,description: str,metadata: dict | None = None):
+logger = logging.getLogger("yookassa")
+
+YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
+YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY")
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3")
+YOOKASSA_CONNECT_TIMEOUT = float(os.getenv("YOOKASSA_CONNECT_TIMEOUT", "5"))
+YOOKASSA_READ_TIMEOUT = float(os.getenv("YOOKASSA_READ_TIMEOUT", "15"))
+YOOKASSA_RETRIES = int(os.getenv("YOOKASSA_RETRIES", "2"))
+YOOKASSA_RETRY_DELAY_SEC = float(os.getenv("YOOKASSA_RETRY_DELAY_SEC", "1"))
+
+# 202 — ЮKassa ещё обрабатывает запрос с этим Idempotence-Key, повторить с тем же ключом
+_RETRY_STATUSES = {202, 429, 500, 502, 503, 504}
+
+
+class YooKassaError(Exception):
+    """ЮKassa отклонила запрос или не ответила за все попытки"""
+
+
+_http: httpx.AsyncClient | None = None
+
+
+def _client() -> httpx.AsyncClient:
+    # один пул соединений на процесс вместо синхронного SDK, блокировавшего event loop
+    global _http
+    if _http is None or _http.is_closed:
+        _http = httpx.AsyncClient(
+            base_url=YOOKASSA_API_URL.rstrip("/") + "/",
+            auth=(YOOKASSA_SHOP_ID or "", YOOKASSA_SECRET_KEY or ""),
+            timeout=httpx.Timeout(YOOKASSA_READ_TIMEOUT, connect=YOOKASSA_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+    return _http
+
+
+async def close_yookassa_http():
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+
+
+async def _post(path: str, body: dict, idempotence_key: str) -> dict:
+    """POST с повторами; ключ идемпотентности один на все попытки — двойного платежа не будет"""
+    last = None
+    for attempt in range(YOOKASSA_RETRIES + 1):
+        try:
+            resp = await _client().post(path, json=body, headers={"Idempotence-Key": idempotence_key})
+        except httpx.TransportError as e:
+            last = f"{type(e).__name__}: {e}"
+        else:
+            if resp.status_code not in _RETRY_STATUSES:
+                if resp.status_code >= 400:
+                    raise YooKassaError(f"YooKassa {path} HTTP {resp.status_code}: {resp.text[:300]}")
+                return resp.json()
+            last = f"HTTP {resp.status_code}"
+        if attempt < YOOKASSA_RETRIES:
+            logger.warning("YooKassa %s retry %s: %s key=%s", path, attempt + 1, last, idempotence_key)
+            await asyncio.sleep(YOOKASSA_RETRY_DELAY_SEC * (attempt + 1))
+    raise YooKassaError(f"YooKassa {path} failed: {last}")
+
+
+async def create_yookassa_payment(order_id: int,amount_rub: Decimal,description: str,metadata: dict | None = None,
+    idempotence_key: str | None = None):
     payload = {"order_id": str(order_id)}
     if metadata:
         payload.update(metadata)
-    payment = Payment.create({
+    payment = await _post("payments", {
         "amount": {"value": str(amount_rub.quantize(Decimal("0.01"))),"currency": "RUB"},
         "confirmation": {"type": "redirect","return_url": os.getenv("YOOKASSA_RETURN_URL")},
         "capture": True,"description": description,
         "metadata": payload
-    }, uuid.uuid4())
+    }, idempotence_key or str(uuid.uuid4()))
 
-    return payment.id, payment.confirmation.confirmation_url
\ No newline at end of file
+    return payment["id"], payment["confirmation"]["confirmation_url"]